@@ -83,4 +83,28 @@ POPULATE_INTENDED_FOR_OPTS = {
 }
 # 'ModalityAcquisitionLabel': it checks for what modality (anat, func, dwi) each fmap is 
 # intended by checking the _acq- label in the fmap filename and finding corresponding 
-# modalities (e.g. _acq-fmri, _acq-bold and _acq-func will be matched with the func modality)
\ No newline at end of file
+# modalities (e.g. _acq-fmri, _acq-bold and _acq-func will be matched with the func modality)
+# --------------------------------------------------------------------------------------
+# grouping: Optional function, used by heudiconv only with "--grouping custom".
+#
+# Instead of reading the header of every DICOM file, the seqinfo is built from the index
+# of DICOM headers created by dicom_index.py (the database is given by the DICOM_INDEX
+# environment variable). See step02_dicom_to_bids_batch.py.
+#
+# heudiconv expects the series grouped by study ({StudyInstanceUID: {seqinfo: files}}) when
+# it is run with --files, as in step02_dicom_to_bids_batch.py, and a flat dict of the series
+# ({seqinfo: files}) when it is run with -d: set GROUPING_BY_STUDY to False for -d.
+# --------------------------------------------------------------------------------------
+GROUPING_BY_STUDY = True
+
+def grouping(files, dcmfilter, seqinfo_cls):
+    import os
+    import sys
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from dicom_index import seqinfos_from_index
+
+    db_path = os.environ.get('DICOM_INDEX')
+    if not db_path:
+        raise RuntimeError('Set DICOM_INDEX to the DICOM index database to use --grouping custom')
+    return seqinfos_from_index(files, db_path, seqinfo_cls,
+                               by_study=GROUPING_BY_STUDY, dcmfilter=dcmfilter)
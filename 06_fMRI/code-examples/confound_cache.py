@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ======================================================================
+# Cache of fMRIPrep confound files
+#
+# fMRIPrep's desc-confounds_timeseries.tsv files are wide text tables that
+# nilearn's load_confounds parses with pandas on every call. Here, the
+# confounds and sample masks of every denoising strategy are stored in one
+# binary .npz file per strategy, in a cache directory of the TSV, after they
+# are first computed with nilearn (which parses the TSV once). Later calls with
+# the same strategy read only that file, without parsing the TSV. Columns read
+# directly with load_confound_columns come from a binary copy of the whole
+# table, converted the first time they are asked for.
+#
+# The cache is valid while the size and modification time of the TSV are
+# unchanged; if only the modification time changed, the content hash
+# (sha256) is compared before the cache is discarded. The strategies also
+# depend on the JSON sidecar of the TSV (used to select the CompCor
+# components), so its hash is part of their key.
+#
+# Example usage:
+#   from confound_cache import load_confounds_cached, load_confound_columns
+#   confounds, sample_masks = load_confounds_cached(
+#       bold_files, cache_dir, strategy=("motion",), motion="basic")
+#   fd = load_confound_columns(confounds_file, ["framewise_displacement"], cache_dir)
+#
+# ======================================================================
+
+# ======================================================================
+# IMPORT REQUIRED PACKAGES
+# ======================================================================
+import os
+import json
+import hashlib
+import uuid
+import numpy as np
+import pandas as pd
+from importlib.metadata import version
+from nilearn.interfaces.fmriprep import load_confounds
+from nilearn.interfaces.fmriprep.load_confounds_utils import get_confounds_file, get_json
+
+# ======================================================================
+# CACHE FILES
+# ======================================================================
+
+def _sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def _replace(write, target_file):
+    """Write a cache file with write(tmp_file), then move it to target_file.
+
+    The temporary name is unique to the process, so concurrent jobs filling
+    the same cache never write to the same file; os.replace is atomic.
+    """
+    tmp_file = f"{target_file}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    try:
+        write(tmp_file)
+        os.replace(tmp_file, target_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def _save_npz(npz_file, arrays):
+    def write(tmp_file):
+        with open(tmp_file, "wb") as f:
+            np.savez(f, **arrays)
+    _replace(write, npz_file)
+
+def _save_meta(meta_file, meta):
+    def write(tmp_file):
+        with open(tmp_file, "w") as f:
+            json.dump(meta, f)
+    _replace(write, meta_file)
+
+def _load_store(confounds_file, cache_dir):
+    """
+    Cache directory of a confounds TSV, emptied if the TSV changed.
+
+    Returns
+    -------
+    store_dir : str
+        Directory with 'meta.json' (path, size, mtime and sha256 of the TSV),
+        one 'strategy-<key>.npz' file per cached strategy and, once
+        load_confound_columns was called, 'table.npz' (all confounds).
+    meta : dict
+        Content of meta.json.
+    """
+    key = hashlib.sha1(os.path.abspath(confounds_file).encode()).hexdigest()
+    store_dir = os.path.join(cache_dir, key)
+    os.makedirs(store_dir, exist_ok=True)
+    meta_file = os.path.join(store_dir, "meta.json")
+    stat = os.stat(confounds_file)
+
+    sha256 = None
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta["size"] == stat.st_size and meta["mtime"] == stat.st_mtime:
+            return store_dir, meta
+        sha256 = _sha256(confounds_file)
+        if meta["sha256"] == sha256:
+            # Same content, new modification time: record it
+            meta["mtime"] = stat.st_mtime
+            _save_meta(meta_file, meta)
+            return store_dir, meta
+
+    meta = {
+        "path": os.path.abspath(confounds_file),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sha256": sha256 or _sha256(confounds_file),
+    }
+    _save_meta(meta_file, meta)
+    # The table and the strategies of the old content are out of date (the
+    # strategies are keyed on its sha256)
+    for name in os.listdir(store_dir):
+        if name == "table.npz" or (
+            name.startswith("strategy-") and not name.startswith(f"strategy-{meta['sha256'][:16]}-")
+        ):
+            os.remove(os.path.join(store_dir, name))
+    return store_dir, meta
+
+# ======================================================================
+# LOAD CONFOUNDS
+# ======================================================================
+
+def load_confound_columns(confounds_file, columns=None, cache_dir=None):
+    """
+    Columns of a confounds TSV, read from the cache.
+
+    The whole table is converted to the cache the first time.
+
+    Parameters
+    ----------
+    confounds_file : str
+        fMRIPrep desc-confounds_timeseries.tsv file.
+    columns : list of str, optional
+        Columns to return (all columns if None).
+    cache_dir : str
+        Cache directory.
+
+    Returns
+    -------
+    confounds : pandas.DataFrame
+        Requested columns ('n/a' values are NaN).
+    """
+    store_dir, _ = _load_store(confounds_file, cache_dir)
+    table_file = os.path.join(store_dir, "table.npz")
+    if not os.path.exists(table_file):
+        table = pd.read_csv(confounds_file, delimiter="\t", encoding="utf-8")
+        _save_npz(table_file, {
+            "columns": np.asarray(table.columns, dtype=str),
+            "table": table.to_numpy(dtype=float),
+        })
+    with np.load(table_file) as f:
+        table = pd.DataFrame(f["table"], columns=f["columns"].tolist())
+    return table if columns is None else table[list(columns)]
+
+def load_confounds_cached(img_files, cache_dir, **kwargs):
+    """
+    Same as nilearn.interfaces.fmriprep.load_confounds, served from the cache.
+
+    The confounds and sample mask of each image are computed with nilearn the
+    first time a strategy (the keyword arguments) is requested, and stored
+    in a file of their own next to the cached confounds file. The nilearn
+    version and the hashes of the TSV and of its JSON sidecar are part of the
+    key, so they are computed again after any of them changes. The
+    ica_aroma='full' and tedana strategies, which read other files, are not
+    cached.
+
+    Parameters
+    ----------
+    img_files : str or list of str
+        fMRIPrep preprocessed BOLD files.
+    cache_dir : str or None
+        Cache directory. If None, nilearn's load_confounds is called directly.
+    **kwargs
+        Parameters of nilearn's load_confounds (strategy, motion, ...).
+
+    Returns
+    -------
+    confounds : pandas.DataFrame or list of pandas.DataFrame
+    sample_mask : None, numpy.ndarray or list of them
+    """
+    if cache_dir is None or kwargs.get("ica_aroma") == "full" or kwargs.get("tedana"):
+        return load_confounds(img_files, **kwargs)
+
+    single_file = isinstance(img_files, (str, os.PathLike))
+    confounds, sample_masks = [], []
+    for img_file in [img_files] if single_file else img_files:
+        confounds_file = get_confounds_file(
+            str(img_file), flag_full_aroma=False, flag_tedana=False
+        )
+        store_dir, meta = _load_store(confounds_file, cache_dir)
+        sidecar_file = get_json(confounds_file)
+        strategy_key = hashlib.sha1(json.dumps(
+            {
+                "parameters": kwargs,
+                "nilearn": version("nilearn"),
+                "sidecar": _sha256(sidecar_file) if os.path.exists(sidecar_file) else None,
+            },
+            sort_keys=True,
+            default=list
+        ).encode()).hexdigest()[:16]
+        strategy_file = os.path.join(
+            store_dir, f"strategy-{meta['sha256'][:16]}-{strategy_key}.npz"
+        )
+
+        if not os.path.exists(strategy_file):
+            img_confounds, img_sample_mask = load_confounds(str(img_file), **kwargs)
+            arrays = {
+                "columns": np.asarray(img_confounds.columns, dtype=str),
+                "values": img_confounds.to_numpy(dtype=float),
+            }
+            if img_sample_mask is not None:
+                arrays["sample_mask"] = img_sample_mask
+            _save_npz(strategy_file, arrays)
+
+        with np.load(strategy_file) as f:
+            confounds.append(pd.DataFrame(f["values"], columns=f["columns"].tolist()))
+            sample_masks.append(f["sample_mask"] if "sample_mask" in f.files else None)
+
+    if single_file:
+        return confounds[0], sample_masks[0]
+    return confounds, sample_masks
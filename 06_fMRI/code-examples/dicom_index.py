@@ -0,0 +1,350 @@
+"""
+Persistent index of DICOM headers for the BIDS conversion.
+
+heudiconv reads the header of every DICOM file each time it runs, to group
+the files into series and describe them (seqinfo) for the heuristic. This
+script reads the headers once, in parallel (header only, without the pixel
+data), and saves the fields that heudiconv uses in an SQLite database. Files
+are read again only if their size or modification time changed.
+
+The heuristic (bids_heuristic.py) then builds the seqinfo from the index:
+run heudiconv with "--grouping custom" and the DICOM_INDEX environment
+variable set to the database (see step02_dicom_to_bids_batch.py).
+
+Usage:
+  1. Activate the conda environment: conda activate mri
+  2. Index the DICOM files:
+       python dicom_index.py build ../mridata --db ../FaceRecognition/scratch/dicom_index.sqlite --n-jobs 8
+  3. Check how the heuristic classifies the series of a subject, without heudiconv:
+       python dicom_index.py preview ../mridata/CBU090962_MR09029 --db ../FaceRecognition/scratch/dicom_index.sqlite
+"""
+
+import argparse
+import importlib.util
+import math
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+# Header fields saved in the index (column name -> DICOM keyword or tag)
+HEADER_FIELDS = {
+    'series_number': 'SeriesNumber',
+    'protocol_name': 'ProtocolName',
+    'series_uid': 'SeriesInstanceUID',
+    'study_uid': 'StudyInstanceUID',
+    'sop_class': 'SOPClassUID',
+    'rows': 'Rows',
+    'columns': 'Columns',
+    'n_frames': 'NumberOfFrames',
+    'mosaic_images': (0x0019, 0x100A),  # Siemens NumberOfImagesInMosaic
+    'image_type': 'ImageType',
+    'repetition_time': 'RepetitionTime',
+    'echo_time': 'EchoTime',
+    'series_description': 'SeriesDescription',
+    'sequence_name': 'SequenceName',
+    'siemens_sequence_name': (0x0019, 0x109C),
+    'xa_sequence_name': (0x0018, 0x9005),
+    'patient_id': 'PatientID',
+    'study_description': 'StudyDescription',
+    'referring_physician_name': 'ReferringPhysicianName',
+    'accession_number': 'AccessionNumber',
+    'patient_age': 'PatientAge',
+    'patient_sex': 'PatientSex',
+    'acquisition_date': 'AcquisitionDate',
+    'acquisition_time': 'AcquisitionTime',
+}
+
+# SOP classes without image data, ignored as by heudiconv
+IGNORED_SOP_CLASSES = [
+    '1.2.840.10008.5.1.4.1.1.66',  # Raw Data Storage
+    '1.2.840.10008.5.1.4.1.1.11.1',  # Grayscale Softcopy Presentation State Storage
+]
+
+# ------------------------------------------------------------
+# Build the index
+# ------------------------------------------------------------
+
+def connect(db_path):
+    """Open the index, creating its table if needed"""
+    db = sqlite3.connect(db_path, timeout=60)
+    columns = ', '.join(f'{name}' for name in HEADER_FIELDS)
+    db.execute(
+        'CREATE TABLE IF NOT EXISTS files ('
+        'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, is_dicom INTEGER, '
+        f'{columns})'
+    )
+    return db
+
+def read_header(path):
+    """Index row of one file (is_dicom is 0 for files that are not DICOM images)"""
+    import pydicom
+
+    stat = os.stat(path)
+    row = {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime, 'is_dicom': 0}
+    try:
+        dcm = pydicom.dcmread(
+            path, stop_before_pixels=True, force=True,
+            specific_tags=[tag for tag in HEADER_FIELDS.values()]
+        )
+    except Exception:
+        return row
+
+    for name, tag in HEADER_FIELDS.items():
+        element = dcm.get(tag)
+        value = element.value if isinstance(element, pydicom.DataElement) else element
+        if isinstance(value, bytes) and name == 'mosaic_images':
+            # Private tag read without its VR (unsigned short)
+            value = int.from_bytes(value[:2], 'little')
+        elif isinstance(value, bytes):
+            value = value.decode(errors='ignore').strip('\x00 ')
+        elif isinstance(value, pydicom.multival.MultiValue):
+            value = '\\'.join(str(v) for v in value)
+        elif isinstance(value, int):
+            value = int(value)
+        elif isinstance(value, float):
+            value = float(value)
+        elif value is not None:
+            value = str(value)
+        row[name] = value
+    row['is_dicom'] = int(
+        row.get('series_number') is not None
+        and row.get('sop_class') not in IGNORED_SOP_CLASSES
+    )
+    return row
+
+def _read_headers(paths):
+    return [read_header(path) for path in paths]
+
+def update_index(db, paths, n_jobs=1, chunk_size=200):
+    """Read the headers of the files that are new or changed since they were indexed
+
+    Returns the number of files read.
+    """
+    indexed = {}
+    for i in range(0, len(paths), 500):
+        chunk = paths[i:i + 500]
+        indexed.update(
+            (path, (size, mtime)) for path, size, mtime in db.execute(
+                f"SELECT path, size, mtime FROM files WHERE path IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+        )
+    todo = []
+    for path in paths:
+        stat = os.stat(path)
+        if indexed.get(path) != (stat.st_size, stat.st_mtime):
+            todo.append(path)
+
+    chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+    columns = ['path', 'size', 'mtime', 'is_dicom'] + list(HEADER_FIELDS)
+
+    def insert(results):
+        for rows in results:
+            db.executemany(
+                f"INSERT OR REPLACE INTO files ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))})",
+                [[row.get(column) for column in columns] for row in rows]
+            )
+            db.commit()
+
+    if n_jobs == 1:
+        insert(map(_read_headers, chunks))
+    else:
+        with ProcessPoolExecutor(n_jobs) as pool:
+            insert(pool.map(_read_headers, chunks))
+    return len(todo)
+
+def list_files(dicom_dir):
+    return sorted(
+        os.path.join(root, name)
+        for root, _, files in os.walk(os.path.abspath(dicom_dir))
+        for name in files
+    )
+
+def build_index(dicom_dir, db_path, n_jobs=1):
+    """Index all files in dicom_dir, and remove the files that no longer exist"""
+    paths = list_files(dicom_dir)
+    with connect(db_path) as db:
+        n_read = update_index(db, paths, n_jobs)
+        prefix = os.path.join(os.path.abspath(dicom_dir), '')
+        existing = set(paths)
+        removed = [
+            (path,) for (path,) in db.execute(
+                "SELECT path FROM files WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)
+            )
+            if path not in existing
+        ]
+        db.executemany("DELETE FROM files WHERE path = ?", removed)
+    db.close()
+    print(f"Indexed {len(paths)} files in {dicom_dir}: {n_read} headers read, "
+          f"{len(paths) - n_read} unchanged, {len(removed)} removed")
+
+# ------------------------------------------------------------
+# Build the heudiconv seqinfo from the index
+# ------------------------------------------------------------
+
+def _image_shape(header):
+    """Image dimensions of one file, as nibabel's DICOM wrappers used by heudiconv"""
+    rows, columns = header['rows'] or 0, header['columns'] or 0
+    if header['mosaic_images'] and 'MOSAIC' in (header['image_type'] or ''):
+        # Siemens mosaic: the slices are tiled in one image
+        n_slices = int(header['mosaic_images'])
+        tiles = math.ceil(math.sqrt(n_slices))
+        return [rows // tiles, columns // tiles, n_slices]
+    if header['n_frames'] and int(header['n_frames']) > 1:
+        return [rows, columns, int(header['n_frames'])]
+    return [rows, columns]
+
+def seqinfos_from_index(files, db_path, seqinfo_cls, n_jobs=1, by_study=False, dcmfilter=None):
+    """
+    Group files into series and describe them, as heudiconv does, from the index.
+
+    Files that are not in the index (or changed since) are indexed first.
+
+    Parameters
+    ----------
+    files : list of str
+        DICOM files of one subject.
+    db_path : str
+        Index database.
+    seqinfo_cls : type
+        heudiconv's SeqInfo named tuple.
+    by_study : bool
+        Group the series by StudyInstanceUID, as heudiconv does for --files.
+    dcmfilter : callable or None
+        heudiconv's DICOM filter (filter_dicom of the heuristic): files for
+        which dcmfilter(dataset) is true are ignored. The index does not hold
+        the whole header, so with a filter the header of every file is read
+        again (without the pixel data).
+
+    Returns
+    -------
+    seqinfo : dict
+        SeqInfo -> list of the files of the series, ordered by series number
+        (or StudyInstanceUID -> such a dict, with by_study).
+    """
+    paths = [os.path.abspath(path) for path in files]
+    db = connect(db_path)
+    db.row_factory = sqlite3.Row
+    update_index(db, paths, n_jobs)
+
+    series = {}
+    for i in range(0, len(paths), 500):
+        chunk = paths[i:i + 500]
+        for row in db.execute(
+            f"SELECT * FROM files WHERE is_dicom = 1 AND path IN ({','.join('?' * len(chunk))})",
+            chunk
+        ):
+            key = (int(row['series_number']), row['protocol_name'] or '')
+            series.setdefault(key, []).append(dict(row))
+    db.close()
+
+    if dcmfilter is not None:
+        import pydicom
+
+        for key, headers in list(series.items()):
+            headers = [
+                h for h in headers
+                if not dcmfilter(pydicom.dcmread(h['path'], stop_before_pixels=True, force=True))
+            ]
+            if headers:
+                series[key] = headers
+            else:
+                del series[key]
+
+    seqinfo, studies = {}, {}
+    total_files = 0
+    for (series_number, protocol_name), headers in sorted(series.items()):
+        headers.sort(key=lambda header: header['path'])
+        header = headers[0]
+        series_files = [h['path'] for h in headers]
+        size = _image_shape(header) + [len(series_files)]
+        if len(size) < 4:
+            size.append(1)
+        total_files += len(series_files)
+        image_type = tuple((header['image_type'] or '').split('\\')) if header['image_type'] else ()
+        fields = {
+            'total_files_till_now': total_files,
+            'example_dcm_file': os.path.basename(series_files[0]),
+            'series_id': f'{series_number}-{protocol_name}',
+            'dcm_dir_name': os.path.basename(os.path.dirname(series_files[0])),
+            'series_files': len(series_files),
+            'unspecified': '',
+            'dim1': size[0],
+            'dim2': size[1],
+            'dim3': size[2],
+            'dim4': size[3],
+            'TR': (header['repetition_time'] if header['repetition_time'] is not None else -1000) / 1000,
+            'TE': header['echo_time'] if header['echo_time'] is not None else -1,
+            'protocol_name': protocol_name,
+            'is_motion_corrected': 'MOCO' in image_type,
+            'is_derived': 'derived' in [x.lower() for x in image_type],
+            'patient_id': header['patient_id'],
+            'study_description': header['study_description'],
+            'referring_physician_name': header['referring_physician_name'] or '',
+            'series_description': header['series_description'] or '',
+            'sequence_name': (header['sequence_name'] or header['siemens_sequence_name']
+                              or header['xa_sequence_name'] or ''),
+            'image_type': image_type,
+            'accession_number': header['accession_number'],
+            'patient_age': header['patient_age'],
+            'patient_sex': header['patient_sex'],
+            'date': header['acquisition_date'],
+            'series_uid': header['series_uid'],
+            'time': header['acquisition_time'],
+            'custom': None,
+        }
+        info = seqinfo_cls(**{field: fields.get(field) for field in seqinfo_cls._fields})
+        seqinfo[info] = series_files
+        studies.setdefault(header['study_uid'], {})[info] = series_files
+    return studies if by_study else seqinfo
+
+# ------------------------------------------------------------
+# Command line
+# ------------------------------------------------------------
+
+def preview(dicom_dir, db_path, heuristic_file, n_jobs=1):
+    """Print the conversion key the heuristic assigns to each series"""
+    from collections import namedtuple
+
+    spec = importlib.util.spec_from_file_location('heuristic', heuristic_file)
+    heuristic = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(heuristic)
+
+    try:
+        from heudiconv.utils import SeqInfo
+    except ImportError:
+        SeqInfo = namedtuple('SeqInfo', [
+            'total_files_till_now', 'example_dcm_file', 'series_id', 'dcm_dir_name',
+            'series_files', 'unspecified', 'dim1', 'dim2', 'dim3', 'dim4', 'TR', 'TE',
+            'protocol_name', 'is_motion_corrected', 'is_derived', 'patient_id',
+            'study_description', 'referring_physician_name', 'series_description',
+            'sequence_name', 'image_type', 'accession_number', 'patient_age',
+            'patient_sex', 'date', 'series_uid', 'time', 'custom'
+        ])
+    seqinfo = seqinfos_from_index(list_files(dicom_dir), db_path, SeqInfo, n_jobs)
+    info = heuristic.infotodict(list(seqinfo))
+    keys = {series_id: key[0] for key, series_ids in info.items() for series_id in series_ids}
+    for s in seqinfo:
+        print(f"{s.series_id:40s} files={s.series_files:<5d} "
+              f"dims={s.dim1}x{s.dim2}x{s.dim3}x{s.dim4:<6d} -> {keys.get(s.series_id, '(not converted)')}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Index DICOM headers for the BIDS conversion')
+    parser.add_argument('command', choices=['build', 'preview'])
+    parser.add_argument('dicom_dir', help='folder with the DICOM files')
+    parser.add_argument('--db', required=True, help='index database')
+    parser.add_argument('--heuristic', default='bids_heuristic.py',
+                        help='heuristic file (preview)')
+    parser.add_argument('--n-jobs', type=int, default=1,
+                        help='number of processes reading headers')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build_index(args.dicom_dir, args.db, args.n_jobs)
+    else:
+        preview(args.dicom_dir, args.db, args.heuristic, args.n_jobs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ======================================================================
+# Compute new contrasts of a saved first-level GLM
+#
+# first_level_script.py saves the fitted GLM of every subject in
+# <output>/first-level/sub-<ID>/sub-<ID>_glm/ (per-run design matrices, betas,
+# residual variance and AR(1) labels, as float32 .npy files that are
+# memory-mapped when loaded). This script loads that state and evaluates any
+# number of new t- or F-contrasts as matrix products, without reading the
+# BOLD images or refitting the model.
+#
+# Example usage:
+#   python first_level_contrasts.py /path/to/output/first-level/sub-01 contrasts.json
+#
+# contrasts.json defines the contrasts in the same way as contrast_definitions
+# in first_level_script.py (t-contrasts), plus F-contrasts given by a list of
+# conditions:
+#   {
+#       "Faces": {"positive_patterns": ["FF", "UF"]},
+#       "Famous_Unfamiliar": {"positive_patterns": ["FF"], "negative_patterns": ["UF"]},
+#       "AllFaces": {"conditions": ["DelFF", "ImmFF", "IniFF"]}
+#   }
+#
+# ======================================================================
+
+# ======================================================================
+# IMPORT REQUIRED PACKAGES
+# ======================================================================
+import os
+import json
+import argparse
+import gzip
+import warnings
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from nilearn.glm.contrasts import Contrast
+from nilearn.maskers import NiftiMasker
+
+# ======================================================================
+# SAVE AND LOAD THE FITTED GLM
+# ======================================================================
+
+def glm_state(fmri_glm, output_prefix):
+    """
+    What is needed to compute contrasts of a fitted FirstLevelModel.
+
+    For every run: the betas (n_regressors, n_voxels), the residual variance
+    (n_voxels,), the AR(1) label of every voxel, and the (unscaled) covariance
+    of the betas of every label. Voxels are in the order of the model's mask.
+
+    Parameters
+    ----------
+    fmri_glm : nilearn.glm.first_level.FirstLevelModel
+        Fitted model.
+    output_prefix : str
+        Prefix of the contrast map file names (e.g. sub-01_ses-mri_task-x_).
+
+    Returns
+    -------
+    state : dict
+        Same as load_glm_state.
+    """
+    runs = []
+    for labels, results, design_matrix in zip(
+        fmri_glm.labels_, fmri_glm.results_, fmri_glm.design_matrices_
+    ):
+        label_names = list(results.keys())
+        n_regressors = design_matrix.shape[1]
+        theta = np.zeros((n_regressors, labels.size))
+        dispersion = np.zeros(labels.size)
+        label_index = np.zeros(labels.size, dtype=np.int32)
+        cov = np.zeros((len(label_names), n_regressors, n_regressors))
+        for i, label in enumerate(label_names):
+            label_mask = labels == label
+            theta[:, label_mask] = results[label].theta
+            dispersion[label_mask] = results[label].dispersion
+            label_index[label_mask] = i
+            cov[i] = results[label].cov
+        runs.append({
+            "theta": theta,
+            "dispersion": dispersion,
+            "labels": label_index,
+            "cov": cov,
+            "label_names": [str(label) for label in label_names],
+            "df_residuals": float(results[label_names[0]].df_residuals),
+        })
+
+    masker = NiftiMasker(mask_img=fmri_glm.masker_.mask_img_).fit()
+    return {
+        "output_prefix": output_prefix,
+        "masker": masker,
+        "design_matrices": list(fmri_glm.design_matrices_),
+        "runs": runs,
+    }
+
+def save_glm_state(state, state_dir):
+    """
+    Save a GLM state (see glm_state) to a directory.
+
+    The design matrices, betas and residual variances are saved as float32,
+    the AR(1) labels as int32 .npy files (one set per run), and the mask as
+    mask.nii.gz.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    state["masker"].mask_img_.to_filename(os.path.join(state_dir, "mask.nii.gz"))
+
+    runs = []
+    for run, (run_state, design_matrix) in enumerate(
+        zip(state["runs"], state["design_matrices"])
+    ):
+        prefix = os.path.join(state_dir, f"run-{run + 1:02d}_")
+        np.save(prefix + "design.npy", design_matrix.to_numpy(dtype=np.float32))
+        np.save(prefix + "theta.npy", run_state["theta"].astype(np.float32))
+        np.save(prefix + "dispersion.npy", run_state["dispersion"].astype(np.float32))
+        np.save(prefix + "labels.npy", run_state["labels"].astype(np.int32))
+        np.save(prefix + "cov.npy", run_state["cov"])
+        runs.append({
+            "columns": design_matrix.columns.tolist(),
+            "frame_times": design_matrix.index.tolist(),
+            "labels": run_state["label_names"],
+            "df_residuals": run_state["df_residuals"],
+        })
+
+    with open(os.path.join(state_dir, "glm.json"), "w") as f:
+        json.dump({"output_prefix": state["output_prefix"], "runs": runs}, f, indent=4)
+
+def load_glm_state(state_dir):
+    """
+    Load a GLM saved by save_glm_state.
+
+    The arrays are memory-mapped, so only the parts used by a contrast are
+    read from disk.
+
+    Returns
+    -------
+    state : dict
+        'output_prefix', 'masker' (fitted NiftiMasker), 'design_matrices'
+        (list of pandas.DataFrame) and 'runs' (list of dicts of arrays).
+    """
+    with open(os.path.join(state_dir, "glm.json")) as f:
+        info = json.load(f)
+
+    runs = []
+    design_matrices = []
+    for run, run_info in enumerate(info["runs"]):
+        prefix = os.path.join(state_dir, f"run-{run + 1:02d}_")
+        design_matrices.append(pd.DataFrame(
+            np.load(prefix + "design.npy"),
+            columns=run_info["columns"],
+            index=run_info["frame_times"],
+        ))
+        runs.append({
+            "theta": np.load(prefix + "theta.npy", mmap_mode="r"),
+            "dispersion": np.load(prefix + "dispersion.npy", mmap_mode="r"),
+            "labels": np.load(prefix + "labels.npy", mmap_mode="r"),
+            "cov": np.load(prefix + "cov.npy"),
+            "label_names": run_info["labels"],
+            "df_residuals": run_info["df_residuals"],
+        })
+
+    masker = NiftiMasker(mask_img=os.path.join(state_dir, "mask.nii.gz")).fit()
+    return {
+        "output_prefix": info["output_prefix"],
+        "masker": masker,
+        "design_matrices": design_matrices,
+        "runs": runs,
+    }
+
+# ======================================================================
+# COMPUTE CONTRASTS
+# ======================================================================
+
+def _run_contrast(run, con_val, stat_type):
+    """Contrast of one run, vectorized over voxels (as nilearn's compute_contrast)."""
+    theta = np.asarray(run["theta"], dtype=np.float64)
+    dispersion = np.asarray(run["dispersion"], dtype=np.float64)
+    labels = np.asarray(run["labels"])
+    con_val = np.atleast_2d(con_val)
+
+    # Contrast of the betas of all voxels: (n_rows, n_voxels)
+    effect = con_val @ theta
+    # Covariance of the contrast for every AR(1) label: (n_labels, n_rows, n_rows)
+    con_cov = con_val @ run["cov"] @ con_val.T
+
+    if stat_type == "t":
+        effect = effect[0]
+        variance = con_cov[labels, 0, 0] * dispersion
+    else:
+        # Whiten the contrast with the inverse square root of its covariance
+        eigval, eigvec = np.linalg.eigh(np.linalg.inv(con_cov))
+        inv_sqrt = (eigvec * np.sqrt(eigval)[:, None, :]) @ eigvec.swapaxes(1, 2)
+        effect = np.einsum("vij,jv->iv", inv_sqrt[labels], effect)
+        variance = dispersion
+
+    return Contrast(
+        effect=effect,
+        variance=variance,
+        dim=con_val.shape[0],
+        dof=run["df_residuals"],
+        stat_type=stat_type,
+    )
+
+def compute_contrast_from_state(state, con_vals, stat_type=None, output_type="z_score"):
+    """
+    Fixed-effects contrast over runs of a GLM state.
+
+    Parameters
+    ----------
+    state : dict
+        Output of glm_state or load_glm_state.
+    con_vals : list of numpy.ndarray
+        Contrast vector (t) or matrix (F) of every run.
+    stat_type : {None, 't', 'F'}
+        Defaults to 't' for vectors and 'F' for matrices.
+    output_type : str
+        'z_score', 'stat', 'p_value', 'effect_size' or 'effect_variance'.
+
+    Returns
+    -------
+    stats_map : nibabel.Nifti1Image
+        Contrast map.
+    """
+    if stat_type is None:
+        stat_type = "t" if np.ndim(con_vals[0]) == 1 else "F"
+
+    contrast = None
+    n_contrasts = 0
+    for i, (run, con_val) in enumerate(zip(state["runs"], con_vals)):
+        if np.all(con_val == 0):
+            warnings.warn(f"Contrast for run {i} is null.")
+            continue
+        run_contrast = _run_contrast(run, con_val, stat_type)
+        contrast = run_contrast if contrast is None else contrast + run_contrast
+        n_contrasts += 1
+    if contrast is None:
+        raise ValueError("All contrasts provided were null contrasts.")
+    contrast = contrast * (1.0 / n_contrasts)
+
+    estimate = getattr(contrast, output_type)()
+    return state["masker"].inverse_transform(estimate)
+
+def iter_contrast_maps(state, contrasts, output_types):
+    """
+    Compute many contrasts of a GLM state.
+
+    All t-contrasts are computed at once: for every run, the contrast vectors
+    are stacked into a (n_contrasts, n_regressors) matrix that is applied to
+    the betas of all voxels in one product. F-contrasts are computed one by
+    one with compute_contrast_from_state.
+
+    Parameters
+    ----------
+    state : dict
+        Output of glm_state or load_glm_state.
+    contrasts : dict
+        Contrast id -> list with the contrast vector (t) or matrix (F) of
+        every run (see create_contrasts in first_level_script.py).
+    output_types : dict
+        Contrast id -> output type (see compute_contrast_from_state).
+
+    Yields
+    ------
+    contrast_id, stats_map : str, nibabel.Nifti1Image
+        Contrast maps, in the order they are computed.
+    """
+    t_ids = [cid for cid, con_vals in contrasts.items() if np.ndim(con_vals[0]) == 1]
+    f_ids = [cid for cid in contrasts if cid not in t_ids]
+
+    if t_ids:
+        n_voxels = state["runs"][0]["labels"].shape[0]
+        effect = np.zeros((len(t_ids), n_voxels))
+        variance = np.zeros((len(t_ids), n_voxels))
+        dof = np.zeros(len(t_ids))
+        n_runs = np.zeros(len(t_ids))
+        for i, run in enumerate(state["runs"]):
+            con_vals = np.vstack([contrasts[cid][i] for cid in t_ids])
+            # Null contrasts of a run are left out of the fixed effects
+            used = np.any(con_vals != 0, axis=1)
+            for cid in np.asarray(t_ids)[~used]:
+                warnings.warn(f"Contrast {cid} for run {i} is null.")
+            labels = np.asarray(run["labels"])
+            con_var = np.einsum("ci,lij,cj->cl", con_vals, run["cov"], con_vals)
+            effect[used] += con_vals[used] @ np.asarray(run["theta"], dtype=np.float64)
+            variance[used] += (
+                con_var[used][:, labels] * np.asarray(run["dispersion"], dtype=np.float64)
+            )
+            dof[used] += run["df_residuals"]
+            n_runs[used] += 1
+
+        for k, cid in enumerate(t_ids):
+            if n_runs[k] == 0:
+                raise ValueError(f"All contrasts provided for {cid} were null contrasts.")
+            contrast = Contrast(
+                effect=effect[k] / n_runs[k],
+                variance=variance[k] / n_runs[k] ** 2,
+                dim=1,
+                dof=dof[k],
+                stat_type="t",
+            )
+            estimate = getattr(contrast, output_types[cid])()
+            yield cid, state["masker"].inverse_transform(estimate)
+
+    for cid in f_ids:
+        yield cid, compute_contrast_from_state(
+            state, contrasts[cid], output_type=output_types[cid]
+        )
+
+# ======================================================================
+# SAVE CONTRAST MAPS
+# ======================================================================
+
+def contrast_filename(output_dir, output_prefix, contrast_id, output_type, compresslevel=1):
+    """
+    BIDS file name of a contrast map.
+
+    The extension is .nii for compresslevel 0 and .nii.gz otherwise.
+    """
+    # from stats get only the part before _ for the BIDS file name
+    stats_suffix = output_type.split("_")[0]
+    # in contrast_id remove underscores
+    contrast_label = contrast_id.replace("_", "")
+    extension = ".nii.gz" if compresslevel else ".nii"
+    return os.path.join(
+        output_dir,
+        output_prefix + 'desc-' + contrast_label + '_' + stats_suffix + extension
+    )
+
+def save_image(img, filename, compresslevel=1):
+    """Save a NIfTI image, gzipped with the given compression level (0 to 9)."""
+    if filename.endswith(".gz"):
+        with gzip.GzipFile(filename, "wb", compresslevel=compresslevel, mtime=0) as f:
+            f.write(img.to_bytes())
+    else:
+        img.to_filename(filename)
+
+def write_contrast_maps(state, contrasts, output_types, filenames, compresslevel=1, n_threads=4):
+    """
+    Compute contrasts of a GLM state and save the maps.
+
+    The maps are computed in the calling thread (see iter_contrast_maps) and
+    saved by a pool of n_threads threads, so that the compression of one map
+    overlaps with the computation and compression of the others.
+
+    Parameters
+    ----------
+    filenames : dict
+        Contrast id -> output file name (see contrast_filename).
+    compresslevel : int
+        gzip compression level of .nii.gz files (1 is fastest).
+    """
+    with ThreadPoolExecutor(n_threads) as pool:
+        futures = [
+            pool.submit(save_image, stats_map, filenames[contrast_id], compresslevel)
+            for contrast_id, stats_map in iter_contrast_maps(state, contrasts, output_types)
+        ]
+        for future in futures:
+            future.result()
+
+# ======================================================================
+# MAIN
+# ======================================================================
+
+def main():
+    from first_level_script import create_contrasts
+
+    parser = argparse.ArgumentParser(description="Compute new contrasts of a saved first-level GLM")
+    parser.add_argument("subject_dir", help="first-level output directory of the subject")
+    parser.add_argument("contrasts", help="JSON file with the contrast definitions")
+    parser.add_argument("--output-type", default=None,
+                        help="output type of all contrasts (default: effect_size "
+                             "for t-contrasts and z_score for F-contrasts)")
+    parser.add_argument("--compress-level", type=int, default=1,
+                        help="gzip level of the maps, 0 for uncompressed .nii")
+    parser.add_argument("--n-threads", type=int, default=4,
+                        help="number of threads writing the maps")
+    args = parser.parse_args()
+
+    subject = os.path.basename(os.path.normpath(args.subject_dir))
+    state = load_glm_state(os.path.join(args.subject_dir, subject + "_glm"))
+    with open(args.contrasts) as f:
+        definitions = json.load(f)
+
+    contrasts = create_contrasts(state["design_matrices"], definitions)
+    output_types = {
+        contrast_id: args.output_type or (
+            "z_score" if "conditions" in parameters else "effect_size"
+        )
+        for contrast_id, parameters in definitions.items()
+    }
+    filenames = {
+        contrast_id: contrast_filename(
+            args.subject_dir, state["output_prefix"], contrast_id,
+            output_types[contrast_id], args.compress_level
+        )
+        for contrast_id in definitions
+    }
+    print("Computing contrasts: " + ", ".join(definitions))
+    write_contrast_maps(state, contrasts, output_types, filenames,
+                        compresslevel=args.compress_level, n_threads=args.n_threads)
+
+
+if __name__ == "__main__":
+    main()
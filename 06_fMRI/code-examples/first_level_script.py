@@ -3,12 +3,46 @@
 # ======================================================================
 # Dace Apšvalka (MRC CBU 2026)
 # Subject-level fMRI analysis using Nilearn
-# 
+#
 # Example usage:
 #   python first_level_script.py /path/to/bids/dataset sub-01 /path/to/output
-# 
+#
 # Or use step07_first_level_analysis.sh for batch processing of multiple subjects using SLURM.
 #
+# Batch mode: several subjects (comma-separated, or 'all') can be analysed
+# from one process, optionally with a pool of worker processes:
+#   python first_level_script.py /path/to/bids/dataset sub-01,sub-02 /path/to/output --n-jobs 2
+#   python first_level_script.py /path/to/bids/dataset all /path/to/output --n-jobs 8
+#
+# The BIDS dataset (including the fMRIPrep derivatives) is indexed only once
+# and the index is saved to an SQLite database (--database, by default
+# scratch/pybids_db in the dataset location). Later runs, and the workers,
+# load the index from the database instead of re-indexing the dataset.
+# To only build the index (e.g. before submitting SLURM jobs):
+#   python first_level_script.py /path/to/bids/dataset --index-only
+# Use --reset-database to re-index after the dataset has changed.
+#
+# The fMRIPrep confound files are read through a cache of binary copies
+# (--confounds-cache, by default scratch/confounds_cache in the dataset
+# location; see confound_cache.py).
+#
+# Incremental runs: a manifest (first-level/manifest.json, next to
+# dataset_description.json) records the hashes of each subject's inputs
+# (BOLD, events, confounds, mask), the model parameters and the contrast
+# definitions. Subjects whose inputs and model are unchanged are skipped, and
+# if only the contrast definitions changed, the saved GLM is reloaded and only
+# the new or changed contrasts are computed. Use --force to refit anyway.
+#
+# The fitted GLM is saved in sub-<ID>/sub-<ID>_glm/ (float32 betas, residual
+# variance and AR(1) labels, see first_level_contrasts.py, which must be in the
+# same folder as this script). New contrasts can be computed from it without
+# the BOLD images:
+#   python first_level_contrasts.py /path/to/output/first-level/sub-01 contrasts.json
+#
+# The contrast maps are written by a pool of threads (--n-threads) with gzip
+# level --compress-level (1, the fastest, by default; 0 writes uncompressed
+# .nii files).
+#
 # ======================================================================
 
 # ======================================================================
@@ -16,38 +50,33 @@
 # ======================================================================
 import os
 import sys
+import json
+import hashlib
+import functools
+import argparse
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from filelock import FileLock
 from bids.layout import BIDSLayout
-from nilearn.interfaces.fmriprep import load_confounds
 from nilearn.glm.first_level import FirstLevelModel
+from first_level_contrasts import (
+    glm_state,
+    save_glm_state,
+    load_glm_state,
+    contrast_filename,
+    write_contrast_maps,
+)
+from confound_cache import load_confounds_cached
 import time
 import warnings
 warnings.filterwarnings("ignore")
 
-# ======================================================================
-# DEFINE PATHS
-# arguments passed from step06_first_level_analysis.sh
-# ======================================================================
-
-ds = sys.argv[1] # dataset location
-sID = sys.argv[2].split("sub-")[1] # subject id
-output = sys.argv[3]
-
-# ======================================================================
-print("Running first-level analysis for subject " + sID)
-start_time = time.time()
-print("Started at: " + time.strftime("%H:%M:%S", time.localtime()))
-
 # ======================================================================
 # DEFINE PARAMETERS
 # =====================================================================
 model_name = 'first-level'
 
-bids_path = os.path.join(ds, 'data')
-
-outdir = os.path.join(output, model_name, 'sub-' + sID)
-
 # t-contrast definitions for the first-level model
 contrast_definitions = {
     "Faces_Scrambled": {
@@ -81,7 +110,7 @@ contrast_definitions = {
     "IniUF": {
         "positive_patterns": ["IniUF"],
     },
-    
+
 }
 
 # Conditions for the effects of interest F-contrast
@@ -91,120 +120,148 @@ conditions_of_interest = [
     "IniFF", "IniSF", "IniUF",
 ]
 
-# ======================================================================
-if not os.path.exists(outdir):
-    os.makedirs(outdir)
-
-print("BIDS data location: " + bids_path)
-print("Output directory: " + outdir)
+# Confounds to include in the GLM (passed to nilearn's load_confounds)
+confound_parameters = {
+    "strategy": ("motion",), # can be multiple strategies
+    "motion": "basic",
+}
 
 # ======================================================================
-# PERFORM SUBJECT LEVEL GLM ANALYSIS
+# CONTRAST HELPER FUNCTIONS
+# Contrasts are defined by patterns of design-matrix column names. The
+# definitions are compiled once per design-matrix schema (the list of column
+# names): all patterns are matched against all columns at once, and the
+# resulting contrast vectors and matrices are cached and reused for all runs
+# with the same columns.
 # ======================================================================
 
-# --- Initialize the BIDS layout and include the derivatives in it
-# layout = BIDSLayout(bids_path, derivatives=True)
-layout = BIDSLayout(bids_path, derivatives=False)
-layout.add_derivatives(os.path.join(ds, 'data', 'derivatives', 'fmriprep'))
-
-# --- Get the preprocessed functional files
-bold = layout.get(
-    subject=sID, 
-    datatype='func', 
-    space='MNI152NLin6Asym', 
-    res='9',
-    desc='preproc', 
-    extension='.nii.gz',
-    return_type='filename'
-    )
-print("Found " + str(len(bold)) + " preprocessed functional files")
-print("Preprocessed functional files:")
-print(*bold, sep="\n")
-
-# --- Get the event files
-events = layout.get(
-    subject=sID, 
-    datatype='func', 
-    suffix='events', 
-    extension=".tsv", 
-    return_type='filename'
-    )
-print("Found " + str(len(events)) + " event files")
-
-# --- Get the brain mask
-brain_mask = layout.get(
-    subject=sID, 
-    datatype='anat', 
-    suffix='mask', 
-    desc='brain', 
-    space='MNI152NLin6Asym', 
-    res='9',
-    extension='.nii.gz',
-    return_type='filename'
-    )
-
-print("Found " + str(len(brain_mask)) + " brain mask files")
+def match_patterns(column_names, patterns):
+    """
+    Match patterns against column names.
 
-# Check if any of the required data is missing
-if len(bold) == 0 or len(events) == 0 or len(brain_mask) == 0:
-    print("ERROR: Missing required data (BOLD, events, or brain mask) for subject " + sID)
-    print("BOLD files: " + str(len(bold)))
-    print("Event files: " + str(len(events)))
-    print("Brain mask files: " + str(len(brain_mask)))
-    sys.exit(1)
+    Returns
+    -------
+    matches : numpy.ndarray
+        Boolean matrix of shape (n_patterns, n_columns); True where the
+        pattern is a substring of the column name.
+    """
+    column_names = np.asarray(column_names, dtype=str)
+    patterns = np.asarray(patterns, dtype=str).reshape(-1, 1)
+    return np.char.find(column_names[None, :], patterns) >= 0
 
+@functools.lru_cache(maxsize=128)
+def _compile_contrasts(column_names, definitions):
+    """
+    Contrast vectors/matrices of all definitions for one design-matrix schema.
 
-# --- Define which confounds to include in the GLM
-confounds_for_glm, sample_masks = load_confounds(
-    bold, # list of fMRIPrep-preprocessed BOLD files
-    strategy=("motion",), # can be multiple strategies
-    motion="basic"
-)
-# Prepare sample masks for FirstLevelModel.fit()
-if all(mask is None for mask in sample_masks):
-    sample_masks_for_glm = None
-else:
-    sample_masks_for_glm = [
-        np.arange(len(confounds), dtype=int)
-        if mask is None
-        else mask
-        for confounds, mask in zip(confounds_for_glm, sample_masks)
-    ]
+    Parameters
+    ----------
+    column_names : tuple of str
+        Design-matrix columns.
+    definitions : str
+        JSON of the contrast definitions (see create_contrasts), so that the
+        arguments can be cached.
+    """
+    definitions = json.loads(definitions)
+    pattern_keys = ["include_patterns", "exclude_patterns",
+                    "positive_patterns", "negative_patterns"]
+    patterns = sorted({
+        pattern
+        for parameters in definitions.values()
+        for key in pattern_keys
+        for pattern in parameters.get(key) or []
+    })
+    pattern_index = {pattern: i for i, pattern in enumerate(patterns)}
+    matches = match_patterns(column_names, patterns)
+
+    def any_match(patterns, default):
+        if not patterns:
+            return np.full(len(column_names), default)
+        return matches[[pattern_index[p] for p in patterns]].any(axis=0)
+
+    contrasts = {}
+    for contrast_id, parameters in definitions.items():
+        if "conditions" in parameters:
+            # F-contrast: one row per condition
+            conditions = np.asarray(parameters["conditions"], dtype=str)
+            rows = conditions[:, None] == np.asarray(column_names, dtype=str)[None, :]
+            missing_conditions = conditions[~rows.any(axis=1)].tolist()
+            if missing_conditions:
+                raise ValueError(
+                    "Conditions missing from the design matrix: "
+                    f"{missing_conditions}"
+                )
+            contrast = rows.astype(float)
+        else:
+            # t-contrast: mean(positive conditions) - mean(negative conditions)
+            selected = (
+                any_match(parameters.get("include_patterns"), True)
+                & ~any_match(parameters.get("exclude_patterns"), False)
+            )
+            positive_cols = any_match(parameters.get("positive_patterns"), False) & selected
+            negative_cols = any_match(parameters.get("negative_patterns"), False) & selected
+
+            if np.any(positive_cols & negative_cols):
+                overlapping_names = [
+                    column_names[index]
+                    for index in np.flatnonzero(positive_cols & negative_cols)
+                ]
+                raise ValueError(
+                    "Some columns match both the positive and negative patterns: "
+                    f"{overlapping_names}"
+                )
+
+            if parameters.get("positive_patterns") and not positive_cols.any():
+                raise ValueError(
+                    "No design-matrix columns matched the positive patterns."
+                )
+
+            if parameters.get("negative_patterns") and not negative_cols.any():
+                raise ValueError(
+                    "No design-matrix columns matched the negative patterns."
+                )
+
+            contrast = np.zeros(len(column_names), dtype=float)
+            if positive_cols.any():
+                contrast[positive_cols] = 1 / positive_cols.sum()
+            if negative_cols.any():
+                contrast[negative_cols] = -1 / negative_cols.sum()
+
+        # The same arrays are returned for every run with these columns
+        contrast.setflags(write=False)
+        contrasts[contrast_id] = contrast
+    return contrasts
+
+def create_contrasts(design_matrices, definitions):
+    """
+    Create all contrasts for all runs in one call.
 
-# --- Get the TR value
-TR = layout.get_tr()
-
-# --- If slice timing correction was applied, get the slice time reference
-slice_timing = layout.get_metadata(bold[0])
-if slice_timing['SliceTimingCorrected']:
-  slice_time_ref = slice_timing['StartTime'] / TR
-else:
-  slice_time_ref = 0
-
-# --- Define the GLM model
-fmri_glm = FirstLevelModel(
-    t_r = TR,
-    slice_time_ref = slice_time_ref, 
-    hrf_model = 'SPM',
-    drift_model = 'cosine',
-    high_pass = 0.01,
-    noise_model = 'ar1',
-    smoothing_fwhm = 6, 
-    mask_img = brain_mask[0]
-    )
+    Parameters
+    ----------
+    design_matrices : list of pandas.DataFrame
+        Design matrix of each run.
 
-# --- Fit the model
-fmri_glm = fmri_glm.fit(
-    bold, 
-    events=events, 
-    confounds=confounds_for_glm,
-    sample_masks=sample_masks_for_glm
-    )
+    definitions : dict
+        Contrast id -> parameters. t-contrasts are defined by the pattern
+        arguments of create_contrast_vector, F-contrasts by a list of
+        conditions: {"conditions": [...]} (see create_effects_of_interest_matrix).
 
-# --- Get the design matrices
-design_matrices = fmri_glm.design_matrices_
+    Returns
+    -------
+    contrasts : dict
+        Contrast id -> list with the contrast vector (t) or matrix (F) of
+        each run, as expected by FirstLevelModel.compute_contrast.
+    """
+    definitions = json.dumps(definitions)
+    compiled = [
+        _compile_contrasts(tuple(design_matrix.columns), definitions)
+        for design_matrix in design_matrices
+    ]
+    return {
+        contrast_id: [run_contrasts[contrast_id] for run_contrasts in compiled]
+        for contrast_id in compiled[0]
+    }
 
-# --- Create contrasts 
 # t-contrast helper function
 def create_contrast_vector(
     design_matrix,
@@ -245,176 +302,482 @@ def create_contrast_vector(
     contrast_vector : numpy.ndarray
         Contrast vector with one value per design-matrix column.
     """
-    column_names = design_matrix.columns
-    contrast_vector = np.zeros(len(column_names), dtype=float)
-
-    def find_matching_columns(patterns):
-        if not patterns:
-            return []
+    parameters = {
+        "include_patterns": include_patterns,
+        "exclude_patterns": exclude_patterns,
+        "positive_patterns": positive_patterns,
+        "negative_patterns": negative_patterns,
+    }
+    return create_contrasts([design_matrix], {"contrast": parameters})["contrast"][0].copy()
 
-        matches = []
+# F-contrast helper function
+def create_effects_of_interest_matrix(
+    design_matrix,
+    conditions_of_interest,
+):
+    """Create an F-contrast testing all conditions of interest."""
+    definition = {"conditions": list(conditions_of_interest)}
+    return create_contrasts([design_matrix], {"contrast": definition})["contrast"][0].copy()
 
-        for index, column_name in enumerate(column_names):
-            if not any(pattern in column_name for pattern in patterns):
-                continue
+# ======================================================================
+# MANIFEST HELPER FUNCTIONS
+# ======================================================================
 
-            if include_patterns and not any(
-                pattern in column_name for pattern in include_patterns
-            ):
-                continue
+def hash_object(obj):
+    """Hash of a JSON-serializable object (e.g. model parameters)."""
+    return hashlib.sha256(
+        json.dumps(obj, sort_keys=True, default=str).encode()
+    ).hexdigest()
 
-            if exclude_patterns and any(
-                pattern in column_name for pattern in exclude_patterns
-            ):
-                continue
+def hash_file(path, previous=None):
+    """
+    Hash of a file's content.
 
-            matches.append(index)
+    If the file's size and modification time are the same as in the previous
+    record, the previous hash is reused instead of reading the file again.
+    """
+    stat = os.stat(path)
+    if (previous and previous["size"] == stat.st_size
+            and previous["mtime"] == stat.st_mtime):
+        return previous
+
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha.hexdigest()}
+
+def read_manifest_entry(manifest_file, sID):
+    """The manifest entry of one subject (empty if there is none)."""
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f).get("sub-" + sID, {})
+
+def write_manifest_entry(manifest_file, sID, entry):
+    """Update the manifest entry of one subject.
+
+    The manifest is locked while it is updated, so that subjects analysed in
+    parallel (worker processes or SLURM jobs) do not overwrite each other.
+    """
+    with FileLock(manifest_file + ".lock"):
+        manifest = {}
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+        manifest["sub-" + sID] = entry
+        tmp_file = f"{manifest_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(tmp_file, manifest_file)
 
-        return matches
+# ======================================================================
+# BIDS LAYOUT
+# ======================================================================
 
-    positive_cols = find_matching_columns(positive_patterns)
-    negative_cols = find_matching_columns(negative_patterns)
+def load_layout(ds, database_path, reset_database=False):
+    """
+    Get the BIDS layout of the dataset, including the fMRIPrep derivatives.
 
-    overlapping_cols = set(positive_cols) & set(negative_cols)
-    if overlapping_cols:
-        overlapping_names = [
-            column_names[index] for index in sorted(overlapping_cols)
-        ]
-        raise ValueError(
-            "Some columns match both the positive and negative patterns: "
-            f"{overlapping_names}"
+    The first call indexes the dataset and saves the index to an SQLite
+    database in database_path; later calls load it from there, which takes
+    seconds instead of minutes on large datasets.
+    """
+    bids_path = os.path.join(ds, 'data')
+    fmriprep_path = os.path.join(ds, 'data', 'derivatives', 'fmriprep')
+    return BIDSLayout(
+        bids_path,
+        derivatives=fmriprep_path,
+        database_path=database_path,
+        reset_database=reset_database
         )
 
-    if positive_patterns and not positive_cols:
-        raise ValueError(
-            "No design-matrix columns matched the positive patterns."
-        )
+# ======================================================================
+# PERFORM SUBJECT LEVEL GLM ANALYSIS
+# ======================================================================
 
-    if negative_patterns and not negative_cols:
-        raise ValueError(
-            "No design-matrix columns matched the negative patterns."
+def run_first_level(
+    layout,
+    sID,
+    output,
+    force=False,
+    compresslevel=1,
+    n_threads=4,
+    confounds_cache=None
+):
+    """Fit the first-level GLM of one subject and save the contrast maps.
+
+    The subject is skipped if the manifest shows that its inputs, model and
+    contrasts are unchanged (unless force is True). The contrast maps are
+    written by n_threads threads, gzipped with compresslevel (0 for
+    uncompressed .nii files). The confounds are read through the cache in
+    confounds_cache (see confound_cache.py).
+    """
+
+    # ======================================================================
+    print("Running first-level analysis for subject " + sID)
+    start_time = time.time()
+    print("Started at: " + time.strftime("%H:%M:%S", time.localtime()))
+
+    outdir = os.path.join(output, model_name, 'sub-' + sID)
+
+    # ======================================================================
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    print("BIDS data location: " + str(layout.root))
+    print("Output directory: " + outdir)
+
+    # --- Get the preprocessed functional files
+    bold = layout.get(
+        subject=sID,
+        datatype='func',
+        space='MNI152NLin6Asym',
+        res='9',
+        desc='preproc',
+        extension='.nii.gz',
+        return_type='filename'
+        )
+    print("Found " + str(len(bold)) + " preprocessed functional files")
+    print("Preprocessed functional files:")
+    print(*bold, sep="\n")
+
+    # --- Get the event files
+    events = layout.get(
+        subject=sID,
+        datatype='func',
+        suffix='events',
+        extension=".tsv",
+        return_type='filename'
+        )
+    print("Found " + str(len(events)) + " event files")
+
+    # --- Get the brain mask
+    brain_mask = layout.get(
+        subject=sID,
+        datatype='anat',
+        suffix='mask',
+        desc='brain',
+        space='MNI152NLin6Asym',
+        res='9',
+        extension='.nii.gz',
+        return_type='filename'
         )
 
-    if positive_cols:
-        contrast_vector[positive_cols] = 1 / len(positive_cols)
+    print("Found " + str(len(brain_mask)) + " brain mask files")
 
-    if negative_cols:
-        contrast_vector[negative_cols] = -1 / len(negative_cols)
+    # --- Get the confound files
+    confound_files = layout.get(
+        subject=sID,
+        datatype='func',
+        desc='confounds',
+        suffix='timeseries',
+        extension='.tsv',
+        return_type='filename'
+        )
 
-    return contrast_vector
+    # Check if any of the required data is missing
+    if len(bold) == 0 or len(events) == 0 or len(brain_mask) == 0:
+        print("ERROR: Missing required data (BOLD, events, or brain mask) for subject " + sID)
+        print("BOLD files: " + str(len(bold)))
+        print("Event files: " + str(len(events)))
+        print("Brain mask files: " + str(len(brain_mask)))
+        return False
 
-# F-contrast helper function
-def create_effects_of_interest_matrix(
-    design_matrix,
-    conditions_of_interest,
-):
-    """Create an F-contrast testing all conditions of interest."""
 
-    missing_conditions = [
-        condition
-        for condition in conditions_of_interest
-        if condition not in design_matrix.columns
-    ]
+    # --- Get the TR value
+    TR = layout.get_tr(subject=sID)
 
-    if missing_conditions:
-        raise ValueError(
-            "Conditions missing from the design matrix: "
-            f"{missing_conditions}"
+    # --- If slice timing correction was applied, get the slice time reference
+    slice_timing = layout.get_metadata(bold[0])
+    if slice_timing['SliceTimingCorrected']:
+      slice_time_ref = slice_timing['StartTime'] / TR
+    else:
+      slice_time_ref = 0
+
+    # --- Define the GLM model
+    fmri_glm = FirstLevelModel(
+        t_r = TR,
+        slice_time_ref = slice_time_ref,
+        hrf_model = 'SPM',
+        drift_model = 'cosine',
+        high_pass = 0.01,
+        noise_model = 'ar1',
+        smoothing_fwhm = 6,
+        mask_img = brain_mask[0]
         )
 
-    return np.vstack([
-        (design_matrix.columns == condition).astype(float)
-        for condition in conditions_of_interest
-    ])
-
-# Generate the t-contrast vectors
-contrasts = {}
+    # --- Compare the inputs and the model with the manifest
+    manifest_file = os.path.join(output, model_name, "manifest.json")
+    glm_dir = os.path.join(outdir, 'sub-' + sID + '_glm')
+    previous = {} if force else read_manifest_entry(manifest_file, sID)
+    previous_inputs = previous.get("inputs", {})
+    inputs = {
+        path: hash_file(path, previous_inputs.get(path))
+        for path in bold + events + confound_files + brain_mask
+    }
+    model_hash = hash_object({
+        "FirstLevelModel": fmri_glm.get_params(),
+        "confounds": confound_parameters,
+    })
+    contrast_hashes = {
+        contrast_id: hash_object(parameters)
+        for contrast_id, parameters in contrast_definitions.items()
+    }
+    contrast_hashes["EffectsOfInterest"] = hash_object(conditions_of_interest)
 
-for contrast_name, parameters in contrast_definitions.items():
-    print(f"\nCreating contrast: {contrast_name}")
+    def content_hashes(records):
+        return {path: record["sha256"] for path, record in records.items()}
 
-    contrast_vectors = [
-        create_contrast_vector(
-            design_matrix,
-            **parameters,
+    refit = not (
+        content_hashes(previous_inputs) == content_hashes(inputs)
+        and previous.get("model") == model_hash
+        and os.path.exists(os.path.join(glm_dir, "glm.json"))
+    )
+    # Output type and file name of each contrast, following BIDS standart
+    res_name = os.path.basename(bold[0]).split("run")[0]
+    output_types = {
+        contrast_id: 'z_score' if contrast_id == 'EffectsOfInterest' else 'effect_size'
+        for contrast_id in contrast_hashes
+    }
+    output_files = {
+        contrast_id: contrast_filename(
+            outdir, res_name, contrast_id, output_types[contrast_id], compresslevel
         )
-        for design_matrix in design_matrices
-    ]
+        for contrast_id in contrast_hashes
+    }
 
-    contrasts[contrast_name] = contrast_vectors
-    
-    # Add the effects of interest F-contrast
-    contrasts["EffectsOfInterest"] = [
-    create_effects_of_interest_matrix(
-        design_matrix,
-        conditions_of_interest,
-    )
-    for design_matrix in design_matrices
+    previous_contrasts = {} if refit else previous.get("contrasts", {})
+    contrasts_to_compute = [
+        contrast_id
+        for contrast_id, contrast_hash in contrast_hashes.items()
+        if previous_contrasts.get(contrast_id, {}).get("hash") != contrast_hash
+        or previous_contrasts[contrast_id]["output"] != output_files[contrast_id]
+        or not os.path.exists(output_files[contrast_id])
     ]
 
-    
-# --- Compute the contrasts and save the results
-for contrast_id in contrasts.keys():   
-    if contrast_id == 'EffectsOfInterest':
-        stats = 'z_score' 
+    if not refit and not contrasts_to_compute:
+        if inputs != previous_inputs:
+            # Same content, new modification times: record them so that the
+            # files are not hashed again next time
+            write_manifest_entry(manifest_file, sID, {**previous, "inputs": inputs})
+        print("Subject " + sID + " is up to date, skipping")
+        return True
+
+    if refit:
+        # --- Define which confounds to include in the GLM
+        confounds_for_glm, sample_masks = load_confounds_cached(
+            bold, # list of fMRIPrep-preprocessed BOLD files
+            confounds_cache,
+            **confound_parameters
+        )
+        # Prepare sample masks for FirstLevelModel.fit()
+        if all(mask is None for mask in sample_masks):
+            sample_masks_for_glm = None
+        else:
+            sample_masks_for_glm = [
+                np.arange(len(confounds), dtype=int)
+                if mask is None
+                else mask
+                for confounds, mask in zip(confounds_for_glm, sample_masks)
+            ]
+
+        # --- Fit the model
+        fmri_glm = fmri_glm.fit(
+            bold,
+            events=events,
+            confounds=confounds_for_glm,
+            sample_masks=sample_masks_for_glm
+            )
+
+        # --- Save the fitted model, so that contrasts can be added later
+        # without refitting
+        state = glm_state(fmri_glm, res_name)
+        save_glm_state(state, glm_dir)
     else:
-        stats = 'effect_size'
-    stats_map = fmri_glm.compute_contrast(
-        contrasts[contrast_id], 
-        output_type = stats)
-    # Save results following BIDS standart
-    res_name = os.path.basename(bold[0]).split("run")[0]
-    # from stats get only the part before _ for the BIDS file name
-    stats_suffix = stats.split("_")[0]
-    # in contrast_id remove underscores
-    contrast_id = contrast_id.replace("_", "")
-    # Save the result
-    stats_map.to_filename(os.path.join(outdir, res_name + 'desc-' + contrast_id + '_' + stats_suffix + '.nii.gz'))
+        print("Inputs and model unchanged, reloading the fitted GLM to compute "
+              "contrasts: " + ", ".join(contrasts_to_compute))
+        state = load_glm_state(glm_dir)
+
+    # --- Get the design matrices
+    design_matrices = state["design_matrices"]
+
+    # --- Create contrasts
+    # The t-contrast vectors and the effects of interest F-contrast of all runs
+    contrasts = create_contrasts(design_matrices, {
+        **contrast_definitions,
+        "EffectsOfInterest": {"conditions": conditions_of_interest},
+    })
+
+    # --- Compute the contrasts and save the results
+    # All t-contrasts are computed in one batch, and the maps are compressed
+    # and written by a pool of threads while the next ones are computed
+    write_contrast_maps(
+        state,
+        {contrast_id: contrasts[contrast_id] for contrast_id in contrasts_to_compute},
+        output_types,
+        output_files,
+        compresslevel=compresslevel,
+        n_threads=n_threads
+        )
+    contrast_records = dict(previous_contrasts)
+    for contrast_id in contrasts_to_compute:
+        contrast_records[contrast_id] = {
+            "hash": contrast_hashes[contrast_id],
+            "output": output_files[contrast_id],
+        }
+
+    # --- Record the inputs, model and contrasts of this subject in the manifest
+    write_manifest_entry(manifest_file, sID, {
+        "inputs": inputs,
+        "model": model_hash,
+        "contrasts": {
+            contrast_id: contrast_records[contrast_id]
+            for contrast_id in contrast_hashes
+        },
+    })
+
+    # ======================================================================
+    # CREATE THIS MODEL'S dataset_description.json FILE
+    # This is needed to use the results directory as BIDS data.
+    # We will save our model parameters in the file as well, which is very useful.
+    # ======================================================================
+
+    jason_file = os.path.join(output, model_name, "dataset_description.json")
+
+    if refit and not os.path.exists(jason_file):
+        import datetime
+        from importlib.metadata import version
+
+        bids_version = layout.get_dataset_description()['BIDSVersion']
+        nilearn_version = version('nilearn')
+        date_created = datetime.datetime.now()
+
+        # Data to be written
+        content = {
+            "Name": "First-level GLM analysis",
+            "BIDSVersion": bids_version,
+            "DatasetType": "results",
+            "GeneratedBy": [
+                {
+                    "Name": "Nilearn",
+                    "Version": nilearn_version,
+                    "CodeURL": "https://nilearn.github.io"
+                }
+            ],
+            "Date": date_created,
+            "ConfoundsIncluded": confounds_for_glm[0].columns.tolist(),
+            "FirstLevelModel": [
+                fmri_glm.get_params()
+            ],
+        }
+
+        # Serializing json
+        json_object = json.dumps(content, indent=4, default=str)
+
+        # Writing to .json
+        with open(jason_file, "w") as outfile:
+            outfile.write(json_object)
+
+    # ======================================================================
+    print("Finished first-level analysis for subject " + sID)
+    print("Finished at: " + time.strftime("%H:%M:%S", time.localtime()))
+    print("Processing time: " + str(round((time.time() - start_time)/60, 2)) + " minutes")
+    return True
 
 # ======================================================================
-# CREATE THIS MODEL'S dataset_description.json FILE
-# This is needed to use the results directory as BIDS data. 
-# We will save our model parameters in the file as well, which is very useful.
+# WORKER PROCESSES
+# Each worker loads the layout from the database once and reuses it for
+# all the subjects it processes.
 # ======================================================================
+_worker_layout = None
 
-jason_file = os.path.join(output, model_name, "dataset_description.json")
-
-if not os.path.exists(jason_file):
-    import json
-    import datetime
-    from importlib.metadata import version
-
-    bids_version = layout.get_dataset_description()['BIDSVersion']
-    nilearn_version = version('nilearn')
-    date_created = datetime.datetime.now()
-    
-    # Data to be written
-    content = {
-        "Name": "First-level GLM analysis",
-        "BIDSVersion": bids_version,
-        "DatasetType": "results",
-        "GeneratedBy": [
-            {
-                "Name": "Nilearn",
-                "Version": nilearn_version,
-                "CodeURL": "https://nilearn.github.io"
-            }
-        ],    
-        "Date": date_created,
-        "ConfoundsIncluded": confounds_for_glm[0].columns.tolist(),
-        "FirstLevelModel": [
-            fmri_glm.get_params()
-        ], 
-    }
-    
-    # Serializing json
-    json_object = json.dumps(content, indent=4, default=str)
-    
-    # Writing to .json
-    with open(jason_file, "w") as outfile:
-        outfile.write(json_object)
+def _init_worker(ds, database_path):
+    global _worker_layout
+    warnings.filterwarnings("ignore")
+    _worker_layout = load_layout(ds, database_path)
 
+def _run_worker(sID, output, **kwargs):
+    return run_first_level(_worker_layout, sID, output, **kwargs)
+
+# ======================================================================
+# MAIN
+# arguments passed from step07_first_level_analysis.sh (or the command line)
 # ======================================================================
-print("Finished first-level analysis for subject " + sID)
-print("Finished at: " + time.strftime("%H:%M:%S", time.localtime()))
-print("Processing time: " + str(round((time.time() - start_time)/60, 2)) + " minutes")
\ No newline at end of file
+
+def main():
+    parser = argparse.ArgumentParser(description="Subject-level fMRI analysis using Nilearn")
+    parser.add_argument("ds", help="dataset location")
+    parser.add_argument("subjects", nargs="?",
+                        help="subject id (sub-01), comma-separated ids, or 'all'")
+    parser.add_argument("output", nargs="?", help="output location")
+    parser.add_argument("--n-jobs", type=int, default=1,
+                        help="number of subjects analysed in parallel")
+    parser.add_argument("--database", default=None,
+                        help="folder of the SQLite index of the dataset "
+                             "(default: <ds>/scratch/pybids_db)")
+    parser.add_argument("--reset-database", action="store_true",
+                        help="re-index the dataset")
+    parser.add_argument("--index-only", action="store_true",
+                        help="only build the index of the dataset")
+    parser.add_argument("--force", action="store_true",
+                        help="refit all subjects, ignoring the manifest")
+    parser.add_argument("--confounds-cache", default=None,
+                        help="folder of the cache of the confound files "
+                             "(default: <ds>/scratch/confounds_cache)")
+    parser.add_argument("--compress-level", type=int, default=1,
+                        help="gzip level of the contrast maps (1 is fastest), "
+                             "0 for uncompressed .nii files")
+    parser.add_argument("--n-threads", type=int, default=4,
+                        help="number of threads writing the contrast maps of a subject")
+    args = parser.parse_args()
+
+    database_path = args.database or os.path.join(args.ds, 'scratch', 'pybids_db')
+    run_options = {
+        "force": args.force,
+        "compresslevel": args.compress_level,
+        "n_threads": args.n_threads,
+        "confounds_cache": args.confounds_cache
+            or os.path.join(args.ds, 'scratch', 'confounds_cache'),
+    }
+
+    # --- Index the dataset once (or load the saved index)
+    start_time = time.time()
+    layout = load_layout(args.ds, database_path, reset_database=args.reset_database)
+    print("BIDS layout ready in " + str(round(time.time() - start_time, 1)) + " seconds")
+    if args.index_only:
+        return
+    if args.subjects is None or args.output is None:
+        parser.error("subjects and output are required unless --index-only is given")
+
+    if args.subjects == 'all':
+        subject_ids = layout.get_subjects()
+    else:
+        subject_ids = [s.split("sub-")[-1] for s in args.subjects.split(",")]
+
+    failed = []
+    if args.n_jobs == 1:
+        for sID in subject_ids:
+            if not run_first_level(layout, sID, args.output, **run_options):
+                failed.append(sID)
+    else:
+        with ProcessPoolExecutor(
+            args.n_jobs,
+            initializer=_init_worker,
+            initargs=(args.ds, database_path)
+        ) as pool:
+            futures = {
+                pool.submit(_run_worker, sID, args.output, **run_options): sID
+                for sID in subject_ids
+            }
+            for future in as_completed(futures):
+                if not future.result():
+                    failed.append(futures[future])
+
+    if failed:
+        print("ERROR: First-level analysis failed for subjects: " + ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,24 @@ start=$(date +%s)
 date
 echo Submitted subject: "$subject"
 
+# Threads and memory of fMRIPrep from the SLURM allocation (8 CPUs and 32 GB otherwise);
+# fMRIPrep's memory limit leaves some room for apptainer. SLURM sets SLURM_MEM_PER_NODE
+# for jobs submitted with --mem, and SLURM_MEM_PER_CPU for jobs submitted with --mem-per-cpu
+NTHREADS=${SLURM_CPUS_PER_TASK:-8}
+OMP_NTHREADS=$(( NTHREADS < 8 ? NTHREADS : 8 ))
+if [ -n "$SLURM_MEM_PER_NODE" ]; then
+    JOB_MEM_MB=$SLURM_MEM_PER_NODE
+elif [ -n "$SLURM_MEM_PER_CPU" ]; then
+    JOB_MEM_MB=$(( SLURM_MEM_PER_CPU * ${SLURM_CPUS_PER_TASK:-1} ))
+else
+    JOB_MEM_MB=32768
+fi
+MEM_MB=$(( JOB_MEM_MB * 9 / 10 ))
+
+# Separate work directory for each subject, so subjects can run at the same time
+WORK_DIR=scratch/fmriprep/sub-"$subject"
+mkdir -p "$PROJECT_PATH/$WORK_DIR"
+
 # ======================================================================
 # FMRIPrep with Apptainer
 # ======================================================================
@@ -33,11 +51,12 @@ apptainer run \
     /MyProject/data/derivatives/fmriprep\
     participant \
     --fs-license-file /MyProject/freesurfer_license.txt \
-    --work-dir /MyProject/scratch/fmriprep \
+    --work-dir /MyProject/"$WORK_DIR" \
     --participant-label "$subject" \
     --output-spaces MNI152NLin6Asym:res-2 \
     --fs-no-reconall \
-    --nthreads 16 --omp-nthreads 8 \
+    --nthreads "$NTHREADS" --omp-nthreads "$OMP_NTHREADS" --mem "$MEM_MB" \
+    --resource-monitor \
     --skip-bids-validation \
     --stop-on-first-crash
 
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ======================================================================
+# Run the preprocessing and analysis steps of all subjects as one pipeline
+#
+# Each stage of the pipeline (e.g. fMRIPrep, then the first-level GLM) is
+# submitted as one SLURM job array with a task per subject. The task of a
+# subject starts only after the task of the same subject in the stage it
+# depends on completed successfully (--dependency=aftercorr), so a subject
+# that fails does not hold back the others. The number of tasks running at
+# once is limited with the array throttle (--array=0-N%max_concurrent) instead
+# of sleeping between submissions, and the jobs are polled with sacct until
+# all are finished.
+#
+# The same pipeline can be run without a cluster (e.g. to test it) with the
+# local backend, which runs the tasks as subprocesses, n_jobs at a time.
+#
+# Example usage:
+#   python pipeline_orchestrator.py /path/to/project
+#   python pipeline_orchestrator.py /path/to/project --stages first-level --subjects 01,02
+#   python pipeline_orchestrator.py /path/to/project --backend local --n-jobs 4
+#
+# The stages are defined in define_stages() below. The command of a stage is
+# a bash snippet in which $SUBJECT is the subject ID (without 'sub-').
+#
+# ======================================================================
+
+# ======================================================================
+# IMPORT REQUIRED PACKAGES
+# ======================================================================
+import os
+import re
+import sys
+import time
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# States of a task that is not finished yet; all other states (COMPLETED,
+# FAILED, CANCELLED, TIMEOUT, OUT_OF_MEMORY, NODE_FAIL, BOOT_FAIL, DEADLINE,
+# PREEMPTED, REVOKED, ...) are final
+ACTIVE_STATES = [
+    "PENDING", "RUNNING", "REQUEUED", "REQUEUE_HOLD", "REQUEUE_FED", "SUSPENDED",
+    "CONFIGURING", "COMPLETING", "RESIZING", "SIGNALING", "STAGE_OUT", "STOPPED",
+    "RESV_DEL_HOLD",
+]
+
+# ======================================================================
+# DEFINE THE PIPELINE
+# ======================================================================
+
+def define_stages(project_path):
+    """
+    Stages of the pipeline.
+
+    Each stage is a dict with:
+        name : str
+        command : str
+            bash snippet run for every subject ($SUBJECT is the subject ID)
+        depends_on : list of str
+            stages that must have completed successfully first
+        cpus, mem, time : SLURM resources of each task (mem and time may be None)
+        max_concurrent : int or None
+            maximum number of tasks of this stage running at once
+    """
+    code_path = os.path.dirname(os.path.abspath(__file__))
+    return [
+        {
+            "name": "fmriprep",
+            "command": f'"{code_path}/fmriprep_script.sh" "{project_path}" "$SUBJECT"',
+            "depends_on": [],
+            "cpus": 8,
+            "mem": "32G",
+            "time": "7-00:00",
+            "max_concurrent": 10,
+        },
+        {
+            "name": "first-level",
+            # The first task indexes the BIDS dataset, the others wait for the
+            # lock and then load the index
+            "command": (
+                f'mkdir -p "{project_path}/scratch" && '
+                f'flock "{project_path}/scratch/pybids_db.lock" '
+                f'python "{code_path}/first_level_script.py" "{project_path}" --index-only && '
+                f'python "{code_path}/first_level_script.py" "{project_path}" '
+                f'"$SUBJECT" "{project_path}/results"'
+            ),
+            "depends_on": ["fmriprep"],
+            "cpus": 1,
+            "mem": None,
+            "time": None,
+            "max_concurrent": None,
+        },
+    ]
+
+def sort_stages(stages):
+    """Order the stages so that each stage comes after the stages it depends on."""
+    names = {stage["name"] for stage in stages}
+    ordered, done = [], set()
+    while len(ordered) < len(stages):
+        ready = [
+            stage for stage in stages
+            if stage["name"] not in done
+            and all(dep in done or dep not in names for dep in stage["depends_on"])
+        ]
+        if not ready:
+            raise ValueError("The stage dependencies contain a cycle")
+        for stage in ready:
+            ordered.append(stage)
+            done.add(stage["name"])
+    return ordered
+
+# ======================================================================
+# SLURM BACKEND
+# ======================================================================
+
+class SlurmBackend:
+    """
+    Submit stages as SLURM job arrays and poll their state with sacct.
+
+    Parameters
+    ----------
+    log_dir : str
+        Location of the job scripts and logs.
+    """
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.subjects = {}
+        os.makedirs(log_dir, exist_ok=True)
+
+    def job_script(self, stage, subjects, dependencies=()):
+        """The sbatch script of a stage: one array task per subject."""
+        throttle = f"%{stage['max_concurrent']}" if stage["max_concurrent"] else ""
+        options = [
+            f"--job-name={stage['name']}",
+            f"--output={self.log_dir}/{stage['name']}_%A_%a.out",
+            f"--error={self.log_dir}/{stage['name']}_%A_%a.err",
+            f"--array=0-{len(subjects) - 1}{throttle}",
+            f"--cpus-per-task={stage['cpus']}",
+        ]
+        if stage["mem"]:
+            options.append(f"--mem={stage['mem']}")
+        if stage["time"]:
+            options.append(f"--time={stage['time']}")
+        if dependencies:
+            # Task i waits for task i of the dependencies only (the arrays
+            # have the same subjects in the same order), and is cancelled if
+            # that task fails, instead of being left pending forever
+            options.append("--dependency=aftercorr:" + ":".join(dependencies))
+            options.append("--kill-on-invalid-dep=yes")
+
+        return "\n".join(
+            ["#!/bin/bash"]
+            + [f"#SBATCH {option}" for option in options]
+            + [
+                "",
+                "SUBJECTS=(" + " ".join(subjects) + ")",
+                "SUBJECT=${SUBJECTS[$SLURM_ARRAY_TASK_ID]}",
+                'echo "Subject: $SUBJECT"',
+                "",
+                stage["command"],
+                "",
+            ]
+        )
+
+    def submit(self, stage, subjects, dependencies=()):
+        """Submit a stage and return its job ID."""
+        job_script_file = os.path.join(self.log_dir, f"{stage['name']}.sh")
+        with open(job_script_file, "w") as f:
+            f.write(self.job_script(stage, subjects, dependencies))
+        result = subprocess.run(
+            ["sbatch", "--parsable", job_script_file],
+            check=True, capture_output=True, text=True
+        )
+        job_id = result.stdout.strip().split(";")[0]
+        self.subjects[job_id] = list(subjects)
+        return job_id
+
+    def status(self, job_id):
+        """State of every subject of a job array, as a dict."""
+        result = subprocess.run(
+            ["sacct", "-j", job_id, "--format=JobID,State",
+             "--noheader", "--parsable2"],
+            check=True, capture_output=True, text=True
+        )
+        return parse_sacct(result.stdout, job_id, self.subjects[job_id])
+
+    def cancel(self, job_id):
+        subprocess.run(["scancel", job_id], check=False)
+
+def parse_sacct(output, job_id, subjects):
+    """
+    Task states of a job array from the output of sacct --parsable2.
+
+    Tasks that sacct does not list separately (e.g. 123_[4-9%2], which are
+    pending, or cancelled before they started) have the state of the row of
+    their range. Tasks that sacct does not list at all are pending.
+    """
+    states = {subject: "PENDING" for subject in subjects}
+    for line in output.splitlines():
+        fields = line.split("|")
+        match = re.fullmatch(re.escape(job_id) + r"_(\d+|\[([\d,\-]+)(%\d+)?\])", fields[0])
+        if not match:
+            continue
+        if match.group(2) is None:
+            tasks = [int(match.group(1))]
+        else:
+            # e.g. 123_[0,2-5%2]
+            tasks = []
+            for task_range in match.group(2).split(","):
+                first, _, last = task_range.partition("-")
+                tasks.extend(range(int(first), int(last or first) + 1))
+        for task in tasks:
+            if task < len(subjects):
+                # e.g. "CANCELLED by 1234"
+                states[subjects[task]] = fields[1].split()[0]
+    return states
+
+# ======================================================================
+# LOCAL BACKEND
+# ======================================================================
+
+class LocalBackend:
+    """
+    Run the stages on this machine, with the same interface as SlurmBackend.
+
+    Each task runs its command with bash, with SUBJECT set in the environment.
+    At most n_jobs tasks run at once (and at most max_concurrent of each
+    stage). The task of a subject waits until the tasks of the same subject
+    in the stages it depends on completed, and is cancelled if one of them
+    did not (as aftercorr).
+
+    Parameters
+    ----------
+    log_dir : str
+        Location of the task logs.
+    n_jobs : int
+        Number of tasks run at once.
+    """
+
+    def __init__(self, log_dir, n_jobs=1):
+        self.log_dir = log_dir
+        self._slots = threading.Semaphore(n_jobs)
+        self._jobs = {}
+        self._running = set()
+        os.makedirs(log_dir, exist_ok=True)
+
+    def submit(self, stage, subjects, dependencies=()):
+        job_id = f"local{len(self._jobs)}"
+        pool = ThreadPoolExecutor(stage["max_concurrent"] or len(subjects))
+        self._jobs[job_id] = {
+            subject: pool.submit(
+                self._run_task, stage, job_id, subject,
+                [self._jobs[dep][subject] for dep in dependencies]
+            )
+            for subject in subjects
+        }
+        pool.shutdown(wait=False)
+        return job_id
+
+    def _run_task(self, stage, job_id, subject, upstream):
+        wait(upstream)
+        if any(future.cancelled() or future.result() != "COMPLETED" for future in upstream):
+            return "CANCELLED"
+        log_file = os.path.join(self.log_dir, f"{stage['name']}_{job_id}_{subject}.out")
+        with self._slots, open(log_file, "w") as log:
+            self._running.add((job_id, subject))
+            result = subprocess.run(
+                ["bash", "-c", stage["command"]],
+                env={**os.environ, "SUBJECT": subject},
+                stdout=log, stderr=subprocess.STDOUT
+            )
+            self._running.discard((job_id, subject))
+        return "COMPLETED" if result.returncode == 0 else "FAILED"
+
+    def status(self, job_id):
+        return {
+            subject: "CANCELLED" if future.cancelled()
+            else future.result() if future.done()
+            else "RUNNING" if (job_id, subject) in self._running
+            else "PENDING"
+            for subject, future in self._jobs[job_id].items()
+        }
+
+    def cancel(self, job_id):
+        for future in self._jobs[job_id].values():
+            future.cancel()
+
+# ======================================================================
+# RUN THE PIPELINE
+# ======================================================================
+
+def run_pipeline(stages, subjects, backend, poll_interval=60):
+    """
+    Submit all stages and wait until all their tasks are finished.
+
+    Parameters
+    ----------
+    stages : list of dict
+        Stages of the pipeline (see define_stages).
+    subjects : list of str
+        Subject IDs (without 'sub-').
+    backend : SlurmBackend or LocalBackend
+    poll_interval : float
+        Seconds between status checks.
+
+    Returns
+    -------
+    states : dict
+        Stage name -> {subject: final state}.
+    """
+    job_ids = {}
+    stage_names = [stage["name"] for stage in stages]
+    for stage in sort_stages(stages):
+        dependencies = [
+            job_ids[dep] for dep in stage["depends_on"] if dep in job_ids
+        ]
+        job_ids[stage["name"]] = backend.submit(stage, subjects, dependencies)
+        print(f"Submitted {stage['name']} for {len(subjects)} subjects: "
+              f"job {job_ids[stage['name']]}")
+
+    summary = None
+    while True:
+        states = {name: backend.status(job_ids[name]) for name in stage_names}
+        new_summary = "; ".join(
+            name + ": " + ", ".join(
+                f"{list(stage_states.values()).count(state)} {state.lower()}"
+                for state in sorted(set(stage_states.values()))
+            )
+            for name, stage_states in states.items()
+        )
+        if new_summary != summary:
+            summary = new_summary
+            print(time.strftime("%H:%M:%S", time.localtime()) + " " + summary)
+        if all(
+            state not in ACTIVE_STATES
+            for stage_states in states.values()
+            for state in stage_states.values()
+        ):
+            return states
+        time.sleep(poll_interval)
+
+# ======================================================================
+# MAIN
+# ======================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the pipeline for all subjects")
+    parser.add_argument("project", help="project location (with the BIDS data in data/)")
+    parser.add_argument("--subjects", default="all",
+                        help="comma-separated subject IDs, or 'all'")
+    parser.add_argument("--stages", nargs="+", default=None,
+                        help="stages to run (default: all)")
+    parser.add_argument("--backend", choices=["slurm", "local"], default="slurm")
+    parser.add_argument("--n-jobs", type=int, default=1,
+                        help="number of tasks run at once by the local backend")
+    parser.add_argument("--poll-interval", type=float, default=60,
+                        help="seconds between status checks")
+    args = parser.parse_args()
+
+    project_path = os.path.abspath(args.project)
+    if args.subjects == "all":
+        data_path = os.path.join(project_path, "data")
+        subjects = sorted(
+            d.replace("sub-", "") for d in os.listdir(data_path)
+            if os.path.isdir(os.path.join(data_path, d)) and d.startswith("sub-")
+        )
+    else:
+        subjects = [s.replace("sub-", "") for s in args.subjects.split(",")]
+
+    stages = define_stages(project_path)
+    if args.stages:
+        stages = [stage for stage in stages if stage["name"] in args.stages]
+
+    log_dir = os.path.join(project_path, "logs", "pipeline")
+    if args.backend == "slurm":
+        backend = SlurmBackend(log_dir)
+    else:
+        backend = LocalBackend(log_dir, n_jobs=args.n_jobs)
+
+    states = run_pipeline(stages, subjects, backend, args.poll_interval)
+    failed = [
+        f"{name} sub-{subject} ({state})"
+        for name, stage_states in states.items()
+        for subject, state in stage_states.items()
+        if state != "COMPLETED"
+    ]
+    if failed:
+        print("Not completed: " + ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
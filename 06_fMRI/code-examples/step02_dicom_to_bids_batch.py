@@ -0,0 +1,214 @@
+"""
+This script converts the DICOM files of all subjects to BIDS format using HeuDiConv.
+
+Every folder in DICOM_ROOT is one subject (e.g. CBU090962_MR09029). The
+subject IDs are read from SUBJECTS_FILE, a tab-separated file with the columns
+dicom_dir and subject (e.g. "CBU090962_MR09029	15"); without it, the
+subject ID is the folder name without the characters BIDS does not allow.
+
+The subjects are converted in parallel by N_JOBS heudiconv processes (heudiconv
+locks the top-level BIDS files, e.g. participants.tsv, while it updates them).
+The output of each conversion is saved in LOG_PATH/sub-<ID>.log, and a summary
+of all conversions in LOG_PATH/summary.tsv.
+
+Subjects that were already converted are skipped: LOG_PATH/manifest.json records
+the DICOM files (number, total size, latest modification time) and the
+heuristic of each converted subject, and a subject is converted again only if
+these changed or its BIDS folder is missing (or with --force).
+
+The DICOM headers are read once into an index (DICOM_INDEX, see dicom_index.py),
+which heudiconv uses through the grouping function of the heuristic instead of
+reading every file again; only new or modified files are indexed on later runs.
+
+Usage:
+  1. Activate the conda environment: conda activate mri
+  2. Run the script: python step02_dicom_to_bids_batch.py [--n-jobs 8] [--force]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Change to the directory where this script is located
+script_directory = os.path.dirname(os.path.abspath(__file__))
+os.chdir(script_directory)
+
+# ------------------------------------------------------------
+# Define your paths
+# ------------------------------------------------------------
+
+# Folder with one folder of raw DICOM files per subject
+DICOM_ROOT = '../mridata' # define either full path or relative to the script
+
+# Location of the output data (it will be created if it doesn't exist)
+OUTPUT_PATH = '../FaceRecognition/data'
+
+# Optional tab-separated file mapping the DICOM folders to subject IDs (or None)
+SUBJECTS_FILE = None
+
+# Location of the conversion logs
+LOG_PATH = '../FaceRecognition/logs/dicom_to_bids'
+
+# Heuristic file for BIDS conversion
+HEURISTIC_FILE = 'bids_heuristic.py'
+
+# Index of the DICOM headers (None to let heudiconv read all the headers itself)
+DICOM_INDEX = '../FaceRecognition/scratch/dicom_index.sqlite'
+
+# Number of subjects converted at the same time
+N_JOBS = 4
+
+# ------------------------------------------------------------
+# Find the subjects
+# ------------------------------------------------------------
+
+def discover_subjects(dicom_root, subjects_file=None):
+    """Subject ID -> DICOM folder of all subjects in dicom_root"""
+    if subjects_file is not None:
+        subjects = {}
+        with open(subjects_file) as f:
+            header = f.readline().rstrip('\n').split('\t')
+            for line in f:
+                row = dict(zip(header, line.rstrip('\n').split('\t')))
+                subjects[row['subject']] = os.path.join(dicom_root, row['dicom_dir'])
+        return subjects
+
+    return {
+        re.sub('[^a-zA-Z0-9]', '', name): os.path.join(dicom_root, name)
+        for name in sorted(os.listdir(dicom_root))
+        if os.path.isdir(os.path.join(dicom_root, name))
+    }
+
+def dicom_signature(dicom_dir):
+    """Number, total size and latest modification time of the files in dicom_dir"""
+    n_files, total_size, latest_mtime = 0, 0, 0
+    for root, _, files in os.walk(dicom_dir):
+        for name in files:
+            stat = os.stat(os.path.join(root, name))
+            n_files += 1
+            total_size += stat.st_size
+            latest_mtime = max(latest_mtime, stat.st_mtime)
+    return {'n_files': n_files, 'size': total_size, 'mtime': latest_mtime}
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+# ------------------------------------------------------------
+# Run heudiconv
+# ------------------------------------------------------------
+
+def convert_subject(subject, dicom_dir, output_path, heuristic_file, log_path,
+                    dicom_index=None):
+    """Convert one subject with heudiconv, saving its output in the log file
+
+    Existing outputs of the subject (from an earlier conversion) are overwritten.
+    With dicom_index, the series are grouped from the index of DICOM headers.
+    Returns the return code of heudiconv and the processing time in seconds.
+    """
+    command = [
+        'heudiconv',
+        '--files', dicom_dir,
+        '--outdir', output_path,
+        '--heuristic', heuristic_file,
+        '--subjects', subject,
+        '--converter', 'dcm2niix',
+        '--bids'
+    ]
+    if os.path.isdir(os.path.join(output_path, f'sub-{subject}')):
+        command.append('--overwrite')
+    env = None
+    if dicom_index is not None:
+        command += ['--grouping', 'custom']
+        env = dict(os.environ, DICOM_INDEX=os.path.abspath(dicom_index))
+    start = time.time()
+    with open(os.path.join(log_path, f'sub-{subject}.log'), 'w') as log:
+        log.write('Running command: ' + ' '.join(command) + '\n')
+        log.flush()
+        result = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT, env=env)
+    return result.returncode, time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert all subjects to BIDS')
+    parser.add_argument('--n-jobs', type=int, default=N_JOBS,
+                        help='number of subjects converted at the same time')
+    parser.add_argument('--force', action='store_true',
+                        help='convert all subjects again')
+    args = parser.parse_args()
+
+    # Check if heuristic file exists
+    if not os.path.exists(HEURISTIC_FILE):
+        print(f"Error: Heuristic file '{HEURISTIC_FILE}' not found!")
+        exit(1)
+    os.makedirs(LOG_PATH, exist_ok=True)
+
+    manifest_file = os.path.join(LOG_PATH, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_file) and not args.force:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    # --- Find the subjects to convert
+    heuristic_hash = file_hash(HEURISTIC_FILE)
+    subjects = discover_subjects(DICOM_ROOT, SUBJECTS_FILE)
+    records, summary = {}, {}
+    for subject, dicom_dir in subjects.items():
+        records[subject] = {
+            'dicom_dir': os.path.abspath(dicom_dir),
+            'dicom': dicom_signature(dicom_dir),
+            'heuristic': heuristic_hash,
+        }
+        if (manifest.get(subject) == records[subject]
+                and os.path.isdir(os.path.join(OUTPUT_PATH, f'sub-{subject}'))):
+            summary[subject] = ('skipped', 0.0)
+    todo = [subject for subject in subjects if subject not in summary]
+    print(f"Found {len(subjects)} subjects in {DICOM_ROOT}: "
+          f"{len(subjects) - len(todo)} already converted, {len(todo)} to convert")
+
+    # --- Index the DICOM headers
+    if DICOM_INDEX is not None and todo:
+        from dicom_index import build_index
+        os.makedirs(os.path.dirname(os.path.abspath(DICOM_INDEX)), exist_ok=True)
+        build_index(DICOM_ROOT, DICOM_INDEX, args.n_jobs)
+
+    # --- Convert them in parallel
+    with ThreadPoolExecutor(args.n_jobs) as pool:
+        futures = {
+            pool.submit(convert_subject, subject, subjects[subject], OUTPUT_PATH,
+                        HEURISTIC_FILE, LOG_PATH, DICOM_INDEX): subject
+            for subject in todo
+        }
+        for future in as_completed(futures):
+            subject = futures[future]
+            returncode, seconds = future.result()
+            if returncode == 0:
+                summary[subject] = ('converted', seconds)
+                manifest[subject] = records[subject]
+            else:
+                summary[subject] = (f'failed (return code {returncode})', seconds)
+                manifest.pop(subject, None)
+            # Save after every subject, so that an interrupted run can be resumed
+            with open(manifest_file, 'w') as f:
+                json.dump(manifest, f, indent=4)
+            print(f"sub-{subject}: {summary[subject][0]} in {seconds / 60:.1f} minutes")
+
+    # --- Write the summary
+    with open(os.path.join(LOG_PATH, 'summary.tsv'), 'w') as f:
+        f.write('subject\tdicom_dir\tstatus\tminutes\tlog\n')
+        for subject in subjects:
+            status, seconds = summary[subject]
+            f.write(f"sub-{subject}\t{subjects[subject]}\t{status}\t{seconds / 60:.2f}\t"
+                    f"{os.path.join(LOG_PATH, f'sub-{subject}.log')}\n")
+    failed = [subject for subject, (status, _) in summary.items() if status.startswith('failed')]
+    if failed:
+        print(f"Conversion failed for {len(failed)} subjects, see the logs in {LOG_PATH}")
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
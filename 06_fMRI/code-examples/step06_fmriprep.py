@@ -1,6 +1,33 @@
+"""
+This script submits fMRIPrep to SLURM, one job per subject.
+
+Each subject has its own work directory (WORK_PATH/sub-<ID>), so the jobs of all
+subjects can run at the same time, and a subject that is submitted again reuses
+the intermediate results of its earlier run. fMRIPrep gets as many threads as
+the job has CPUs, and a memory limit a bit below the job's memory.
+
+fMRIPrep runs with --resource-monitor, and writes the memory and CPU use of all
+its steps to resource_monitor.json in the work directory. After a subject
+finished, the samples of its last job (nipype appends those of every run to
+the same file) are summarised in WORK_PATH/sub-<ID>/resource_profile.json (peak
+memory, CPU use, run time), and the resources of later submissions are sized
+from these profiles instead of the defaults (see recommend_resources).
+
+Usage:
+  python step06_fmriprep.py                     # submit all subjects
+  python step06_fmriprep.py --subjects 01 02    # submit some subjects
+  python step06_fmriprep.py --dry-run           # show the resources without submitting
+  python step06_fmriprep.py --profiles          # show the resource profiles
+"""
+
+import argparse
+import glob
+import json
+import math
 import os
 import subprocess
-import time
+
+import numpy as np
 
 #------------------------------------------------------------
 # Specify the paths
@@ -10,27 +37,180 @@ OUTPUT_PATH = "/imaging/correia/da05/workshops/FaceRecognition/data/derivatives/
 FREESURFER_LICENSE = "/imaging/correia/da05/workshops/FaceRecognition/freesurfer_license.txt"
 WORK_PATH = "/imaging/correia/da05/workshops/FaceRecognition/scratch/fmriprep"
 
-if not os.path.exists(OUTPUT_PATH):
-    os.makedirs(OUTPUT_PATH)
-if not os.path.exists(WORK_PATH):
-    os.makedirs(WORK_PATH)
+#------------------------------------------------------------
+# Job resources
+#------------------------------------------------------------
+# Used until subjects have been profiled
+DEFAULT_CPUS = 8
+DEFAULT_MEM_GB = 32
+DEFAULT_TIME_HOURS = 7 * 24
+
+# Limits of the sized resources
+MIN_CPUS = 2
+MAX_CPUS = 16
+MIN_MEM_GB = 8
+MAX_MEM_GB = 64
+
+# Margins added to the profiled memory and run time
+MEM_MARGIN = 1.25
+TIME_MARGIN = 2.0
+
+# Threads per process used by fMRIPrep (at most)
+MAX_OMP_THREADS = 8
+
+#------------------------------------------------------------
+# Resource profiles
+#------------------------------------------------------------
+def subject_work_dir(WORK_PATH, subject):
+    return os.path.join(WORK_PATH, f"sub-{subject}")
+
+def summarise_resource_monitor(monitor_file, start_time=None, max_gap_hours=1, bin_seconds=5):
+    """
+    Summarise the resource_monitor.json of a fMRIPrep run.
+
+    The file has the samples (time, rss_GiB, cpus in %) of all the workflow
+    nodes. nipype appends the samples of every run with the same work
+    directory, so only those of the last run are kept: the samples from
+    start_time (the start of the job, in seconds since the epoch) or, without
+    it, those after the last gap of more than max_gap_hours without samples.
+    They are binned in time, and the nodes running in the same bin are added up
+    to get the use of the whole job.
+    """
+    with open(monitor_file) as f:
+        monitor = json.load(f)
+    time = np.asarray(monitor["time"], dtype=float)
+    if start_time is not None:
+        last_run = time >= start_time
+    else:
+        sorted_time = np.sort(time)
+        gaps = np.flatnonzero(np.diff(sorted_time) > max_gap_hours * 3600)
+        last_run = time >= (sorted_time[gaps[-1] + 1] if gaps.size else -np.inf)
+    time = time[last_run]
+    if time.size == 0:
+        return None
+    rss = np.asarray(monitor["rss_GiB"], dtype=float)[last_run]
+    cpus = np.asarray(monitor["cpus"], dtype=float)[last_run] / 100
+    nodes = np.unique(
+        [f"{name}.{mapnode}" for name, mapnode in zip(monitor["name"], monitor["mapnode"])],
+        return_inverse=True
+    )[1][last_run]
+
+    # Peak of each node in each time bin, then total over the nodes
+    bins = ((time - time.min()) // bin_seconds).astype(int)
+    n_bins, n_nodes = bins.max() + 1, nodes.max() + 1
+    node_rss = np.zeros((n_bins, n_nodes))
+    node_cpus = np.zeros((n_bins, n_nodes))
+    np.maximum.at(node_rss, (bins, nodes), rss)
+    np.maximum.at(node_cpus, (bins, nodes), cpus)
+    total_rss = node_rss.sum(axis=1)
+    total_cpus = node_cpus.sum(axis=1)
+    busy = total_cpus > 0
+
+    return {
+        "peak_mem_gb": float(total_rss.max()),
+        "peak_cpus": float(total_cpus.max()),
+        "p90_cpus": float(np.percentile(total_cpus[busy], 90)) if busy.any() else 0.0,
+        "mean_cpus": float(total_cpus[busy].mean()) if busy.any() else 0.0,
+        "hours": float((time.max() - time.min()) / 3600),
+    }
+
+def load_resource_profile(WORK_PATH, subject):
+    """
+    Resource profile of a subject, or None if it has not been run (to the end).
+
+    The profile is saved next to resource_monitor.json, and computed again
+    only if that file changed. Only the samples of the last job are used; its
+    start time is written to job_start.txt by the job script.
+    """
+    work_dir = subject_work_dir(WORK_PATH, subject)
+    monitor_files = glob.glob(os.path.join(work_dir, "fmriprep_*_wf", "resource_monitor.json"))
+    if not monitor_files:
+        return None
+    monitor_file = max(monitor_files, key=os.path.getmtime)
+    mtime = os.path.getmtime(monitor_file)
+
+    start_file = os.path.join(work_dir, "job_start.txt")
+    start_time = None
+    if os.path.exists(start_file):
+        with open(start_file) as f:
+            start_time = float(f.read())
+        if start_time > mtime:
+            # A new job has started, and the file is still that of an earlier one
+            start_time = None
+
+    profile_file = os.path.join(work_dir, "resource_profile.json")
+    if os.path.exists(profile_file):
+        with open(profile_file) as f:
+            profile = json.load(f)
+        if (profile.get("monitor_file") == monitor_file and profile.get("monitor_mtime") == mtime
+                and profile.get("start_time") == start_time):
+            return profile
+
+    profile = summarise_resource_monitor(monitor_file, start_time)
+    if profile is None:
+        return None
+    job_file = os.path.join(work_dir, "job_resources.json")
+    if os.path.exists(job_file):
+        with open(job_file) as f:
+            profile["job"] = json.load(f)
+    profile.update(monitor_file=monitor_file, monitor_mtime=mtime, start_time=start_time)
+    with open(profile_file, "w") as f:
+        json.dump(profile, f, indent=4)
+    return profile
+
+def recommend_resources(profiles, subject=None):
+    """
+    CPUs, memory (GB) and time limit (hours) of the next job of a subject.
+
+    The subject's own profile is used if it was run before, otherwise the
+    largest peak memory, CPU use and run time of the profiled subjects. The
+    CPUs are those fMRIPrep kept busy 90% of the time (more would be left idle);
+    the memory and time get a margin. Without profiles, the defaults are used.
+    """
+    if subject in profiles:
+        profiles = {subject: profiles[subject]}
+    if not profiles:
+        return DEFAULT_CPUS, DEFAULT_MEM_GB, DEFAULT_TIME_HOURS
+
+    peak_mem = max(p["peak_mem_gb"] for p in profiles.values())
+    p90_cpus = max(p["p90_cpus"] for p in profiles.values())
+    # Run time scaled to the CPUs of the new job
+    hours = max(
+        p["hours"] * p.get("job", {}).get("cpus", DEFAULT_CPUS) for p in profiles.values()
+    )
+
+    cpus = int(np.clip(math.ceil(p90_cpus), MIN_CPUS, MAX_CPUS))
+    mem_gb = int(np.clip(math.ceil(peak_mem * MEM_MARGIN + 1), MIN_MEM_GB, MAX_MEM_GB))
+    time_hours = int(min(math.ceil(hours / cpus * TIME_MARGIN + 1), DEFAULT_TIME_HOURS))
+    return cpus, mem_gb, time_hours
 
 #------------------------------------------------------------
 # Function to submit fMRIPrep to sbatch
 #------------------------------------------------------------
-def submit_fmriprep_job(BIDS_PATH, OUTPUT_PATH, WORK_PATH, FREESURFER_LICENSE, subject):
+def submit_fmriprep_job(BIDS_PATH, OUTPUT_PATH, WORK_PATH, FREESURFER_LICENSE, subject,
+                        cpus=DEFAULT_CPUS, mem_gb=DEFAULT_MEM_GB, time_hours=DEFAULT_TIME_HOURS):
+    work_dir = subject_work_dir(WORK_PATH, subject)
+    log_dir = os.path.join(WORK_PATH, "logs")
+    os.makedirs(work_dir, exist_ok=True)
+    os.makedirs(log_dir, exist_ok=True)
+
+    # fMRIPrep's memory limit (MB) leaves some room for apptainer and python itself
+    fmriprep_mem_mb = int(mem_gb * 1024 * 0.9)
+    omp_nthreads = min(cpus, MAX_OMP_THREADS)
+
     # Create a SLURM job script for the subject
     job_script = f"""#!/bin/bash
 #SBATCH --job-name=fmriprep_{subject}
-#SBATCH --output={WORK_PATH}/fmriprep_{subject}_%j.out
-#SBATCH --error={WORK_PATH}/fmriprep_{subject}_%j.err
-#SBATCH --time=7-00:00
-#SBATCH --mem=32G
-#SBATCH --cpus-per-task=8
+#SBATCH --output={log_dir}/fmriprep_{subject}_%j.out
+#SBATCH --error={log_dir}/fmriprep_{subject}_%j.err
+#SBATCH --time={time_hours // 24}-{time_hours % 24:02d}:00
+#SBATCH --mem={mem_gb}G
+#SBATCH --cpus-per-task={cpus}
 
 start=$(date +%s)
+echo "$start" > {work_dir}/job_start.txt
 date
-echo "Submitted subject: {subject}"
+echo "Submitted subject: {subject} ({cpus} CPUs, {mem_gb} GB)"
 
 # Load the apptainer module
 module load apptainer
@@ -39,7 +219,7 @@ module load apptainer
 apptainer run \\
     -B {BIDS_PATH}:/data:ro \\
     -B {OUTPUT_PATH}:/out \\
-    -B {WORK_PATH}:/work \\
+    -B {work_dir}:/work \\
     -B {FREESURFER_LICENSE}:/freesurfer_license.txt:ro \\
     /imaging/local/software/singularity_images/fmriprep/fmriprep-24.1.1.sif \\
     /data /out participant \\
@@ -48,53 +228,87 @@ apptainer run \\
     --fs-license-file /freesurfer_license.txt \\
     --output-space MNI152NLin6Asym:res-2 \\
     --fs-no-reconall \\
-    --nthreads 16 --omp-nthreads 8 \\
+    --nthreads {cpus} --omp-nthreads {omp_nthreads} --mem {fmriprep_mem_mb} \\
+    --resource-monitor \\
     --skip-bids-validation \\
     --stop-on-first-crash
 
-# Unload the apptainer module    
+# Unload the apptainer module
 module unload apptainer
 
 # processing end time
 end=$(date +%s)
 date
-echo Time elapsed: "$(TZ=UTC0 printf '%(%H:%M:%S)T\n' $((end - start)))"
+echo Time elapsed: "$(TZ=UTC0 printf '%(%H:%M:%S)T\\n' $((end - start)))"
 
     """
 
     # Write the job script to a temporary file
-    job_script_file = os.path.join(
-        WORK_PATH, f"fmriprep_{subject}.sh")
+    job_script_file = os.path.join(work_dir, f"fmriprep_{subject}.sh")
     with open(job_script_file, "w") as f:
         f.write(job_script)
-    
+
     # Submit the job script to SLURM using sbatch
     try:
         subprocess.run(["sbatch", job_script_file], check=True)
-        print(f"Submitted job for subject {subject}")
+        print(f"Submitted job for subject {subject}: {cpus} CPUs, {mem_gb} GB, {time_hours} hours")
+
+        # Record the resources of the job, to compare them with its profile
+        with open(os.path.join(work_dir, "job_resources.json"), "w") as f:
+            json.dump({"cpus": cpus, "mem_gb": mem_gb, "time_hours": time_hours}, f, indent=4)
 
         # After submission, delete the job script
         os.remove(job_script_file)
-        print(f"Deleted job script: {job_script_file}")
 
     except subprocess.CalledProcessError as e:
         print(f"Error submitting job for subject {subject}: {e}")
-        
+
 #------------------------------------------------------------
 # Main loop through subjects
 #------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Submit fMRIPrep jobs to SLURM")
+    parser.add_argument("--subjects", nargs="+",
+                        help="subject IDs without 'sub-' (default: all subjects)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="show the resources of each job without submitting it")
+    parser.add_argument("--profiles", action="store_true",
+                        help="show the resource profiles of the subjects that were run")
+    args = parser.parse_args()
+
+    os.makedirs(OUTPUT_PATH, exist_ok=True)
+    os.makedirs(WORK_PATH, exist_ok=True)
+
+    # Get all directories that start with 'sub-', and extract the subject IDs
+    subject_dirs = sorted(
+        d for d in os.listdir(BIDS_PATH)
+        if os.path.isdir(os.path.join(BIDS_PATH, d)) and d.startswith('sub-')
+    )
+    all_subjects = [d.replace('sub-', '') for d in subject_dirs]
+
+    profiles = {}
+    for subject in all_subjects:
+        profile = load_resource_profile(WORK_PATH, subject)
+        if profile is not None:
+            profiles[subject] = profile
+
+    if args.profiles:
+        print("subject\tpeak_mem_gb\tp90_cpus\tmean_cpus\thours")
+        for subject, p in profiles.items():
+            print(f"{subject}\t{p['peak_mem_gb']:.1f}\t{p['p90_cpus']:.1f}\t"
+                  f"{p['mean_cpus']:.1f}\t{p['hours']:.1f}")
+        return
 
-# Get all directories that start with 'sub-'
-subject_dirs = [d for d in os.listdir(BIDS_PATH) if os.path.isdir(os.path.join(BIDS_PATH, d)) and d.startswith('sub-')]
+    for subject in args.subjects or all_subjects:
+        cpus, mem_gb, time_hours = recommend_resources(profiles, subject)
+        if args.dry_run:
+            print(f"sub-{subject}: {cpus} CPUs, {mem_gb} GB, {time_hours} hours")
+            continue
+        # Submit fMRIPrep job to SLURM (the work directories are separate,
+        # so the subjects don't need to be staggered)
+        submit_fmriprep_job(BIDS_PATH, OUTPUT_PATH, WORK_PATH, FREESURFER_LICENSE, subject,
+                            cpus, mem_gb, time_hours)
 
-# Extract the subject IDs by stripping the 'sub-' prefix
-SUBJECT_IDs = [d.replace('sub-', '') for d in subject_dirs]
 
-for subject in SUBJECT_IDs:
-    # Submit fMRIPrep job to SLURM
-    submit_fmriprep_job(BIDS_PATH, OUTPUT_PATH, WORK_PATH, FREESURFER_LICENSE, subject)
-    
-    # Sleep 1 min 
-    # Fmriprep: Workaround for running subjects in parallel 
-    # https://neurostars.org/t/updated-fmriprep-workaround-for-running-subjects-in-parallel/6677)
-    time.sleep(60)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,9 @@
 # Usage:
 #   Activate the required conda environment.
 #   Configure the variables below and run the script: ./step07_first_level_analysis.sh
+#
+# To run fMRIPrep and the first-level analysis as one pipeline, with the
+# first-level jobs waiting for fMRIPrep to complete, see pipeline_orchestrator.py.
 #-----------------------------------------------------------
 
 # Your project's root directory
@@ -48,9 +51,20 @@ if [ ! -f "$SCRIPT_PATH" ]; then
     exit
 fi
 
+#-----------------------------------------------------------
+# Index the BIDS dataset once
+#-----------------------------------------------------------
+# The index is saved to an SQLite database ("$PROJECT_PATH"/scratch/pybids_db),
+# which all subject jobs then load instead of re-indexing the whole dataset.
+echo "Indexing the BIDS dataset..."
+python "$SCRIPT_PATH" "${PROJECT_PATH}" --index-only || exit 1
+
 #-----------------------------------------------------------
 # Submit job for each subject
 #-----------------------------------------------------------
+# Alternatively, analyse all subjects in a single job with a pool of workers:
+#   sbatch --job-name=first_level --cpus-per-task=8 \
+#       "$SCRIPT_PATH" "${PROJECT_PATH}" all "${OUT_PATH}" --n-jobs 8
 
 # Couldn't use task array because passing a list as an argument is tricky.
 # For loop is fine too.
@@ -1,5 +1,9 @@
-import mne
 import os
+import sys
+
+# noise_cov_cache.py is next to this config
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from noise_cov_cache import cached_noise_cov
 
 demo_data_root = os.path.join("/home", "cognestic", "Desktop", "COGNESTIC", "08_EEG_MEG", "MNE-sample-data-bids")
 
@@ -25,12 +29,10 @@ use_maxwell_filter = True
 def noise_cov(bp):
     # Estimate the noise covariance.
     # Use pre-stimulus period as noise source
-    bp = bp.copy().update(suffix="epo")
-    if not bp.fpath.exists():
-        bp.update(split="01")
-    epo = mne.read_epochs(bp)
-    cov = mne.compute_covariance(epo, rank="info", tmax=0)
-    return cov
+    # (cached in deriv_root/noise_cov_cache, and shared by the workers and reruns)
+    return cached_noise_cov(
+        bp, tmax=0, rank="info", cache_dir=os.path.join(deriv_root, "noise_cov_cache")
+    )
 
 
 spatial_filter = "ssp"
@@ -0,0 +1,160 @@
+"""Cached noise covariance for the MNE-BIDS-Pipeline config
+
+The noise covariance of an epochs file is computed once and saved as a -cov.fif
+file in a cache directory, keyed by the path, modification time and size of the
+epochs file (all its splits) and the tmin, tmax and rank of the covariance.
+Later calls, also from the other pipeline workers and from reruns of the
+pipeline, read the cached file; a file lock makes sure that workers asking for
+the same covariance at the same time compute it only once.
+
+The epochs are read with preload=False and the covariance is accumulated
+batch_size epochs at a time, so only one batch of epochs is in memory. The
+result is the same as mne.compute_covariance(epochs, method='empirical').
+
+Usage in the config:
+
+    def noise_cov(bp):
+        return cached_noise_cov(bp, tmax=0, rank="info", cache_dir=...)
+"""
+import glob
+import hashlib
+import json
+import os
+
+import mne
+import numpy as np
+from filelock import FileLock
+
+
+# In-memory cache of the noise covariances read or computed by this process
+_cov_cache = {}
+
+# Scalings of the channel types used by mne.compute_covariance
+_SCALINGS = dict(mag=1e15, grad=1e13, eeg=1e6)
+
+
+def _epochs_files(bp):
+    """Epochs file of a BIDSPath (or path), and all its split files"""
+    if hasattr(bp, 'fpath'):
+        bp = bp.copy().update(suffix='epo')
+        if not bp.fpath.exists():
+            bp.update(split='01')
+        fname = str(bp.fpath)
+    else:
+        fname = str(bp)
+    if '_split-01_' in os.path.basename(fname):
+        splits = glob.glob(os.path.join(
+            os.path.dirname(fname),
+            os.path.basename(fname).replace('_split-01_', '_split-*_')
+        ))
+        return fname, sorted(splits)
+    return fname, [fname]
+
+
+def _cov_cache_key(files, tmin, tmax, rank):
+    """Hash of the epochs files (path, mtime, size) and covariance parameters"""
+    stats = [(os.path.abspath(f), os.stat(f).st_mtime, os.stat(f).st_size) for f in files]
+    return hashlib.sha1(json.dumps(
+        [stats, tmin, tmax, rank, mne.__version__], default=str
+    ).encode()).hexdigest()[:16]
+
+
+def compute_noise_cov(fname, tmin=None, tmax=0, rank='info', batch_size=32):
+    """Empirical noise covariance of an epochs file, computed incrementally
+
+    Same as mne.compute_covariance(epochs, tmin=tmin, tmax=tmax, rank=rank),
+    with the epochs read batch_size at a time.
+
+    Returns
+    -------
+    cov : mne.Covariance
+        Noise covariance of the data channels (bad channels excluded)
+    """
+    epochs = mne.read_epochs(fname, preload=False, verbose='error')
+    picks = mne.pick_types(epochs.info, meg=True, eeg=True, seeg=True, ecog=True,
+                           dbs=True, fnirs=True, exclude='bads')
+    info = mne.pick_info(epochs.info, picks)
+
+    # Time window, rounded to the nearest samples as by compute_covariance
+    samples = np.round(epochs.times * info['sfreq'])
+    keep = np.ones(len(samples), bool)
+    if tmin is not None:
+        keep &= samples >= np.round(tmin * info['sfreq'])
+    if tmax is not None:
+        keep &= samples <= np.round(tmax * info['sfreq'])
+
+    # Sum of the outer products of the samples, one batch of epochs at a time
+    C = np.zeros((len(picks), len(picks)))
+    n_samples = 0
+    for start in range(0, len(epochs), batch_size):
+        data = epochs.get_data(picks=picks, item=slice(start, start + batch_size), verbose='error')
+        data = data[..., keep]
+        C += np.einsum('ect,eft->cf', data, data)
+        n_samples += data.shape[0] * data.shape[2]
+    C /= n_samples - 1
+
+    # Remove the dimensions beyond the rank of each channel type, as in
+    # compute_covariance (with the data of each type scaled to natural units)
+    cov = mne.Covariance(C, info['ch_names'], [], info['projs'], n_samples - 1,
+                         method='empirical')
+    ranks = mne.compute_rank(cov, rank=rank, info=info, verbose='error')
+    idx_by_type = mne.channel_indices_by_type(info)
+    scale = np.ones(len(picks))
+    for ch_type, idx in idx_by_type.items():
+        scale[idx] = _SCALINGS.get(ch_type, 1.)
+    Q = np.eye(len(picks))
+    for ch_type, ch_rank in ranks.items():
+        types = ['mag', 'grad'] if ch_type == 'meg' else [ch_type]
+        idx = np.sort(np.concatenate([idx_by_type[t] for t in types])).astype(int)
+        s = scale[idx]
+        _, eigvec = np.linalg.eigh(C[np.ix_(idx, idx)] * np.outer(s, s))
+        eigvec = eigvec[:, len(idx) - ch_rank:]
+        Q[np.ix_(idx, idx)] = (eigvec @ eigvec.T) * np.outer(1 / s, s)
+    cov['data'] = Q @ C @ Q.T
+    return cov
+
+
+def cached_noise_cov(bp, tmin=None, tmax=0, rank='info', cache_dir=None, batch_size=32):
+    """Noise covariance of the epochs of bp, from the cache or computed
+
+    Parameters
+    ----------
+    bp : mne_bids.BIDSPath | str
+        Epochs file (or the BIDSPath the pipeline passes to noise_cov)
+    tmin, tmax : float | None
+        Time window of the covariance
+    rank : str | dict | None
+        Rank of the noise covariance, see mne.compute_covariance
+    cache_dir : str | None
+        Directory of the cached -cov.fif files. If None, a noise_cov_cache
+        directory next to the epochs file.
+    batch_size : int
+        Number of epochs read at a time
+
+    Returns
+    -------
+    cov : mne.Covariance
+        Noise covariance
+    """
+    fname, files = _epochs_files(bp)
+    key = _cov_cache_key(files, tmin, tmax, rank)
+    if key in _cov_cache:
+        return _cov_cache[key].copy()
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(fname), 'noise_cov_cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    stem = os.path.basename(fname).removesuffix('.fif')
+    cov_fname = os.path.join(cache_dir, f'{stem}_{key}-cov.fif')
+
+    # Only one worker computes a covariance, the others wait and read it
+    with FileLock(cov_fname + '.lock'):
+        if os.path.exists(cov_fname):
+            cov = mne.read_cov(cov_fname, verbose='error')
+        else:
+            cov = compute_noise_cov(fname, tmin, tmax, rank, batch_size)
+            tmp_fname = os.path.join(cache_dir, f'{stem}_{key}.{os.getpid()}.tmp-cov.fif')
+            cov.save(tmp_fname, overwrite=True, verbose='error')
+            os.replace(tmp_fname, cov_fname)
+    _cov_cache[key] = cov
+    return cov.copy()
@@ -0,0 +1,338 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+from numpy.lib.format import open_memmap
+from scipy.stats import rankdata
+import numpy as np
+
+from rsa import residual_precision, rdm_movie
+
+
+# Data shared with the worker processes, set once per worker by _init_worker
+_worker_data = {}
+
+
+def _init_worker(rdm_file, model_rdms, method, evaluations):
+    _worker_data.update(
+        # Opened read-only in every worker: the pages of the file are shared
+        rdms=np.load(rdm_file, mmap_mode='r') if rdm_file is not None else None,
+        model_rdms=model_rdms,
+        method=method,
+        evaluations=evaluations
+    )
+
+
+def compute_group_rdms(
+    load_subject,
+    subjects,
+    rdm_file,
+    method='crossnobis',
+    precision='shrinkage_diag',
+    max_bytes=None,
+    dtype=np.float32
+):
+    """RDM movies of all subjects, written into one memory-mapped array
+
+    Details
+    -------
+        - The subjects are loaded one at a time and only their RDMs are kept,
+          so the memory use is one subject's data plus the RDMs (which are
+          stored in rdm_file, a .npy file, and read back memory-mapped).
+        - The stack is written to a temporary file that replaces rdm_file
+          only once all subjects are done, so an error leaves no partial
+          rdm_file behind.
+        - The noise precision of each subject is computed from its own
+          residuals (see rsa.residual_precision).
+    Parameters
+    ----------
+        load_subject : callable
+            load_subject(subject) returns the data (n_examples, n_channels,
+            n_timepoints) and labels (n_examples) of a subject, e.g. from
+            rsa.epochs_to_rsa_data. All subjects need the same conditions
+            and timepoints.
+        subjects : list
+            Subjects passed to load_subject
+        rdm_file : str
+            .npy file of the RDM stack
+        method : str
+            'crossnobis' or 'euclidean', see rsa.rdm_movie
+        precision : str | None
+            Covariance estimator of the noise precision (see
+            rsa.residual_precision), or None for no noise normalization
+        max_bytes : int | None
+            Memory limit of rsa.rdm_movie
+        dtype : np.dtype
+            Data type of the RDM stack
+    Returns
+    -------
+        conditions : np.ndarray
+            Sorted unique labels (rows and columns of the RDMs)
+        rdms : np.memmap
+            RDM movies of shape (n_subjects, n_timepoints,
+            n_conditions*(n_conditions-1)/2), read-only
+    """
+    if len(subjects) == 0:
+        raise ValueError('No subjects')
+    tmp_file = f'{rdm_file}.{os.getpid()}.tmp.npy'
+    rdms = None
+    try:
+        for i, subject in enumerate(subjects):
+            X, y = load_subject(subject)
+            noise = residual_precision(X, y, precision) if precision is not None else None
+            subject_conditions, subject_rdms = rdm_movie(X, y, method, noise, max_bytes=max_bytes)
+            del X
+            if rdms is None:
+                conditions = subject_conditions
+                rdms = open_memmap(tmp_file, mode='w+', dtype=dtype,
+                                   shape=(len(subjects),) + subject_rdms.shape)
+            elif not np.array_equal(subject_conditions, conditions):
+                raise ValueError(f'Subject {subject} has conditions {subject_conditions}, '
+                                 f'the first subject has {conditions}')
+            elif subject_rdms.shape != rdms.shape[1:]:
+                raise ValueError(f'Subject {subject} has {subject_rdms.shape[0]} timepoints, '
+                                 f'the first subject has {rdms.shape[1]}')
+            rdms[i] = subject_rdms
+        rdms.flush()
+        del rdms
+        os.replace(tmp_file, rdm_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return conditions, np.load(rdm_file, mmap_mode='r')
+
+
+def _correlate(rdms, model_rdms, method):
+    """Similarity of RDM vectors and model RDM vectors
+
+    Parameters
+    ----------
+        rdms : np.ndarray
+            RDM vectors of shape (..., n_pairs)
+        model_rdms : np.ndarray
+            Model RDM vectors of shape (n_models, n_pairs)
+        method : str
+            'cosine', 'pearson' or 'spearman'
+    Returns
+    -------
+        similarity : np.ndarray
+            Similarities of shape (n_models, ...)
+    """
+    rdms = np.asarray(rdms, dtype=np.float64)
+    model_rdms = np.asarray(model_rdms, dtype=np.float64)
+    if method == 'spearman':
+        rdms = rankdata(rdms, axis=-1)
+        model_rdms = rankdata(model_rdms, axis=-1)
+    if method in ['pearson', 'spearman']:
+        rdms = rdms - rdms.mean(axis=-1, keepdims=True)
+        model_rdms = model_rdms - model_rdms.mean(axis=-1, keepdims=True)
+    rdms = rdms / np.linalg.norm(rdms, axis=-1, keepdims=True)
+    model_rdms = model_rdms / np.linalg.norm(model_rdms, axis=-1, keepdims=True)
+    return np.moveaxis(rdms @ model_rdms.T, -1, 0)
+
+
+def fit_models(rdms, model_rdms, method='cosine', subjects_per_batch=None):
+    """Similarity of the RDM movies of all subjects to model RDMs
+
+    Details
+    -------
+        - All subjects, timepoints and models are compared at once (one
+          matrix product after ranking, centering and normalizing the RDM
+          vectors), in batches of subjects_per_batch subjects.
+    Parameters
+    ----------
+        rdms : np.ndarray
+            RDM movies of shape (n_subjects, n_timepoints, n_pairs), e.g. from
+            compute_group_rdms
+        model_rdms : np.ndarray
+            Model RDM vectors of shape (n_models, n_pairs), in the order of
+            the RDM pairs (upper triangle of the sorted conditions)
+        method : str
+            'cosine', 'pearson' or 'spearman' (rank) correlation
+        subjects_per_batch : int | None
+            Number of subjects compared at once. If None, all subjects.
+    Returns
+    -------
+        evaluations : np.ndarray
+            Similarities of shape (n_models, n_subjects, n_timepoints)
+    """
+    assert method in ['cosine', 'pearson', 'spearman']
+    n_subjects = len(rdms)
+    batch = subjects_per_batch or n_subjects
+    evaluations = np.empty((len(model_rdms), n_subjects, rdms.shape[1]))
+    for start in range(0, n_subjects, batch):
+        stop = min(start + batch, n_subjects)
+        evaluations[:, start:stop] = _correlate(rdms[start:stop], model_rdms, method)
+    return evaluations
+
+
+def _pair_index(n_conditions):
+    """(n_conditions, n_conditions) index of each pair in the RDM vectors"""
+    index = np.full((n_conditions, n_conditions), -1)
+    rows, cols = np.triu_indices(n_conditions, k=1)
+    index[rows, cols] = index[cols, rows] = np.arange(len(rows))
+    return index
+
+
+def _bootstrap_batch(samples):
+    """Group-average evaluations of one batch of bootstrap samples
+
+    Returns
+    -------
+        boot : np.ndarray
+            Evaluations of shape (n_samples, n_models, n_timepoints)
+    """
+    rdms = _worker_data['rdms']
+    model_rdms = _worker_data['model_rdms']
+    method = _worker_data['method']
+    n_conditions = int(round((1 + np.sqrt(1 + 8 * rdms.shape[-1])) / 2))
+    pair_index = _pair_index(n_conditions)
+
+    boot = np.empty((len(samples), len(model_rdms), rdms.shape[1]))
+    for i, (subjects, conditions) in enumerate(samples):
+        # Pairs of the resampled conditions, without the pairs of a condition
+        # with its own copies
+        rows, cols = np.triu_indices(len(conditions), k=1)
+        pairs = pair_index[conditions[rows], conditions[cols]]
+        pairs = pairs[pairs >= 0]
+        evaluations = _correlate(rdms[np.unique(subjects)][..., pairs], model_rdms[:, pairs], method)
+        # Subjects drawn several times count several times
+        _, inverse = np.unique(subjects, return_inverse=True)
+        boot[i] = np.nanmean(evaluations[:, inverse.ravel()], axis=1)
+    return boot
+
+
+def bootstrap_evaluations(
+    rdm_file,
+    model_rdms,
+    method='cosine',
+    n_bootstrap=1000,
+    resample='both',
+    n_jobs=1,
+    samples_per_batch=50,
+    random_state=None
+):
+    """Bootstrap distribution of the group-average model evaluations
+
+    Details
+    -------
+        - Subjects and/or conditions are drawn with replacement. With
+          resampled conditions, the RDMs and model RDMs are restricted to the
+          pairs of the drawn conditions (as rsatoolbox's bootstrap of
+          patterns).
+        - Batches of samples are spread across n_jobs processes, which read
+          the RDM stack from rdm_file memory-mapped (shared, not copied).
+    Parameters
+    ----------
+        rdm_file : str
+            .npy file of the RDM stack (n_subjects, n_timepoints, n_pairs),
+            see compute_group_rdms
+        model_rdms : np.ndarray
+            Model RDM vectors of shape (n_models, n_pairs)
+        method : str
+            'cosine', 'pearson' or 'spearman', see fit_models
+        n_bootstrap : int
+            Number of bootstrap samples
+        resample : str
+            'subjects', 'conditions' or 'both'
+        n_jobs : int
+            Number of worker processes
+        samples_per_batch : int
+            Number of bootstrap samples computed by a worker at a time
+        random_state : None | int | np.random.Generator
+            Seed or generator used to draw the samples
+    Returns
+    -------
+        boot : np.ndarray
+            Group-average evaluations of shape (n_bootstrap, n_models,
+            n_timepoints)
+    """
+    assert resample in ['subjects', 'conditions', 'both']
+    rng = np.random.default_rng(random_state)
+    rdms = np.load(rdm_file, mmap_mode='r')
+    n_subjects, n_pairs = rdms.shape[0], rdms.shape[-1]
+    n_conditions = int(round((1 + np.sqrt(1 + 8 * n_pairs)) / 2))
+    del rdms
+
+    samples = []
+    for _ in range(n_bootstrap):
+        subjects = (rng.integers(0, n_subjects, n_subjects)
+                    if resample in ['subjects', 'both'] else np.arange(n_subjects))
+        conditions = (np.sort(rng.integers(0, n_conditions, n_conditions))
+                      if resample in ['conditions', 'both'] else np.arange(n_conditions))
+        samples.append((subjects, conditions))
+    batches = [samples[i:i + samples_per_batch] for i in range(0, n_bootstrap, samples_per_batch)]
+
+    initargs = (rdm_file, np.asarray(model_rdms, dtype=np.float64), method, None)
+    if n_jobs == 1:
+        _init_worker(*initargs)
+        results = [_bootstrap_batch(batch) for batch in batches]
+    else:
+        with ProcessPoolExecutor(n_jobs, initializer=_init_worker, initargs=initargs) as pool:
+            results = list(pool.map(_bootstrap_batch, batches))
+    return np.concatenate(results, axis=0)
+
+
+def _sign_flip_batch(flips):
+    """Group averages of the evaluations with the signs of the subjects flipped
+
+    Returns
+    -------
+        null : np.ndarray
+            Averages of shape (n_flips, n_models, n_timepoints)
+    """
+    evaluations = _worker_data['evaluations']
+    return np.einsum('ps,mst->pmt', flips, evaluations) / evaluations.shape[1]
+
+
+def sign_flip_test(
+    evaluations,
+    n_permutations=1000,
+    n_jobs=1,
+    permutations_per_batch=200,
+    random_state=None
+):
+    """Sign-flip permutation null distribution of the group-average model
+    evaluations (H0: evaluations symmetric around zero)
+
+    Details
+    -------
+        - The signs of the evaluations of every subject are flipped at random
+          (the same flips for all models and timepoints), and the flipped
+          evaluations of a batch of permutations are averaged with one einsum.
+        - Use permutation.cluster_permutation_test(mean[m], null[:, m],
+          chance=0) for a cluster-based test of model m.
+    Parameters
+    ----------
+        evaluations : np.ndarray
+            Evaluations of shape (n_models, n_subjects, n_timepoints), see
+            fit_models
+        n_permutations : int
+            Number of sign-flip permutations
+        n_jobs : int
+            Number of worker processes
+        permutations_per_batch : int
+            Number of permutations computed by a worker at a time
+        random_state : None | int | np.random.Generator
+            Seed or generator used to draw the signs
+    Returns
+    -------
+        mean : np.ndarray
+            Observed group average of shape (n_models, n_timepoints)
+        null : np.ndarray
+            Null group averages of shape (n_permutations, n_models,
+            n_timepoints)
+    """
+    rng = np.random.default_rng(random_state)
+    evaluations = np.asarray(evaluations, dtype=np.float64)
+    flips = rng.choice([-1.0, 1.0], size=(n_permutations, evaluations.shape[1]))
+    batches = [flips[i:i + permutations_per_batch]
+               for i in range(0, n_permutations, permutations_per_batch)]
+
+    initargs = (None, None, None, evaluations)
+    if n_jobs == 1:
+        _init_worker(*initargs)
+        results = [_sign_flip_batch(batch) for batch in batches]
+    else:
+        with ProcessPoolExecutor(n_jobs, initializer=_init_worker, initargs=initargs) as pool:
+            results = list(pool.map(_sign_flip_batch, batches))
+    return evaluations.mean(axis=1), np.concatenate(results, axis=0)
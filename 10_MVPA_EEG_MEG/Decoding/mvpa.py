@@ -1,53 +1,170 @@
+import os
+import hashlib
+import json
+
 import mne
 from mne.decoding import Scaler
 from mne.cov import compute_covariance, compute_whitener
 from mne.io.pick import _picks_to_idx as picks_to_idx
 
+from sklearn.base import BaseEstimator, ClassifierMixin, clone
+from sklearn.linear_model import SGDClassifier
+from sklearn.model_selection import check_cv
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler, FunctionTransformer
 
-from scipy.stats import pearsonr
+from scipy.stats import rankdata
 import numpy as np
 
 
+# In-memory cache of noise covariances and whiteners, see whiten_epochs
+_whitener_cache = {}
+
+
+def _whitener_cache_key(epochs, cov_cond_query, picks_idx, rank):
+    """Hash identifying the noise covariance and whitener of epochs
+
+    Epochs read from a file are identified by the file (path, mtime, size) and
+    the selection of epochs, so that no data is read on a cache hit. Epochs
+    without a file are identified by their baseline data.
+    """
+    cov_epochs = epochs[cov_cond_query]
+    key = hashlib.sha1()
+    key.update(repr((cov_cond_query, rank, picks_idx.tolist())).encode())
+    key.update(repr(epochs.info['ch_names']).encode())
+    key.update(repr(epochs.info['bads']).encode())
+    key.update(repr([(p['desc'], p['active']) for p in epochs.info['projs']]).encode())
+    key.update(np.ascontiguousarray(epochs.times).tobytes())
+    key.update(np.ascontiguousarray(cov_epochs.events).tobytes())
+    key.update(np.ascontiguousarray(cov_epochs.selection).tobytes())
+    # Processing after reading (filtering, resampling, baseline correction)
+    key.update(repr((epochs.info['sfreq'], epochs.info['highpass'],
+                     epochs.info['lowpass'], epochs.baseline)).encode())
+    fname = getattr(epochs, 'filename', None)
+    if fname is not None and os.path.exists(fname):
+        stat = os.stat(fname)
+        key.update(repr((os.path.abspath(fname), stat.st_mtime, stat.st_size)).encode())
+    else:
+        # The baseline data is all the covariance is estimated from
+        key.update(np.ascontiguousarray(cov_epochs.get_data(tmax=0)).tobytes())
+    return key.hexdigest()
+
+
+def _get_noise_cov_whitener(epochs, cov_cond_query, picks_idx, rank, cache_dir):
+    """Get the noise covariance and whitener from the cache or compute them"""
+    key = _whitener_cache_key(epochs, cov_cond_query, picks_idx, rank)
+    if key in _whitener_cache:
+        return _whitener_cache[key]
+
+    if cache_dir is not None:
+        cov_fname = os.path.join(cache_dir, f'whitener_{key}-cov.fif')
+        W_fname = os.path.join(cache_dir, f'whitener_{key}.npy')
+        if os.path.exists(cov_fname) and os.path.exists(W_fname):
+            _whitener_cache[key] = (mne.read_cov(cov_fname), np.load(W_fname))
+            return _whitener_cache[key]
+
+    # Compute covariance matrix based on the baseline of the written epochs
+    noise_cov = compute_covariance(
+        epochs[cov_cond_query],
+        tmin=None,
+        tmax=0,
+        method='ledoit_wolf',
+        n_jobs=None,
+        projs=None,
+        rank=rank
+    )
+    # Compute whitener, choosing the best covariance estimator
+    W, _ = compute_whitener(noise_cov,
+                            epochs.info,
+                            picks=picks_idx,
+                            pca=True
+    )
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        noise_cov.save(cov_fname, overwrite=True)
+        np.save(W_fname, W)
+    _whitener_cache[key] = (noise_cov, W)
+    return _whitener_cache[key]
+
+
+def compute_epochs_whitener(
+    epochs,
+    cov_cond_query,
+    picks=['mag', 'grad', 'eeg'],
+    rank='info',
+    cache_dir=None
+):
+    """Whitener of epochs, computed from the noise covariance of the baseline
+    of the epochs selected by cov_cond_query (cached, see whiten_epochs)
+
+    Returns
+    -------
+    W : numpy.array, shape (n_components, n_sensors)
+        Whitener to apply to the data of the picked channels
+    """
+    picks_idx = picks_to_idx(epochs.info, picks)
+    _, W = _get_noise_cov_whitener(epochs, cov_cond_query, picks_idx, rank, cache_dir)
+    return W
+
+
 def whiten_epochs(
     epochs,
     cov_cond_query,
     data_cond_query,
-    picks=['mag', 'grad', 'eeg']
+    picks=['mag', 'grad', 'eeg'],
+    rank='info',
+    cache_dir=None,
+    batch_size=64,
+    dtype=np.float64
 ):
     """Whiten epochs
     
+    Details
+    -------
+        - The noise covariance and the whitener are cached in memory (and in 
+          cache_dir if given), keyed by a hash of the epochs file (or the
+          baseline data of epochs without a file), selection, channels and
+          projectors of the epochs, cov_cond_query, picks and rank. 
+          Repeated calls with a different data_cond_query reuse them.
+        - The whitener is applied batch_size trials at a time, so that only
+          one batch of unwhitened data is held in memory next to the output.
     Parameters
     ----------
     epochs : mne.Epochs
         Epochs object
+    cov_cond_query : str | list
+        Query selecting the epochs used to compute the noise covariance
+    data_cond_query : str | list
+        Query selecting the epochs to whiten
+    picks : list
+        Channels to whiten
+    rank : str | dict | None
+        Rank of the noise covariance, see mne.compute_covariance
+    cache_dir : str | None
+        Directory to cache the noise covariance and whitener on disk. If None,
+        they are only cached in memory.
+    batch_size : int
+        Number of trials whitened at a time
+    dtype : np.dtype
+        Data type of the whitened data (np.float32 halves the memory)
     Returns
     -------
     data : numpy.array, shape (n_trials, n_sensors, n_time)
         Data array
     """
-    
-    # Compute covariance matrix based on the baseline of the written epochs
-    noise_cov = compute_covariance(
-        epochs[cov_cond_query],
-        tmin=None,
-        tmax=0,
-        method='ledoit_wolf',
-        n_jobs=None,
-        projs=None,
-        rank='info'
-    )
-    # Compute whitener, choosing the best covariance estimator
-    W, _ = compute_whitener(noise_cov,
-                            epochs.info,
-                            picks=picks_to_idx(epochs.info, picks),
-                            pca=True
-    )
-    # Get epochs data
-    data = epochs[data_cond_query].get_data(picks=picks_to_idx(epochs.info, picks))
-    # Apply whitener to data
-    data = (np.dot(data.swapaxes(1, 2), W.T)).swapaxes(1, 2)
+    picks_idx = picks_to_idx(epochs.info, picks)
+    W = compute_epochs_whitener(epochs, cov_cond_query, picks, rank, cache_dir)
+    W = W.astype(dtype)
+
+    # Apply whitener to data, one batch of trials at a time
+    data_epochs = epochs[data_cond_query]
+    n_trials = len(data_epochs)
+    data = np.empty((n_trials, W.shape[0], len(epochs.times)), dtype=dtype)
+    for start in range(0, n_trials, batch_size):
+        stop = min(start + batch_size, n_trials)
+        batch = data_epochs.get_data(picks=picks_idx, item=slice(start, stop))
+        np.matmul(W, batch.astype(dtype, copy=False), out=data[start:stop])
 
     return data
 
@@ -55,7 +172,8 @@ def whiten_epochs(
 def windowizer(
     X,
     window_size=10,
-    win_func='expand_features'
+    win_func='expand_features',
+    copy=True
 ):
     """Windowizer function to create a sliding window of size window_size
     over the last dimension of the input data X.
@@ -76,20 +194,57 @@ def windowizer(
             (n_examples, n_features*window_size, n_timepoints-window_size+1)
         - 'mean'computes the moving average of the data across the timepoints 
             separately for each example. The output shape is 
-            (n_examples, n_features, n_timepoints-window_size)
+            (n_examples, n_features, n_timepoints-window_size+1)
+    copy : bool
+        Only used with 'expand_features'. If True (default), the windows are
+        written into a single new array of the shape given above. If False, a
+        read-only strided view of the same shape is returned instead, so that
+        the windows are not copied (only X, once, if its timepoints are not
+        already its slowest-varying axis after the examples). Strides cannot
+        put the features in the order of copy=True, so in the view they are
+        ordered by lag: the n_features features at the first timepoint of the
+        window, then at the second, etc. Classifiers fitted at every
+        timepoint give the same scores, but their weights are permuted.
+    Returns
+    -------
+    X_win : np.ndarray
+        Windowed data (see win_func and copy for the shape).
     """
 
     assert win_func in ['expand_features', 'mean']
-    
-    X_win = []
-    for i in range(0, X.shape[-1]-window_size+1):
-        temp = X[:, :, i:i+window_size]
-        if win_func == 'expand_features':
-            temp = np.reshape(temp, (temp.shape[0], -1))
-        elif win_func == 'mean':
-            temp = np.mean(temp, axis=-1)
-        X_win.append(np.expand_dims(temp, axis=-1))
-    X_win = np.concatenate(X_win, axis=-1)
+    n_times = X.shape[-1]
+    assert 0 < window_size <= n_times, 'window_size must be in [1, n_timepoints]'
+
+    if win_func == 'expand_features' and copy:
+        # (n_examples, n_features, n_windows, window_size) view without copying,
+        # moved to (n_examples, n_features, window_size, n_windows) so that
+        # features vary slowest and the window fastest once flattened
+        X_win = np.moveaxis(
+            np.lib.stride_tricks.sliding_window_view(X, window_size, axis=-1),
+            -1, -2
+        )
+        X_win = X_win.reshape(X.shape[:-2] + (-1, X_win.shape[-1]))
+    elif win_func == 'expand_features':
+        # In time-major memory (n_examples, n_timepoints, n_features), feature
+        # k = lag*n_features + feature of window t is at offset k + t*n_features:
+        # one stride for the features and one for the windows
+        X_t = np.ascontiguousarray(np.swapaxes(X, -1, -2))
+        n_features = X.shape[-2]
+        X_win = np.lib.stride_tricks.as_strided(
+            X_t,
+            shape=X.shape[:-2] + (n_features*window_size, n_times - window_size + 1),
+            strides=X_t.strides[:-2] + (X_t.strides[-1], X_t.strides[-2]),
+            writeable=False
+        )
+    elif win_func == 'mean':
+        # Moving average from the difference of cumulative sums, O(n_timepoints)
+        # regardless of the window size
+        dtype = X.dtype if np.issubdtype(X.dtype, np.floating) else np.float64
+        csum = np.zeros(X.shape[:-1] + (n_times + 1,), dtype=np.float64)
+        np.cumsum(X, axis=-1, dtype=np.float64, out=csum[..., 1:])
+        X_win = csum[..., window_size:] - csum[..., :-window_size]
+        X_win /= window_size
+        X_win = X_win.astype(dtype, copy=False)
 
     return X_win
 
@@ -97,11 +252,19 @@ def windowizer(
 def pseudotrial_generator(
     X,
     y,
-    n_trials_to_average=8
+    n_trials_to_average=8,
+    n_repetitions=None,
+    random_state=None
 ):
     """Function to average the examples of each condition in X and y into
     evoked responses based on the number of examples to average.
-    
+
+    Details
+    -------
+        - The examples of each condition are shuffled and dealt into
+          ceil(n_examples/n_trials_to_average) groups, which are then averaged.
+        - All groups (and all repetitions) are averaged at once by multiplying
+          the data with a (n_evoked, n_examples) averaging matrix.
     Parameters
     ----------
         X : np.ndarray
@@ -111,46 +274,71 @@ def pseudotrial_generator(
         n_trials_to_average : int
             Number of examples to average from the same condition to create the 
             evoked response.
+        n_repetitions : int | None
+            If None (default), a single set of pseudotrials is returned. 
+            Otherwise, n_repetitions independently shuffled sets are computed 
+            in one go and stacked along a new first axis.
+        random_state : None | int | np.random.Generator
+            Seed or generator used to shuffle the examples.
     Returns
     -------
         X_avg : np.ndarray
-            Averaged data of shape (n_evoked, n_features, n_timepoints)
+            Averaged data of shape (n_evoked, n_features, n_timepoints), or 
+            (n_repetitions, n_evoked, n_features, n_timepoints) if 
+            n_repetitions is given
         y_avg : np.ndarray
-            Labels of the averaged data of shape (n_evoked)
-    """
-    labels, label_ind = np.unique(y, return_inverse=True)
-    X_avg = []
-    y_avg = []
-    # Loop around conditions (labels)
-    for i in range(len(labels)):
-        # select indices of the current condition and shuffle them
-        temp = np.squeeze(np.argwhere(label_ind == i))
-        np.random.shuffle(temp)
-        # compute the number of examples after averaging given the number of examples to average
-        n_avg_examples = int(np.ceil(len(temp)/n_trials_to_average))
-        # select the indices of the examples to average
-        # create index for averaging based on the modulo of the number of averaged examples
-        temp_ind = np.array([j%n_avg_examples for j in range(0, len(temp))])
-        avg_ind = [temp[np.squeeze(np.argwhere(temp_ind == j))] for j in range(n_avg_examples)]
-        # Average the examples based on the computed indices
-        for ind in avg_ind:
-            X_avg.append(np.mean(X[ind], axis=0, keepdims=True))
-            y_avg.append(labels[i])
-    X_avg = np.concatenate(X_avg, axis=0)
-    y_avg = np.array(y_avg)
+            Labels of the averaged data of shape (n_evoked). The labels are the
+            same for every repetition.
+    """
+    rng = np.random.default_rng(random_state)
+    labels, label_ind, label_counts = np.unique(
+        y, return_inverse=True, return_counts=True)
+    label_ind = label_ind.ravel()
+    n_examples = len(label_ind)
+    # Number of evoked responses per condition and their offsets in the output
+    n_avg_examples = np.ceil(label_counts / n_trials_to_average).astype(int)
+    avg_offsets = np.concatenate([[0], np.cumsum(n_avg_examples)[:-1]])
+    label_offsets = np.concatenate([[0], np.cumsum(label_counts)[:-1]])
+    n_evoked = n_avg_examples.sum()
+    y_avg = np.repeat(labels, n_avg_examples)
+
+    n_rep = 1 if n_repetitions is None else n_repetitions
+    dtype = X.dtype if np.issubdtype(X.dtype, np.floating) else np.float64
+    avg_matrix = np.zeros((n_rep, n_evoked, n_examples), dtype=dtype)
+    for rep in range(n_rep):
+        # Shuffle the examples within each condition: sort by condition first
+        # and by a random key second
+        order = np.lexsort((rng.random(n_examples), label_ind))
+        # Position of each example within its (shuffled) condition, and the
+        # evoked response it belongs to (modulo of the number of averages)
+        sorted_labels = label_ind[order]
+        position = np.arange(n_examples) - label_offsets[sorted_labels]
+        avg_ind = avg_offsets[sorted_labels] + position % n_avg_examples[sorted_labels]
+        avg_matrix[rep, avg_ind, order] = 1
+    avg_matrix /= avg_matrix.sum(axis=-1, keepdims=True)
+
+    # Average the examples of all groups and repetitions with one matmul
+    X_avg = np.matmul(avg_matrix, X.reshape(n_examples, -1).astype(dtype, copy=False))
+    X_avg = X_avg.reshape((n_rep, n_evoked) + X.shape[1:])
+    if n_repetitions is None:
+        X_avg = X_avg[0]
     return X_avg, y_avg
 
 
 def over_sample(
     X,
     y,
-    factor=10
+    factor=10,
+    mode='data',
+    random_state=None
 ):
     """Function to over-sample the data by a factor
     Details
     -------
         - The function over-samples the data by randomly selecting examples 
           from each condition with replacement
+        - With mode='indices' or mode='weights' the over-sampled array is 
+          never created, which keeps the memory use at the size of X
     Parameters
     ----------
         X : np.ndarray
@@ -159,41 +347,903 @@ def over_sample(
             Labels of the input data of shape (n_examples)
         factor : int
             Factor to over-sample the data by
+        mode : str
+            What to return. Options are 'data', 'indices' or 'weights'.
+            - 'data' returns the over-sampled data and labels
+            - 'indices' returns the indices of the selected examples and their
+              labels, so that X[indices[start:stop]] can be gathered batch by 
+              batch
+            - 'weights' returns how many times each example was selected, to
+              be passed as sample_weight to the classifier instead of 
+              duplicating the examples
+        random_state : None | int | np.random.Generator
+            Seed or generator used to select the examples.
     Returns
     -------
         X_over : np.ndarray
             Over-sampled data of shape (n_examples*factor, n_features, n_timepoints)
+            (mode='data'), or indices of the selected examples of shape 
+            (n_examples*factor) (mode='indices')
         y_over : np.ndarray
             Labels of the over-sampled data of shape (n_examples*factor)
+            (mode='data' and mode='indices')
+        sample_weight : np.ndarray
+            Number of times each example was selected, of shape (n_examples)
+            (only returned with mode='weights')
     """
-    X_over = []
-    y_over = []
-    for ui in np.unique(y):
-        temp = np.squeeze(np.argwhere(y == ui))
-        temp = np.random.choice(temp, size=factor*len(temp))
-        X_over.append(X[temp])
-        y_over.append(y[temp])
-    X_over = np.concatenate(X_over, axis=0)
-    y_over = np.concatenate(y_over, axis=0)
+    assert mode in ['data', 'indices', 'weights']
+    rng = np.random.default_rng(random_state)
+    _, label_ind, label_counts = np.unique(
+        y, return_inverse=True, return_counts=True)
+    label_ind = label_ind.ravel()
+    # Indices of the examples grouped by condition
+    order = np.argsort(label_ind, kind='stable')
+    label_offsets = np.concatenate([[0], np.cumsum(label_counts)[:-1]])
+    # Draw factor*n_examples of each condition with replacement, one 
+    # condition after the other
+    draw_labels = np.repeat(np.arange(len(label_counts)), factor*label_counts)
+    draw_pos = (rng.random(len(draw_labels))*label_counts[draw_labels]).astype(int)
+    indices = order[label_offsets[draw_labels] + draw_pos]
+
+    if mode == 'weights':
+        return np.bincount(indices, minlength=len(label_ind))
+    y_over = y[indices]
+    if mode == 'indices':
+        return indices, y_over
+    X_over = X[indices]
     return X_over, y_over
 
 
-def pearsonr_score(y, y_pred):
-    """Custom score function based on the Pearson correlation coefficient"""
-    return pearsonr(y, y_pred)[0]
+def pearsonr_score(y, y_pred, multioutput='raw_values'):
+    """Custom score function based on the Pearson correlation coefficient
+
+    Details
+    -------
+        - The correlation is computed along the first (examples) axis, 
+          separately for every output (and timepoint), in one pass over the 
+          centered data.
+        - Outputs where y or y_pred is constant get NaN.
+        - Use make_scorer(pearsonr_score) as scoring of sklearn or of mne's 
+          SlidingEstimator; with several outputs, pass 
+          multioutput='uniform_average' to make_scorer to get a single score.
+    Parameters
+    ----------
+        y : np.ndarray
+            True values of shape (n_examples), (n_examples, n_outputs) or 
+            (n_examples, n_outputs, n_timepoints)
+        y_pred : np.ndarray
+            Predicted values of shape y.shape, or with additional trailing 
+            axes (e.g. timepoints) against which y is broadcast
+        multioutput : str
+            'raw_values' returns one correlation per output, 'uniform_average'
+            their mean (ignoring NaN)
+    Returns
+    -------
+        r : float | np.ndarray
+            Pearson correlation of shape y_pred.shape[1:]
+    """
+    assert multioutput in ['raw_values', 'uniform_average']
+    y = np.asarray(y, dtype=np.float64)
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    y = y.reshape(y.shape + (1,)*(y_pred.ndim - y.ndim))
+    y = y - y.mean(axis=0)
+    y_pred = y_pred - y_pred.mean(axis=0)
+    num = np.sum(y * y_pred, axis=0)
+    den = np.sqrt(np.sum(y**2, axis=0) * np.sum(y_pred**2, axis=0))
+    r = np.full(np.broadcast(num, den).shape, np.nan)
+    np.divide(num, den, out=r, where=den > 0)
+    r = np.clip(r, -1, 1)
+    if multioutput == 'uniform_average':
+        return float(np.nanmean(r))
+    return r if r.ndim else float(r)
 
 
 def moving_window_preprocessor(
     moving_window_size=10,
-    moving_window_func='expand_features'
+    moving_window_func='expand_features',
+    copy=True
 ):
     # Create a pipeline with a scaler and a windowizer. The latter makes it 
     # possible to run mvpa on a sliding window of the data, instead of single 
-    # timepoints. 
+    # timepoints. With copy=False the windows are a read-only view of the
+    # scaled data, with the features ordered by lag (see windowizer).
     preprocessor = Pipeline(
         [('scaler', Scaler(scalings='mean')),
         ('windowizer', FunctionTransformer(
             windowizer,
-            kw_args={'window_size': moving_window_size, 'win_func': moving_window_func}))]
+            kw_args={'window_size': moving_window_size,
+                     'win_func': moving_window_func,
+                     'copy': copy}))]
     )
-    return preprocessor
\ No newline at end of file
+    return preprocessor
+
+
+def batched_roc_auc(y_true, y_score):
+    """Area under the ROC curve computed along the first axis of y_score
+
+    Parameters
+    ----------
+        y_true : np.ndarray
+            Binary labels of shape (n_examples), True or 1 for the positive 
+            class, or (n_examples, n_columns) for different labels for every
+            column of the last axis of y_score (e.g. label permutations)
+        y_score : np.ndarray
+            Decision values of shape (n_examples, ...)
+    Returns
+    -------
+        auc : np.ndarray
+            AUC of shape y_score.shape[1:], NaN where y_true has one class
+    """
+    y_true = np.asarray(y_true).astype(bool)
+    n_pos = y_true.sum(axis=0)
+    n_neg = len(y_true) - n_pos
+    # Mann-Whitney U statistic of the positive examples, ties get mean ranks
+    ranks = rankdata(y_score, axis=0)
+    if y_true.ndim == 1:
+        rank_sum = np.tensordot(y_true.astype(ranks.dtype), ranks, axes=(0, 0))
+    else:
+        # Align the labels with the examples and columns axes of y_score
+        y_true = y_true.reshape(y_true.shape[:1] + (1,)*(ranks.ndim - 2) + y_true.shape[1:])
+        rank_sum = np.sum(ranks * y_true, axis=0)
+    den = np.broadcast_to(n_pos*n_neg, np.shape(rank_sum))
+    auc = np.full(np.shape(rank_sum), np.nan)
+    np.divide(rank_sum - n_pos*(n_pos + 1)/2, den, out=auc, where=den > 0)
+    return auc
+
+
+def ridge_weights(Xc, Tc, alpha):
+    """Ridge weights of centered, time-major data for several target columns
+
+    Parameters
+    ----------
+        Xc : np.ndarray
+            Centered data of shape (n_times, n_examples, n_features)
+        Tc : np.ndarray
+            Centered targets of shape (n_examples, n_columns)
+        alpha : float
+            Regularization strength
+    Returns
+    -------
+        W : np.ndarray
+            Weights of shape (n_times, n_features, n_columns)
+    """
+    n_examples, n_features = Xc.shape[1:]
+    if n_examples < n_features:
+        # Dual form: W = X'(XX' + alpha*I)^-1 T
+        G = np.matmul(Xc, Xc.swapaxes(1, 2))
+        G[:, np.arange(n_examples), np.arange(n_examples)] += alpha
+        Tc = np.broadcast_to(Tc, (len(G),) + Tc.shape)
+        return np.matmul(Xc.swapaxes(1, 2), np.linalg.solve(G, Tc))
+    C = np.matmul(Xc.swapaxes(1, 2), Xc)
+    C[:, np.arange(n_features), np.arange(n_features)] += alpha
+    return np.linalg.solve(C, np.matmul(Xc.swapaxes(1, 2), Tc))
+
+
+def _ledoit_wolf_shrinkage(scatter, row_norm4, n_examples):
+    """Ledoit-Wolf shrinkage of centered data X of shape (n_batch, n_examples,
+    n_features), computed separately for each batch (as in sklearn) from its
+    sums: scatter = X'X of shape (n_batch, n_features, n_features) and
+    row_norm4 = sum of |x|^4 over the examples, of shape (n_batch)"""
+    n_features = scatter.shape[-1]
+    emp_cov_trace = np.diagonal(scatter, axis1=1, axis2=2) / n_examples
+    mu = emp_cov_trace.sum(axis=-1) / n_features
+    beta_ = row_norm4
+    delta_ = (scatter**2).sum(axis=(1, 2)) / n_examples**2
+    beta = (beta_/n_examples - delta_) / (n_features*n_examples)
+    delta = (delta_ - 2*mu*emp_cov_trace.sum(axis=-1) + n_features*mu**2) / n_features
+    beta = np.minimum(beta, delta)
+    return np.divide(beta, delta, out=np.zeros_like(delta), where=delta > 0)
+
+
+class LinearSlidingEstimator(ClassifierMixin, BaseEstimator):
+    """Closed-form linear classifier fitted separately at every timepoint
+
+    A fast alternative to mne's SlidingEstimator for linear models. Instead of
+    fitting one sklearn model per timepoint, the weights of all timepoints are
+    obtained with batched linear algebra on the (n_examples, n_features, 
+    n_timepoints) data. It can be passed to mne's cross_val_multiscore, which
+    then returns scores of shape (n_splits, n_timepoints).
+
+    Parameters
+    ----------
+        model : str
+            Linear model fitted at each timepoint. Options are 'lda', 
+            'shrinkage' or 'ridge'.
+            - 'lda' is linear discriminant analysis with the pooled 
+              within-class covariance (requires more examples than features)
+            - 'shrinkage' is LDA with the covariance shrunk towards a scaled
+              identity matrix
+            - 'ridge' is ridge regression of the labels (coded as +1/-1, one 
+              column per class if there are more than two)
+        alpha : float | str
+            Regularization. For 'shrinkage' the shrinkage in [0, 1], or 'auto'
+            for the Ledoit-Wolf estimate at each timepoint. For 'ridge' the 
+            regularization strength. Not used for 'lda'.
+        scale : bool
+            Whether to standardize each feature at each timepoint with the 
+            mean and standard deviation of the training data (as 
+            StandardScaler does in a SlidingEstimator pipeline).
+        scoring : str
+            'roc_auc' (two classes only) or 'accuracy'.
+        time_batch_size : int | None
+            Number of timepoints fitted at a time. Fitting LDA holds a 
+            (time_batch_size, n_features, n_features) covariance array in 
+            memory. If None, all timepoints are fitted at once.
+    Attributes
+    ----------
+        classes_ : np.ndarray
+            Class labels
+        coef_ : np.ndarray
+            Weights of shape (n_timepoints, n_features, n_classes) applied to 
+            the (scaled) data
+        intercept_ : np.ndarray
+            Intercepts of shape (n_timepoints, n_classes)
+    """
+
+    def __init__(
+        self,
+        model='shrinkage',
+        alpha='auto',
+        scale=True,
+        scoring='roc_auc',
+        time_batch_size=None
+    ):
+        self.model = model
+        self.alpha = alpha
+        self.scale = scale
+        self.scoring = scoring
+        self.time_batch_size = time_batch_size
+
+    def _scale(self, X):
+        if not self.scale:
+            return X
+        return (X - self.mean_) / self.scale_
+
+    def _fit_batch(self, X, Y):
+        """Fit the weights of time-major data X (n_times, n_examples, n_features)
+        given the one-hot labels Y (n_examples, n_classes)"""
+        if self.model == 'ridge':
+            # Targets coded as +1/-1, centered together with X to fit intercepts
+            T = 2*Y - 1
+            if T.shape[1] == 2:
+                T = T[:, 1:]
+            X_mean = X.mean(axis=1, keepdims=True)
+            T_mean = T.mean(axis=0)
+            W = ridge_weights(X - X_mean, T - T_mean, self.alpha)
+            b = T_mean - np.matmul(X_mean, W)[:, 0]
+            return W, b
+
+        # LDA: class means and pooled within-class covariance at each timepoint
+        counts = Y.sum(axis=0)
+        M = np.matmul(Y.T / counts[:, None], X)
+        Xc = X - np.matmul(Y, M)
+        row_norm4 = ((Xc**2).sum(axis=-1)**2).sum(axis=-1)
+        return self._lda_weights(np.matmul(Xc.swapaxes(1, 2), Xc), M, counts, row_norm4)
+
+    def _lda_weights(self, scatter, M, counts, row_norm4):
+        """LDA weights from the within-class scatter Xc'Xc (n_times, n_features,
+        n_features), the class means M (n_times, n_classes, n_features), the
+        class counts and the sums of |xc|^4 (n_times, see _ledoit_wolf_shrinkage)"""
+        n_examples, n_features = counts.sum(), M.shape[-1]
+        S = scatter / n_examples
+        if self.model == 'shrinkage':
+            if self.alpha == 'auto':
+                shrinkage = _ledoit_wolf_shrinkage(scatter, row_norm4, n_examples)[:, None, None]
+            else:
+                shrinkage = self.alpha
+            mu = np.trace(S, axis1=1, axis2=2)[:, None, None] / n_features
+            S *= 1 - shrinkage
+            S += shrinkage * mu * np.eye(n_features)
+        W = np.linalg.solve(S, M.swapaxes(1, 2))
+        b = -0.5*np.sum(M * W.swapaxes(1, 2), axis=-1) + np.log(counts/n_examples)
+        return W, b
+
+    def fit(self, X, y):
+        """Fit the linear model at every timepoint
+
+        Parameters
+        ----------
+            X : np.ndarray
+                Input data of shape (n_examples, n_features, n_timepoints)
+            y : np.ndarray
+                Labels of shape (n_examples)
+        Returns
+        -------
+            self : LinearSlidingEstimator
+        """
+        assert self.model in ['lda', 'shrinkage', 'ridge']
+        assert self.scoring in ['roc_auc', 'accuracy']
+        self.classes_, y_ind = np.unique(y, return_inverse=True)
+        Y = np.eye(len(self.classes_))[y_ind.ravel()]
+        X = np.asarray(X, dtype=np.float64)
+        if self.scale:
+            self.mean_ = X.mean(axis=0)
+            self.scale_ = X.std(axis=0)
+            self.scale_[self.scale_ == 0] = 1
+        # Time-major view (n_times, n_examples, n_features) for batched algebra
+        X = self._scale(X).transpose(2, 0, 1)
+        n_times = X.shape[0]
+        batch_size = n_times if self.time_batch_size is None else self.time_batch_size
+        coef, intercept = [], []
+        for start in range(0, n_times, batch_size):
+            W, b = self._fit_batch(X[start:start + batch_size], Y)
+            coef.append(W)
+            intercept.append(b)
+        self.coef_ = np.concatenate(coef, axis=0)
+        self.intercept_ = np.concatenate(intercept, axis=0)
+        return self
+
+    def fit_batches(self, batches):
+        """Same fit as fit, from data read one batch of examples at a time
+
+        Details
+        -------
+            - The fit only needs sums over the examples. A first pass over the
+              batches accumulates the labels and the mean and variance of
+              every feature at every timepoint, overall and per class
+              (merged batch by batch); a second pass, repeated for every
+              time batch, accumulates the scatter matrices of the centered
+              (and scaled) data. The weights are then those of fit on all
+              examples at once, up to rounding errors.
+        Parameters
+        ----------
+            batches : callable
+                batches() returns a new iterator of (X_batch, y_batch), with
+                X_batch of shape (n_batch, n_features, n_timepoints)
+        Returns
+        -------
+            self : LinearSlidingEstimator
+        """
+        assert self.model in ['lda', 'shrinkage', 'ridge']
+        assert self.scoring in ['roc_auc', 'accuracy']
+        n, mean, m2, class_sums, class_counts = 0, 0, 0, {}, {}
+        for X, y in batches():
+            X, y = np.asarray(X, dtype=np.float64), np.asarray(y)
+            n_batch = len(X)
+            batch_mean = X.mean(axis=0)
+            delta = batch_mean - mean
+            m2 = m2 + ((X - batch_mean)**2).sum(axis=0) + delta**2 * n*n_batch/(n + n_batch)
+            mean = mean + delta * n_batch/(n + n_batch)
+            n += n_batch
+            for label in np.unique(y):
+                class_sums[label] = class_sums.get(label, 0) + X[y == label].sum(axis=0)
+                class_counts[label] = class_counts.get(label, 0) + np.sum(y == label)
+        self.classes_ = np.array(sorted(class_sums))
+        counts = np.array([class_counts[c] for c in self.classes_], dtype=np.float64)
+        if self.scale:
+            self.mean_ = mean
+            self.scale_ = np.sqrt(m2 / n)
+            self.scale_[self.scale_ == 0] = 1
+        # Time-major overall and class means of the scaled data
+        X_mean = self._scale(mean).T
+        M = self._scale(np.stack([class_sums[c] for c in self.classes_]) / counts[:, None, None])
+        M = M.transpose(2, 0, 1)
+        if self.model == 'ridge':
+            # Targets coded as +1/-1 (see _fit_batch)
+            T_mean = 2*counts/n - 1
+            if len(self.classes_) == 2:
+                T_mean = T_mean[1:]
+
+        n_times = X_mean.shape[0]
+        batch_size = n_times if self.time_batch_size is None else self.time_batch_size
+        coef, intercept = [], []
+        for start in range(0, n_times, batch_size):
+            times = slice(start, start + batch_size)
+            scatter, cross, row_norm4 = 0, 0, 0
+            for X, y in batches():
+                X = np.asarray(X, dtype=np.float64)[..., times]
+                if self.scale:
+                    X = (X - self.mean_[:, times]) / self.scale_[:, times]
+                X = X.transpose(2, 0, 1)
+                Y = (np.asarray(y)[:, None] == self.classes_).astype(np.float64)
+                if self.model == 'ridge':
+                    Xc = X - X_mean[times, None]
+                    T = 2*Y - 1
+                    if T.shape[1] == 2:
+                        T = T[:, 1:]
+                    cross = cross + np.matmul(Xc.swapaxes(1, 2), T - T_mean)
+                else:
+                    Xc = X - np.matmul(Y, M[times])
+                    row_norm4 = row_norm4 + ((Xc**2).sum(axis=-1)**2).sum(axis=-1)
+                scatter = scatter + np.matmul(Xc.swapaxes(1, 2), Xc)
+            if self.model == 'ridge':
+                n_features = scatter.shape[-1]
+                scatter[:, np.arange(n_features), np.arange(n_features)] += self.alpha
+                W = np.linalg.solve(scatter, cross)
+                b = T_mean - np.matmul(X_mean[times, None], W)[:, 0]
+            else:
+                W, b = self._lda_weights(scatter, M[times], counts, row_norm4)
+            coef.append(W)
+            intercept.append(b)
+        self.coef_ = np.concatenate(coef, axis=0)
+        self.intercept_ = np.concatenate(intercept, axis=0)
+        return self
+
+    def decision_function(self, X):
+        """Decision values at every timepoint
+
+        Returns
+        -------
+            y_score : np.ndarray
+                Decision values of shape (n_examples, n_timepoints) for two
+                classes (positive for classes_[1]), or (n_examples, 
+                n_timepoints, n_classes) otherwise
+        """
+        X = self._scale(np.asarray(X, dtype=np.float64)).transpose(2, 0, 1)
+        y_score = (np.matmul(X, self.coef_) + self.intercept_[:, None, :]).swapaxes(0, 1)
+        if len(self.classes_) == 2:
+            if y_score.shape[-1] == 1:
+                return y_score[..., 0]
+            return y_score[..., 1] - y_score[..., 0]
+        return y_score
+
+    def predict(self, X):
+        """Predicted labels of shape (n_examples, n_timepoints)"""
+        y_score = self.decision_function(X)
+        if y_score.ndim == 2:
+            return self.classes_[(y_score > 0).astype(int)]
+        return self.classes_[np.argmax(y_score, axis=-1)]
+
+    def score(self, X, y):
+        """Score of shape (n_timepoints) at every timepoint (see scoring)"""
+        if self.scoring == 'roc_auc':
+            assert len(self.classes_) == 2, "roc_auc requires two classes"
+            return batched_roc_auc(y == self.classes_[1], self.decision_function(X))
+        return np.mean(self.predict(X) == np.asarray(y)[:, None], axis=0)
+
+
+def get_linear_weights(estimator):
+    """Get the weights of a fitted time-resolved linear classifier, mapped
+    back to the space of the unscaled data
+
+    Parameters
+    ----------
+        estimator : LinearSlidingEstimator | mne.decoding.SlidingEstimator
+            Fitted estimator. The steps of a SlidingEstimator's base estimator
+            must be StandardScaler's followed by a linear classifier with coef_
+            and intercept_ (optionally wrapped in mne's LinearModel).
+    Returns
+    -------
+        coef : np.ndarray
+            Weights of shape (n_timepoints, n_features, n_outputs). n_outputs
+            is 1 for two classes (positive for classes[1]) and n_classes 
+            otherwise.
+        intercept : np.ndarray
+            Intercepts of shape (n_timepoints, n_outputs)
+        classes : np.ndarray
+            Class labels
+    """
+    if isinstance(estimator, LinearSlidingEstimator):
+        coef, intercept = estimator.coef_, estimator.intercept_
+        if estimator.scale:
+            # Fold the scaling into the weights: w'(x - m)/s = (w/s)'x - w'(m/s)
+            scale = estimator.scale_.T[:, :, None]
+            coef = coef / scale
+            intercept = intercept - np.sum(coef * estimator.mean_.T[:, :, None], axis=1)
+        if len(estimator.classes_) == 2 and coef.shape[-1] == 2:
+            coef = coef[..., 1:] - coef[..., :1]
+            intercept = intercept[:, 1:] - intercept[:, :1]
+        return coef, intercept, estimator.classes_
+
+    coef, intercept = [], []
+    for est in estimator.estimators_:
+        steps = est.steps if isinstance(est, Pipeline) else [(None, est)]
+        clf = steps[-1][1]
+        # mne's LinearModel keeps the fitted model in model_ (model in older versions)
+        clf = getattr(clf, 'model_', getattr(clf, 'model', clf))
+        if not (hasattr(clf, 'coef_') and hasattr(clf, 'intercept_')):
+            raise ValueError(f'{type(clf).__name__} is not a linear model with coef_ and intercept_')
+        w = np.atleast_2d(clf.coef_).T.astype(np.float64)
+        b = np.atleast_1d(clf.intercept_).astype(np.float64)
+        for _, step in steps[-2::-1]:
+            if not isinstance(step, StandardScaler):
+                raise ValueError(f'Cannot map the weights through {type(step).__name__}')
+            if step.scale_ is not None:
+                w = w / step.scale_[:, None]
+            if step.mean_ is not None:
+                b = b - step.mean_ @ w
+        coef.append(w)
+        intercept.append(b)
+    return np.stack(coef), np.stack(intercept), estimator.classes_
+
+
+def generalization_scores(
+    estimator,
+    X,
+    y,
+    scoring='roc_auc',
+    max_memory_mb=512
+):
+    """Temporal generalization scores of a fitted linear time-resolved 
+    classifier, computed directly from its weights
+
+    Details
+    -------
+        - The decision values of all training timepoints on all testing 
+          timepoints are a single tensor contraction of the weights 
+          (n_train_times, n_features) with X (n_examples, n_features, 
+          n_test_times). This is evaluated for chunks of training timepoints
+          with matmul, so that no more than about max_memory_mb is used.
+        - The result is the same as the score of mne's GeneralizingEstimator 
+          fitted with the same base estimator.
+    Parameters
+    ----------
+        estimator : LinearSlidingEstimator | mne.decoding.SlidingEstimator
+            Fitted linear estimator (see get_linear_weights)
+        X : np.ndarray
+            Test data of shape (n_examples, n_features, n_test_times)
+        y : np.ndarray
+            Test labels of shape (n_examples)
+        scoring : str
+            'roc_auc' (two classes only) or 'accuracy'
+        max_memory_mb : float
+            Approximate memory cap for the decision values and their ranks
+    Returns
+    -------
+        scores : np.ndarray
+            Scores of shape (n_train_times, n_test_times)
+    """
+    assert scoring in ['roc_auc', 'accuracy']
+    coef, intercept, classes = get_linear_weights(estimator)
+    n_train_times, _, n_outputs = coef.shape
+    X = np.asarray(X, dtype=np.float64)
+    n_examples, _, n_test_times = X.shape
+    y = np.asarray(y)
+    if scoring == 'roc_auc':
+        assert len(classes) == 2, "roc_auc requires two classes"
+        y_true = y == classes[1]
+
+    # Decision values and their ranks (or argmax) take ~3 arrays of 
+    # (n_examples, chunk, n_test_times, n_outputs) float64
+    bytes_per_train_time = 3 * 8 * n_examples * n_test_times * n_outputs
+    chunk = int(max(1, max_memory_mb * 1024**2 // bytes_per_train_time))
+    scores = np.empty((n_train_times, n_test_times))
+    for start in range(0, n_train_times, chunk):
+        stop = min(start + chunk, n_train_times)
+        # (chunk, n_outputs, n_features) @ (n_examples, n_features, n_test_times)
+        y_score = np.matmul(coef[start:stop].swapaxes(1, 2)[:, None], X[None])
+        y_score += intercept[start:stop, None, :, None]
+        # -> (n_examples, chunk, n_test_times, n_outputs)
+        y_score = y_score.transpose(1, 0, 3, 2)
+        if scoring == 'roc_auc':
+            scores[start:stop] = batched_roc_auc(y_true, y_score[..., 0])
+        else:
+            if n_outputs == 1:
+                y_pred = classes[(y_score[..., 0] > 0).astype(int)]
+            else:
+                y_pred = classes[np.argmax(y_score, axis=-1)]
+            scores[start:stop] = np.mean(y_pred == y[:, None, None], axis=0)
+    return scores
+
+
+def cross_val_generalization(
+    estimator,
+    X,
+    y,
+    cv=5,
+    scoring='roc_auc',
+    max_memory_mb=512
+):
+    """Cross-validated temporal generalization with a linear time-resolved
+    classifier
+
+    The estimator is fitted once per split, and the full generalization 
+    matrix of the test data is computed from its weights with 
+    generalization_scores. This replaces cross_val_multiscore with a
+    GeneralizingEstimator for linear models.
+
+    Parameters
+    ----------
+        estimator : LinearSlidingEstimator | mne.decoding.SlidingEstimator
+            Linear estimator (see get_linear_weights)
+        X : np.ndarray
+            Input data of shape (n_examples, n_features, n_timepoints)
+        y : np.ndarray
+            Labels of shape (n_examples)
+        cv : int | cross-validation generator
+            Cross-validation scheme, as in cross_val_multiscore
+        scoring : str
+            'roc_auc' (two classes only) or 'accuracy'
+        max_memory_mb : float
+            Approximate memory cap, see generalization_scores
+    Returns
+    -------
+        scores : np.ndarray
+            Scores of shape (n_splits, n_timepoints, n_timepoints)
+    """
+    cv = check_cv(cv, y, classifier=True)
+    scores = []
+    for train, test in cv.split(X, y):
+        est = clone(estimator).fit(X[train], y[train])
+        scores.append(generalization_scores(est, X[test], y[test], scoring, max_memory_mb))
+    return np.stack(scores)
+
+
+class EpochsStream:
+    """Epochs data read from disk one batch of trials at a time
+
+    Parameters
+    ----------
+        source : str | mne.Epochs | np.ndarray
+            Path of a -epo.fif file (read with preload=False), an Epochs 
+            object, or an array of shape (n_examples, n_features, n_timepoints)
+            (e.g. a np.memmap).
+        y : np.ndarray | None
+            Labels of shape (n_examples). If None, the event codes of the 
+            epochs are used (required for an array source).
+        picks : list | None
+            Channels to read (Epochs only)
+        batch_size : int
+            Number of trials per batch
+        cache_fname : str | None
+            If given, the picked data of the epochs is copied once, batch by
+            batch, to this .npy file, and the batches are then read from it as
+            a memory-mapped array. An existing file is reused if its sidecar
+            (cache_fname + '.json') matches the epochs file (path, mtime,
+            size), selection, picks and times; otherwise it is rewritten.
+    """
+
+    def __init__(
+        self,
+        source,
+        y=None,
+        picks=None,
+        batch_size=32,
+        cache_fname=None
+    ):
+        if isinstance(source, (str, os.PathLike)):
+            source = mne.read_epochs(source, preload=False)
+        self.batch_size = batch_size
+        if isinstance(source, mne.BaseEpochs):
+            self.y = source.events[:, 2] if y is None else np.asarray(y)
+            self._epochs = source
+            self._picks = picks_to_idx(source.info, picks)
+            self.shape = (len(source), len(self._picks), len(source.times))
+            self._data = None
+            if cache_fname is not None:
+                self._data = self._write_cache(cache_fname)
+        else:
+            if y is None:
+                raise ValueError('y is required when source is an array')
+            self.y = np.asarray(y)
+            self._data = source
+            self.shape = source.shape
+
+    def _cache_source(self):
+        """Description of the cached data: epochs file (path, mtime, size),
+        selection of epochs, picked channels and times. None for epochs
+        without a file, whose cache is always rewritten."""
+        fname = getattr(self._epochs, 'filename', None)
+        if fname is None or not os.path.exists(fname):
+            return None
+        stat = os.stat(fname)
+        return dict(
+            fname=os.path.abspath(fname),
+            mtime=stat.st_mtime,
+            size=stat.st_size,
+            selection=hashlib.sha1(
+                np.ascontiguousarray(self._epochs.selection).tobytes()).hexdigest(),
+            picks=[self._epochs.ch_names[i] for i in self._picks],
+            times=[float(self._epochs.times[0]), float(self._epochs.times[-1]),
+                   len(self._epochs.times)],
+            shape=list(self.shape)
+        )
+
+    def _write_cache(self, fname):
+        # The sidecar describes the data in the cache, which is reused only
+        # if it comes from the same epochs file, selection and picks
+        source = self._cache_source()
+        source_fname = fname + '.json'
+        if source is not None and os.path.exists(fname) and os.path.exists(source_fname):
+            with open(source_fname) as f:
+                if json.load(f) == source:
+                    return np.load(fname, mmap_mode='r')
+        if os.path.exists(source_fname):
+            os.remove(source_fname)
+        data = np.lib.format.open_memmap(fname, mode='w+', dtype=np.float64, shape=self.shape)
+        for start in range(0, self.shape[0], self.batch_size):
+            item = slice(start, start + self.batch_size)
+            data[item] = self._epochs.get_data(picks=self._picks, item=item)
+        data.flush()
+        del data
+        if source is not None:
+            with open(source_fname, 'w') as f:
+                json.dump(source, f)
+        return np.load(fname, mmap_mode='r')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def get_batch(self, indices):
+        """Data of the trials indices, of shape (len(indices), n_features, 
+        n_timepoints)"""
+        if self._data is not None:
+            return np.asarray(self._data[indices])
+        return self._epochs.get_data(picks=self._picks, item=np.asarray(indices))
+
+    def iter_batches(self, indices=None):
+        """Yield (X_batch, y_batch) of batch_size trials from indices (all
+        trials by default), in order"""
+        if indices is None:
+            indices = np.arange(len(self))
+        for start in range(0, len(indices), self.batch_size):
+            batch = indices[start:start + self.batch_size]
+            yield self.get_batch(batch), self.y[batch]
+
+
+class StreamingSlidingEstimator(BaseEstimator):
+    """Time-resolved classifier trained on an EpochsStream, one batch of 
+    trials at a time
+
+    Every batch goes through the same steps as the in-memory pipeline: 
+    whitener (as in whiten_epochs), scaler (as mne's Scaler(scalings='mean'),
+    with the channel means and standard deviations accumulated over a first 
+    pass) and windowizer. The transformed batches are therefore the same as
+    the corresponding trials of the in-memory pipeline, and memory use is 
+    bounded by the batch size of the stream.
+
+    The classifier is fitted in one of two ways:
+        - A LinearSlidingEstimator is fitted exactly, from sums accumulated
+          over the batches (see LinearSlidingEstimator.fit_batches): the 
+          scores are those of the in-memory pipeline with the same 
+          LinearSlidingEstimator, up to rounding errors.
+        - Any other classifier (SGDClassifier() by default) is cloned for 
+          every timepoint and updated with partial_fit. Its scores only 
+          approximate those of an in-memory fit (e.g. of the demo's 
+          LogisticRegression), and depend on n_passes and the batch order.
+
+    Parameters
+    ----------
+        base_estimator : estimator | None
+            LinearSlidingEstimator, or classifier with partial_fit cloned for
+            every timepoint. Defaults to SGDClassifier().
+        whitener : np.ndarray | None
+            Whitener of shape (n_components, n_features), e.g. from 
+            compute_epochs_whitener
+        scale : bool
+            Whether to standardize each channel
+        window_size : int | None
+            If given, apply windowizer with this window size
+        win_func : str
+            Windowizer function, 'expand_features' or 'mean'
+        n_passes : int
+            Number of passes of partial_fit over the training trials (not
+            used with a LinearSlidingEstimator)
+        scoring : str
+            'roc_auc' (two classes only) or 'accuracy'
+    """
+
+    def __init__(
+        self,
+        base_estimator=None,
+        whitener=None,
+        scale=True,
+        window_size=None,
+        win_func='expand_features',
+        n_passes=1,
+        scoring='roc_auc'
+    ):
+        self.base_estimator = base_estimator
+        self.whitener = whitener
+        self.scale = scale
+        self.window_size = window_size
+        self.win_func = win_func
+        self.n_passes = n_passes
+        self.scoring = scoring
+
+    def _whiten(self, X):
+        if self.whitener is None:
+            return X
+        return np.matmul(self.whitener, X)
+
+    def transform(self, X):
+        """Apply the whitener, scaler and windowizer to a batch"""
+        X = self._whiten(X)
+        if self.scale:
+            X = (X - self.mean_[:, None]) / self.std_[:, None]
+        if self.window_size is not None:
+            X = windowizer(X, self.window_size, self.win_func)
+        return X
+
+    def fit(self, stream, indices=None):
+        """Fit the scaler and the classifiers of all timepoints
+
+        Parameters
+        ----------
+            stream : EpochsStream
+                Data source
+            indices : np.ndarray | None
+                Training trials (all trials by default)
+        Returns
+        -------
+            self : StreamingSlidingEstimator
+        """
+        if indices is None:
+            indices = np.arange(len(stream))
+        self.classes_ = np.unique(stream.y[indices])
+        if self.scale:
+            # Channel means and standard deviations over trials and time
+            n, total, total_sq = 0, 0, 0
+            for X, _ in stream.iter_batches(indices):
+                X = self._whiten(X)
+                n += X.shape[0] * X.shape[2]
+                total = total + X.sum(axis=(0, 2))
+                total_sq = total_sq + (X**2).sum(axis=(0, 2))
+            self.mean_ = total / n
+            self.std_ = np.sqrt(np.maximum(total_sq / n - self.mean_**2, 0))
+            self.std_[self.std_ == 0] = 1
+        base_estimator = SGDClassifier() if self.base_estimator is None else self.base_estimator
+        if isinstance(base_estimator, LinearSlidingEstimator):
+            self.estimator_ = clone(base_estimator).fit_batches(
+                lambda: ((self.transform(X), y) for X, y in stream.iter_batches(indices)))
+            self.estimators_ = None
+            return self
+        self.estimator_, self.estimators_ = None, None
+        for _ in range(self.n_passes):
+            for X, y in stream.iter_batches(indices):
+                X = self.transform(X)
+                if self.estimators_ is None:
+                    self.estimators_ = [clone(base_estimator) for _ in range(X.shape[-1])]
+                for t, est in enumerate(self.estimators_):
+                    est.partial_fit(X[..., t], y, classes=self.classes_)
+        return self
+
+    def decision_function(self, stream, indices=None):
+        """Decision values of shape (n_examples, n_timepoints) (two classes)"""
+        if indices is None:
+            indices = np.arange(len(stream))
+        y_score = []
+        for X, _ in stream.iter_batches(indices):
+            X = self.transform(X)
+            if self.estimator_ is not None:
+                y_score.append(self.estimator_.decision_function(X))
+                continue
+            y_score.append(np.stack(
+                [est.decision_function(X[..., t]) for t, est in enumerate(self.estimators_)],
+                axis=1))
+        return np.concatenate(y_score, axis=0)
+
+    def predict(self, stream, indices=None):
+        """Predicted labels of shape (n_examples, n_timepoints)"""
+        if indices is None:
+            indices = np.arange(len(stream))
+        y_pred = []
+        for X, _ in stream.iter_batches(indices):
+            X = self.transform(X)
+            if self.estimator_ is not None:
+                y_pred.append(self.estimator_.predict(X))
+                continue
+            y_pred.append(np.stack(
+                [est.predict(X[..., t]) for t, est in enumerate(self.estimators_)],
+                axis=1))
+        return np.concatenate(y_pred, axis=0)
+
+    def score(self, stream, indices=None):
+        """Score of shape (n_timepoints) (see scoring)"""
+        if indices is None:
+            indices = np.arange(len(stream))
+        y = stream.y[indices]
+        if self.scoring == 'roc_auc':
+            assert len(self.classes_) == 2, "roc_auc requires two classes"
+            return batched_roc_auc(y == self.classes_[1], self.decision_function(stream, indices))
+        return np.mean(self.predict(stream, indices) == y[:, None], axis=0)
+
+
+def cross_val_stream(
+    estimator,
+    stream,
+    cv=5
+):
+    """Cross-validated scores of a StreamingSlidingEstimator
+
+    Returns
+    -------
+        scores : np.ndarray
+            Scores of shape (n_splits, n_timepoints)
+    """
+    cv = check_cv(cv, stream.y, classifier=True)
+    scores = []
+    for train, test in cv.split(np.zeros(len(stream)), stream.y):
+        est = clone(estimator).fit(stream, train)
+        scores.append(est.score(stream, test))
+    return np.stack(scores)
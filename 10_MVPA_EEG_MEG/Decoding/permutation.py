@@ -0,0 +1,278 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from sklearn.model_selection import check_cv
+
+from scipy.ndimage import label as label_clusters
+import numpy as np
+
+from mvpa import batched_roc_auc, ridge_weights
+
+
+# Data shared with the worker processes, set once per worker by _init_worker
+_worker_data = {}
+
+
+def _init_worker(X, y_code, splits, alpha, generalization, time_batch_size,
+                 max_memory_mb):
+    _worker_data.update(
+        X=X,
+        y_code=y_code,
+        splits=splits,
+        alpha=alpha,
+        generalization=generalization,
+        time_batch_size=time_batch_size,
+        max_memory_mb=max_memory_mb
+    )
+
+
+def _time_batch_size(n_times, n_test, n_perms, generalization, max_memory_mb):
+    """Number of training timepoints scored at once so that the decision
+    values and their ranks (~3 float64 arrays) stay below max_memory_mb"""
+    bytes_per_time = 3 * 8 * n_test * n_perms * (n_times if generalization else 1)
+    return int(min(n_times, max(1, max_memory_mb * 1024**2 // bytes_per_time)))
+
+
+def _permutation_batch(perms):
+    """Cross-validated scores of one batch of label permutations
+
+    Returns
+    -------
+        scores : np.ndarray
+            Scores of shape (n_perms, n_times) or (n_perms, n_times, n_times)
+    """
+    X = _worker_data['X']
+    y_code = _worker_data['y_code']
+    alpha = _worker_data['alpha']
+    generalization = _worker_data['generalization']
+    splits = _worker_data['splits']
+    n_times = X.shape[-1]
+    time_batch_size = _worker_data['time_batch_size']
+    if time_batch_size is None:
+        time_batch_size = _time_batch_size(
+            n_times, max(len(test) for _, test in splits), len(perms), generalization,
+            _worker_data['max_memory_mb']
+        )
+
+    # Permuted +1/-1 labels, one column per permutation
+    Y = y_code[perms].T
+    shape = (len(perms), n_times, n_times) if generalization else (len(perms), n_times)
+    # Sum and number of the splits with both classes in the test labels (the
+    # AUC of a split whose permuted test labels have a single class is NaN)
+    scores = np.zeros(shape)
+    n_valid = np.zeros(shape)
+    for train, test in splits:
+        # Standardize each feature at each timepoint with the training data
+        mean = X[train].mean(axis=0)
+        scale = X[train].std(axis=0)
+        scale[scale == 0] = 1
+        X_train = ((X[train] - mean) / scale).transpose(2, 0, 1)
+        y_test = Y[test] > 0
+        for start in range(0, n_times, time_batch_size):
+            stop = min(start + time_batch_size, n_times)
+            # Weights of all permutations: (n_batch_times, n_features, n_perms)
+            # (X_train is centered, so the targets need not be)
+            W = ridge_weights(X_train[start:stop], Y[train], alpha)
+            if generalization:
+                # The model of each training time scales the data of every
+                # testing time with its own statistics: fold the scale into the
+                # weights (the offset does not change the AUC)
+                W /= scale[:, start:stop].T[:, :, None]
+                # (n_test, n_batch_times, n_test_times, n_perms)
+                y_score = np.einsum('nfs,tfp->ntsp', X[test], W, optimize=True)
+                auc = np.moveaxis(batched_roc_auc(y_test, y_score), -1, 0)
+            else:
+                # (n_test, n_batch_times, n_perms)
+                X_test = (X[test][..., start:stop] - mean[:, start:stop]) / scale[:, start:stop]
+                y_score = np.matmul(X_test.transpose(2, 0, 1), W).swapaxes(0, 1)
+                auc = batched_roc_auc(y_test, y_score).T
+            valid = ~np.isnan(auc)
+            scores[:, start:stop] += np.where(valid, auc, 0)
+            n_valid[:, start:stop] += valid
+    with np.errstate(invalid='ignore'):
+        return scores / n_valid
+
+
+def permutation_decoding(
+    X,
+    y,
+    cv=5,
+    n_permutations=1000,
+    alpha=1.0,
+    generalization=False,
+    n_jobs=1,
+    permutations_per_batch=100,
+    time_batch_size=None,
+    max_memory_mb=512,
+    random_state=None
+):
+    """Label-permutation null distribution of time-resolved decoding scores
+
+    Details
+    -------
+        - The classifier is the closed-form ridge classifier of
+          mvpa.LinearSlidingEstimator(model='ridge', alpha=alpha), scored with
+          ROC AUC. With two classes, the AUC of LDA is obtained with alpha=0
+          (the LDA weights are proportional to the ridge weights without
+          regularization), which requires more training examples than
+          features.
+        - The training data enters the weights only through (X'X + alpha*I),
+          so the weights of a whole batch of permutations are one batched
+          solve with a (n_examples, n_permutations) right-hand side.
+        - Batches of permutations are spread across n_jobs processes.
+        - The same cross-validation splits are used for all permutations.
+          A split whose permuted test labels have a single class has no AUC
+          and is left out of the average of that permutation.
+    Parameters
+    ----------
+        X : np.ndarray
+            Input data of shape (n_examples, n_features, n_timepoints)
+        y : np.ndarray
+            Labels of shape (n_examples), two classes
+        cv : int | cross-validation generator
+            Cross-validation scheme, as in cross_val_multiscore
+        n_permutations : int
+            Number of label permutations
+        alpha : float
+            Ridge regularization strength
+        generalization : bool
+            If True, score the temporal generalization matrix instead of the
+            time-resolved scores
+        n_jobs : int
+            Number of worker processes
+        permutations_per_batch : int
+            Number of permutations computed at once by each worker
+        time_batch_size : int | None
+            Number of training timepoints fitted at once. If None, derived
+            from max_memory_mb.
+        max_memory_mb : float
+            Approximate memory cap per worker for the decision values and
+            their ranks, used if time_batch_size is None
+        random_state : None | int | np.random.Generator
+            Seed or generator used to permute the labels
+    Returns
+    -------
+        scores : np.ndarray
+            Observed scores averaged across splits, of shape (n_timepoints) or
+            (n_timepoints, n_timepoints) if generalization is True
+        null_scores : np.ndarray
+            Scores of the permuted labels, of shape (n_permutations, ...)
+    """
+    rng = np.random.default_rng(random_state)
+    classes = np.unique(y)
+    assert len(classes) == 2, "permutation_decoding requires two classes"
+    X = np.asarray(X, dtype=np.float64)
+    y_code = np.where(y == classes[1], 1.0, -1.0)
+    splits = list(check_cv(cv, y, classifier=True).split(X, y))
+    # The first "permutation" is the identity and gives the observed scores
+    n_examples = len(y)
+    perms = np.vstack(
+        [np.arange(n_examples)] +
+        [rng.permutation(n_examples) for _ in range(n_permutations)]
+    )
+    batches = np.array_split(perms, max(1, int(np.ceil(len(perms) / permutations_per_batch))))
+
+    initargs = (X, y_code, splits, alpha, generalization, time_batch_size, max_memory_mb)
+    if n_jobs == 1:
+        _init_worker(*initargs)
+        results = [_permutation_batch(batch) for batch in batches]
+    else:
+        with ProcessPoolExecutor(n_jobs, initializer=_init_worker, initargs=initargs) as pool:
+            results = list(pool.map(_permutation_batch, batches))
+    scores = np.concatenate(results, axis=0)
+    return scores[0], scores[1:]
+
+
+def group_null_distribution(
+    null_scores,
+    n_samples=1000,
+    random_state=None
+):
+    """Null distribution of group-average scores
+
+    Each sample averages one randomly drawn permutation of every subject
+    (Stelzer et al., 2013).
+
+    Parameters
+    ----------
+        null_scores : np.ndarray
+            Permutation scores of all subjects, of shape (n_subjects,
+            n_permutations, ...)
+        n_samples : int
+            Number of group-level null samples
+        random_state : None | int | np.random.Generator
+            Seed or generator used to draw the permutations
+    Returns
+    -------
+        group_null : np.ndarray
+            Group-average null scores of shape (n_samples, ...)
+    """
+    rng = np.random.default_rng(random_state)
+    n_subjects, n_permutations = null_scores.shape[:2]
+    draws = rng.integers(0, n_permutations, size=(n_samples, n_subjects))
+    return null_scores[np.arange(n_subjects), draws].mean(axis=1)
+
+
+def cluster_permutation_test(
+    scores,
+    null_scores,
+    chance=0.5,
+    threshold=None,
+    p_threshold=None
+):
+    """Cluster-based permutation test of decoding scores against a
+    permutation null distribution
+
+    Details
+    -------
+        - Timepoints (or train/test timepoint pairs of a temporal
+          generalization matrix) above the cluster-forming threshold are
+          grouped into clusters of adjacent points.
+        - The statistic of a cluster is the sum of its scores above chance.
+        - The p-value of each observed cluster is the proportion of
+          permutations whose largest cluster statistic is at least as large.
+    Parameters
+    ----------
+        scores : np.ndarray
+            Observed scores of shape (n_timepoints) or (n_timepoints,
+            n_timepoints)
+        null_scores : np.ndarray
+            Null scores of shape (n_permutations, ...), e.g. from
+            permutation_decoding or group_null_distribution
+        chance : float
+            Chance level of the scores
+        threshold : float | None
+            Cluster-forming threshold on the scores. If None, the threshold of
+            each timepoint is the 1 - p_threshold quantile of its null scores.
+        p_threshold : float | None
+            Cluster-forming p-value, used if threshold is None (0.05 if both
+            are None)
+    Returns
+    -------
+        clusters : list of np.ndarray
+            Boolean masks of shape scores.shape of the observed clusters
+        cluster_p_values : np.ndarray
+            Corrected p-value of each cluster
+        H0 : np.ndarray
+            Largest cluster statistic of each permutation
+    """
+    if threshold is not None and p_threshold is not None:
+        raise ValueError('Set only one of threshold and p_threshold')
+    if threshold is None:
+        p_threshold = 0.05 if p_threshold is None else p_threshold
+        threshold = np.quantile(null_scores, 1 - p_threshold, axis=0)
+
+    def _find_clusters(x):
+        labels, n_clusters = label_clusters(x > threshold)
+        stats = np.bincount(labels.ravel(), weights=(x - chance).ravel(),
+                            minlength=n_clusters + 1)[1:]
+        return labels, stats
+
+    labels, cluster_stats = _find_clusters(scores)
+    H0 = np.array([
+        _find_clusters(x)[1].max(initial=0) for x in null_scores
+    ])
+    clusters = [labels == i + 1 for i in range(len(cluster_stats))]
+    cluster_p_values = np.array([
+        (np.sum(H0 >= stat) + 1) / (len(H0) + 1) for stat in cluster_stats
+    ])
+    return clusters, cluster_p_values, H0
@@ -0,0 +1,255 @@
+import numpy as np
+
+
+def epochs_to_rsa_data(epochs, picks='mag', label_func=None):
+    """Data and condition labels of epochs, read once for all RSA functions
+
+    Parameters
+    ----------
+        epochs : mne.Epochs
+            Epochs object
+        picks : str | list
+            Channels to use
+        label_func : callable | None
+            Applied to the event name of every epoch to get its label (e.g.
+            lambda name: int(name.split('/')[0]) for the image index). If
+            None, the labels are the event names.
+    Returns
+    -------
+        X : np.ndarray
+            Data of shape (n_examples, n_channels, n_timepoints)
+        y : np.ndarray
+            Labels of shape (n_examples)
+    """
+    rev_event_id = {v: k for k, v in epochs.event_id.items()}
+    names = [rev_event_id[code] for code in epochs.events[:, 2]]
+    if label_func is not None:
+        names = [label_func(name) for name in names]
+    return epochs.get_data(picks=picks), np.array(names)
+
+
+def _group_matrix(group_ind, n_groups, dtype=np.float64):
+    """(n_groups, n_examples) indicator matrix of the group of each example"""
+    G = np.zeros((n_groups, len(group_ind)), dtype=dtype)
+    G[group_ind, np.arange(len(group_ind))] = 1
+    return G
+
+
+def condition_means(X, y):
+    """Average of the examples of each condition
+
+    Details
+    -------
+        - All conditions are averaged at once by multiplying the data with a
+          (n_conditions, n_examples) indicator matrix.
+    Parameters
+    ----------
+        X : np.ndarray
+            Input data of shape (n_examples, n_channels, n_timepoints)
+        y : np.ndarray
+            Labels of the input data of shape (n_examples)
+    Returns
+    -------
+        conditions : np.ndarray
+            Sorted unique labels of shape (n_conditions)
+        means : np.ndarray
+            Averages of shape (n_conditions, n_channels, n_timepoints)
+        counts : np.ndarray
+            Number of examples of each condition, of shape (n_conditions)
+    """
+    conditions, cond_ind, counts = np.unique(y, return_inverse=True, return_counts=True)
+    cond_ind = cond_ind.ravel()
+    G = _group_matrix(cond_ind, len(conditions))
+    means = (G @ X.reshape(len(X), -1)) / counts[:, np.newaxis]
+    return conditions, means.reshape((len(conditions),) + X.shape[1:]), counts
+
+
+def residual_precision(X, y, method='shrinkage_diag'):
+    """Noise precision matrix of the channels, from the residuals of the
+    examples around their condition means
+
+    Details
+    -------
+        - The residuals of all examples and timepoints are pooled, as in
+          rsatoolbox.data.prec_from_residuals on the residuals reshaped to
+          (n_examples*n_timepoints, n_channels), which this reproduces.
+        - The sums over the residuals are matrix products instead of a loop
+          over the residuals.
+    Parameters
+    ----------
+        X : np.ndarray
+            Input data of shape (n_examples, n_channels, n_timepoints)
+        y : np.ndarray
+            Labels of the input data of shape (n_examples)
+        method : str
+            Covariance estimator: 'full', 'diag', 'shrinkage_diag' (shrinkage
+            towards the diagonal, Schäfer & Strimmer 2005) or 'shrinkage_eye'
+            (shrinkage towards a multiple of the identity, Ledoit & Wolf 2004)
+    Returns
+    -------
+        prec : np.ndarray
+            Precision matrix of shape (n_channels, n_channels)
+    """
+    assert method in ['full', 'diag', 'shrinkage_diag', 'shrinkage_eye']
+    _, cond_ind = np.unique(y, return_inverse=True)
+    _, means, _ = condition_means(X, y)
+    residuals = X - means[cond_ind.ravel()]
+    residuals = np.swapaxes(residuals, 1, 2).reshape(-1, X.shape[1])
+    residuals = residuals - residuals.mean(axis=0)
+    n, dof = residuals.shape[0], residuals.shape[0] - 1
+
+    s_sum = residuals.T @ residuals
+    if method == 'full':
+        cov = s_sum / dof
+    elif method == 'diag':
+        cov = np.diag(np.diag(s_sum) / dof)
+    else:
+        res2 = residuals**2
+        s2_sum = res2.T @ res2
+        if method == 'shrinkage_diag':
+            s = s_sum / dof
+            var = np.diag(s)
+            s_mean = s_sum / np.sqrt(np.outer(var, var)) / (n - 1)
+            s2_mean = s2_sum / np.outer(var, var) / (n - 1)
+            var_hat = n / dof**2 * (s2_mean - s_mean**2)
+            mask = ~np.eye(len(s), dtype=bool)
+            lamb = np.clip(np.sum(var_hat[mask]) / np.sum(s_mean[mask]**2), 0, 1)
+            cov = s * np.where(mask, 1 - lamb, 1)
+        else:
+            s = s_sum / n
+            b2 = np.sum(s2_sum / n - s * s) / n
+            m = np.trace(s) / len(s)
+            d2 = np.sum((s - m * np.eye(len(s)))**2)
+            b2 = min(d2, b2)
+            cov = (b2 / d2 * m * np.eye(len(s)) + (d2 - b2) / d2 * s) * n / dof
+    return np.linalg.inv(cov)
+
+
+def default_cv_folds(y):
+    """Cross-validation fold of each example: the k-th example of every
+    condition is in fold k (as rsatoolbox does without a cv_descriptor)
+
+    Parameters
+    ----------
+        y : np.ndarray
+            Labels of the examples of shape (n_examples)
+    Returns
+    -------
+        folds : np.ndarray
+            Fold index of each example of shape (n_examples)
+    """
+    _, cond_ind, counts = np.unique(y, return_inverse=True, return_counts=True)
+    cond_ind = cond_ind.ravel()
+    if not np.all(counts == counts[0]):
+        raise ValueError('Different number of examples per condition: '
+                         'equalize the event counts or pass folds')
+    order = np.argsort(cond_ind, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    folds = np.empty(len(y), dtype=int)
+    folds[order] = np.arange(len(y)) - offsets[cond_ind[order]]
+    return folds
+
+
+def rdm_movie(
+    X,
+    y,
+    method='crossnobis',
+    noise=None,
+    folds=None,
+    max_bytes=None
+):
+    """Representational dissimilarity matrices of all timepoints
+
+    Details
+    -------
+        - 'euclidean' is the squared Euclidean distance between the condition
+          means (Mahalanobis with noise), 'crossnobis' the cross-validated
+          Mahalanobis distance: for every fold, the condition means of the
+          fold are compared with those of the other folds, and the distances
+          are averaged over the folds. Both are divided by the number of
+          channels, as in rsatoolbox.rdm.calc_rdm_movie.
+        - The means of all folds and conditions are computed with one matrix
+          product, the data are whitened with the Cholesky factor of the
+          precision, and the inner products of all condition pairs, folds and
+          timepoints are one batched matrix product.
+        - With max_bytes, the timepoints are processed in chunks so that the
+          intermediate arrays stay below about max_bytes.
+    Parameters
+    ----------
+        X : np.ndarray
+            Input data of shape (n_examples, n_channels, n_timepoints)
+        y : np.ndarray
+            Labels of the input data of shape (n_examples)
+        method : str
+            'crossnobis' or 'euclidean'
+        noise : np.ndarray | None
+            Noise precision matrix of shape (n_channels, n_channels), see
+            residual_precision. If None, the identity.
+        folds : np.ndarray | None
+            Cross-validation fold of each example (crossnobis only). If None,
+            see default_cv_folds.
+        max_bytes : int | None
+            Memory limit of the intermediate arrays. If None, all timepoints
+            are processed at once.
+    Returns
+    -------
+        conditions : np.ndarray
+            Sorted unique labels (rows and columns of the RDMs)
+        rdms : np.ndarray
+            Upper triangles (without the diagonal) of the RDMs, of shape
+            (n_timepoints, n_conditions*(n_conditions-1)/2)
+    """
+    assert method in ['crossnobis', 'euclidean']
+    n_examples, n_channels, n_times = X.shape
+    conditions, cond_ind = np.unique(y, return_inverse=True)
+    cond_ind = cond_ind.ravel()
+    n_cond = len(conditions)
+
+    if method == 'crossnobis':
+        if folds is None:
+            folds = default_cv_folds(y)
+        _, fold_ind = np.unique(folds, return_inverse=True)
+        n_folds = fold_ind.max() + 1
+    else:
+        fold_ind = np.zeros(n_examples, dtype=int)
+        n_folds = 1
+    group_ind = fold_ind.ravel() * n_cond + cond_ind
+    G = _group_matrix(group_ind, n_folds * n_cond)
+    fold_counts = G.sum(axis=1).reshape(n_folds, n_cond)
+    if method == 'crossnobis':
+        if np.any(fold_counts == 0):
+            raise ValueError('Every fold needs examples of every condition')
+        total_counts = fold_counts.sum(axis=0)
+        train_weights = 1 / (total_counts - fold_counts)
+    test_weights = 1 / fold_counts
+    L = np.eye(n_channels) if noise is None else np.linalg.cholesky(noise)
+
+    # Size of the intermediate arrays per timepoint: data, fold means (sums,
+    # test and train) and the kernel/RDM of the condition pairs
+    bytes_per_time = 8 * (n_examples * n_channels + 3 * n_folds * n_cond * n_channels
+                          + 3 * n_cond * n_cond)
+    chunk = n_times if max_bytes is None else int(max(1, max_bytes // bytes_per_time))
+
+    triu = np.triu_indices(n_cond, k=1)
+    rdms = np.empty((n_times, len(triu[0])))
+    for start in range(0, n_times, chunk):
+        stop = min(start + chunk, n_times)
+        n_t = stop - start
+        # Sums of the examples of each fold and condition, as
+        # (n_times, n_conditions, n_folds, n_channels), whitened
+        sums = G @ X[..., start:stop].reshape(n_examples, -1)
+        sums = sums.reshape(n_folds, n_cond, n_channels, n_t).transpose(3, 1, 0, 2) @ L
+        test = sums * test_weights.T[..., np.newaxis]
+        if method == 'crossnobis':
+            train = (sums.sum(axis=2, keepdims=True) - sums) * train_weights.T[..., np.newaxis]
+        else:
+            train = test
+        # Inner products of all condition pairs summed over the folds (one
+        # matrix product per timepoint), averaged over the folds
+        kernel = train.reshape(n_t, n_cond, -1) @ test.reshape(n_t, n_cond, -1).transpose(0, 2, 1)
+        kernel /= n_folds
+        diag = np.einsum('tcc->tc', kernel)
+        rdm = diag[:, :, np.newaxis] + diag[:, np.newaxis, :] - kernel - np.swapaxes(kernel, 1, 2)
+        rdms[start:stop] = rdm[:, triu[0], triu[1]] / n_channels
+
+    return conditions, rdms
@@ -0,0 +1,250 @@
+"""Run time-resolved decoding for many subjects in parallel
+
+Each epochs file is decoded with the functions of mvpa.py in a separate
+worker process, and the scores are appended to a single HDF5 store, under the
+name of the file (e.g. sub-01_ses-02_task-faces). Files already in the store
+are skipped, so an interrupted run can simply be started again.
+
+Usage:
+    python run_decoding.py spec.json scores.h5 sub-01-epo.fif sub-02-epo.fif ... \
+        --n-jobs 8 --n-threads 1
+
+The pipeline spec is a JSON file, e.g.:
+    {
+        "picks": "meg",
+        "model": "shrinkage",
+        "alpha": "auto",
+        "scoring": "roc_auc",
+        "cv": 5,
+        "window_size": null,
+        "win_func": "expand_features",
+        "generalization": false
+    }
+Missing keys take the values of DEFAULT_SPEC.
+"""
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import h5py
+
+
+DEFAULT_SPEC = {
+    'picks': 'meg',
+    'model': 'shrinkage',
+    'alpha': 'auto',
+    'scoring': 'roc_auc',
+    'cv': 5,
+    'window_size': None,
+    'win_func': 'expand_features',
+    'generalization': False,
+}
+
+# Environment variables read by the BLAS/OpenMP libraries at import time
+_THREAD_ENV_VARS = [
+    'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS',
+]
+
+
+def _init_worker(n_threads):
+    """Limit the BLAS/OpenMP threads of a worker process"""
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(limits=n_threads)
+
+
+@contextlib.contextmanager
+def _thread_env(n_threads):
+    """Set the thread variables inherited by the spawned workers (read before
+    numpy is imported), and restore those of this process afterwards"""
+    saved = {var: os.environ.get(var) for var in _THREAD_ENV_VARS}
+    os.environ.update({var: str(n_threads) for var in _THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def store_key(fname):
+    """Name of the results of an epochs file in the store: the file name
+    without the epochs suffix, e.g. sub-01_ses-02_task-x for
+    sub-01_ses-02_task-x-epo.fif (so sessions, runs and tasks of a subject
+    are kept apart)"""
+    name = os.path.basename(fname)
+    for suffix in ['-epo.fif', '_epo.fif', '.fif']:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def decode_subject(fname, spec):
+    """Decode the epochs of one subject
+
+    Parameters
+    ----------
+        fname : str
+            Path of the -epo.fif file. The event codes are the labels.
+        spec : dict
+            Pipeline spec (see DEFAULT_SPEC)
+    Returns
+    -------
+        scores : np.ndarray
+            Scores of shape (n_splits, n_timepoints), or (n_splits,
+            n_timepoints, n_timepoints) if spec['generalization'] is True
+        times : np.ndarray
+            Times of the scores
+    """
+    import mne
+    from mne.decoding import cross_val_multiscore
+    import mvpa
+
+    epochs = mne.read_epochs(fname, preload=True, verbose='error')
+    epochs.pick(spec['picks'], exclude='bads')
+    X = epochs.get_data(copy=False)
+    y = epochs.events[:, 2]
+    times = epochs.times
+    if spec['window_size'] is not None:
+        preprocessor = mvpa.moving_window_preprocessor(
+            moving_window_size=spec['window_size'],
+            moving_window_func=spec['win_func']
+        )
+        X = preprocessor.fit_transform(X)
+        times = times[spec['window_size'] - 1:]
+
+    estimator = mvpa.LinearSlidingEstimator(
+        model=spec['model'],
+        alpha=spec['alpha'],
+        scoring=spec['scoring']
+    )
+    if spec['generalization']:
+        scores = mvpa.cross_val_generalization(
+            estimator, X, y, cv=spec['cv'], scoring=spec['scoring'])
+    else:
+        scores = cross_val_multiscore(estimator, X, y, cv=spec['cv'], n_jobs=None)
+    return scores, times
+
+
+def stored_keys(store_fname, spec):
+    """Names of the epochs files already in the store
+
+    Raises a ValueError if the store was computed with another spec.
+    """
+    if not os.path.exists(store_fname):
+        return set()
+    with h5py.File(store_fname, 'r') as store:
+        stored_spec = json.loads(store.attrs['spec'])
+        if stored_spec != spec:
+            raise ValueError(
+                f"{store_fname} was computed with another spec: {stored_spec}"
+            )
+        # Only complete entries (the times are written last)
+        return {key for key in store if 'times' in store[key]}
+
+
+def load_store(store_fname):
+    """All results of the store, as a dict of arrays ('<key>/scores' and
+    '<key>/times')"""
+    with h5py.File(store_fname, 'r') as store:
+        return {f'{key}/{name}': store[key][name][()]
+                for key in store for name in store[key]}
+
+
+def append_store(store_fname, spec, key, scores, times):
+    """Add the results of one epochs file to the store (without rewriting
+    the others)"""
+    with h5py.File(store_fname, 'a') as store:
+        store.attrs['spec'] = json.dumps(spec, sort_keys=True)
+        if key in store:
+            del store[key]
+        group = store.create_group(key)
+        group.create_dataset('scores', data=scores, compression='gzip')
+        group.create_dataset('times', data=times)
+
+
+def run_decoding(
+    epochs_fnames,
+    store_fname,
+    spec=None,
+    n_jobs=1,
+    n_threads=1
+):
+    """Decode many subjects in parallel and collect the scores in a store
+
+    Parameters
+    ----------
+        epochs_fnames : list of str
+            Epochs files (e.g. one per subject, session or run)
+        store_fname : str
+            Path of the HDF5 store. For every epochs file it holds the
+            datasets '<key>/scores' and '<key>/times', with key the file name
+            without the epochs suffix (see store_key), and the spec as an
+            attribute. Read it with load_store.
+        spec : dict | None
+            Pipeline spec (see DEFAULT_SPEC)
+        n_jobs : int
+            Number of worker processes
+        n_threads : int
+            Number of BLAS/OpenMP threads of each worker
+    Returns
+    -------
+        failed : dict
+            Error message of every subject that failed
+    """
+    spec = {**DEFAULT_SPEC, **(spec or {})}
+    spec = json.loads(json.dumps(spec, sort_keys=True))
+    keys = [store_key(fname) for fname in epochs_fnames]
+    if len(set(keys)) < len(keys):
+        raise ValueError("Several epochs files have the same name")
+    done = stored_keys(store_fname, spec)
+    todo = [fname for fname, key in zip(epochs_fnames, keys) if key not in done]
+    print(f"{len(epochs_fnames) - len(todo)} files already in {store_fname}, "
+          f"{len(todo)} to decode")
+
+    failed = {}
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(n_jobs, mp_context=ctx, initializer=_init_worker,
+                             initargs=(n_threads,)) as pool:
+        # The workers are started by submit, with the thread variables set
+        with _thread_env(n_threads):
+            futures = {pool.submit(decode_subject, fname, spec): fname for fname in todo}
+        for future in as_completed(futures):
+            key = store_key(futures[future])
+            try:
+                scores, times = future.result()
+            except Exception as e:
+                failed[key] = repr(e)
+                print(f"{key}: failed ({e!r})")
+                continue
+            # Save after every file, so that a crash only loses running jobs
+            append_store(store_fname, spec, key, scores, times)
+            print(f"{key}: done at {time.strftime('%H:%M:%S', time.localtime())}")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('spec', help='JSON file with the pipeline spec')
+    parser.add_argument('store', help='Output HDF5 store')
+    parser.add_argument('epochs', nargs='+', help='Epochs files')
+    parser.add_argument('--n-jobs', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--n-threads', type=int, default=1, help='BLAS threads per worker')
+    args = parser.parse_args()
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+    failed = run_decoding(args.epochs, args.store, spec, args.n_jobs, args.n_threads)
+    if failed:
+        raise SystemExit(f"{len(failed)} files failed: {', '.join(failed)}")
+
+
+if __name__ == '__main__':
+    main()
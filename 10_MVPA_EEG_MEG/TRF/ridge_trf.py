@@ -0,0 +1,578 @@
+from numpy.lib.stride_tricks import sliding_window_view
+import numpy as np
+
+
+def _as_trials(data):
+    """List of (n_samples, n_features) float arrays from an array or list"""
+    if data is None:
+        return None
+    if isinstance(data, np.ndarray):
+        data = [data]
+    trials = []
+    for trial in data:
+        trial = np.asarray(trial, dtype=np.float64)
+        trials.append(trial[:, np.newaxis] if trial.ndim == 1 else trial)
+    return trials
+
+
+def _get_xy(stimulus, response, tmin, tmax, direction):
+    """Predictors, estimands and lag range of a forward (1) or backward (-1)
+    model"""
+    stimulus, response = _as_trials(stimulus), _as_trials(response)
+    if stimulus is not None and response is not None:
+        if len(stimulus) != len(response):
+            raise ValueError('Need the same number of stimulus and response trials')
+        if any(len(s) != len(r) for s, r in zip(stimulus, response)):
+            raise ValueError('Stimulus and response trials need the same length')
+    if direction == 1:
+        return stimulus, response, tmin, tmax
+    elif direction == -1:
+        return response, stimulus, -tmax, -tmin
+    raise ValueError('direction must be 1 or -1')
+
+
+def lag_indices(tmin, tmax, fs):
+    """Time lags in samples, as mTRFpy (mtrf.matrices.lags_idx)"""
+    return np.arange(int(np.floor(tmin * fs)), int(np.ceil(tmax * fs)) + 1)
+
+
+def lagged_view(x, lags):
+    """Time-lagged design of x as a strided view
+
+    Details
+    -------
+        - Row t, lag i, feature f is x[t - lags[i], f], or 0 outside of x
+          (zero padding, as mtrf.matrices.lag_matrix).
+        - Only x padded with max(|lags|) zeros is copied; the design itself is
+          a view, materialized block by block where it is needed (see
+          trial_statistics). view.reshape(n_samples, -1) gives the columns in
+          the order of mTRFpy (lag by lag, all features of each lag).
+    Parameters
+    ----------
+        x : np.ndarray
+            Data of shape (n_samples, n_features)
+        lags : np.ndarray
+            Consecutive lags in samples, see lag_indices
+    Returns
+    -------
+        view : np.ndarray
+            Read-only view of shape (n_samples, n_lags, n_features)
+    """
+    n_samples = len(x)
+    pre, post = max(lags[-1], 0), max(-lags[0], 0)
+    x_pad = np.pad(x, ((pre, post), (0, 0)))
+    windows = sliding_window_view(x_pad, len(lags), axis=0)
+    start = pre - lags[-1]
+    return windows[start:start + n_samples, :, ::-1].transpose(0, 2, 1)
+
+
+def _empty_statistics(n_x, n_y):
+    return dict(
+        n=0,
+        x_sum=np.zeros(n_x),
+        y_sum=np.zeros(n_y),
+        xx=np.zeros((n_x, n_x)),
+        xy=np.zeros((n_x, n_y)),
+        yy=np.zeros(n_y)
+    )
+
+
+def _accumulate(stats, X, y):
+    """Add the sums of a block of the lagged design X and estimands y"""
+    stats['n'] += len(X)
+    stats['x_sum'] += X.sum(axis=0)
+    stats['y_sum'] += y.sum(axis=0)
+    stats['xx'] += X.T @ X
+    stats['xy'] += X.T @ y
+    stats['yy'] += np.sum(y**2, axis=0)
+
+
+def trial_statistics(x, y, lags, block_size=4096):
+    """Sums of the lagged design and estimands of one trial
+
+    Details
+    -------
+        - The lagged design is read from lagged_view block_size samples at a
+          time, so only one block of it is in memory.
+        - All fits and cross-validations below work on these sums only, the
+          lagged design is not built again.
+    Parameters
+    ----------
+        x : np.ndarray
+            Predictors of shape (n_samples, n_features)
+        y : np.ndarray
+            Estimands of shape (n_samples, n_outputs)
+        lags : np.ndarray
+            Lags in samples, see lag_indices
+        block_size : int
+            Number of samples of the lagged design materialized at a time
+    Returns
+    -------
+        stats : dict
+            n (number of samples), x_sum (n_lags*n_features), y_sum
+            (n_outputs), xx (X'X), xy (X'y) and yy (sum of squares of y)
+    """
+    view = lagged_view(x, lags)
+    stats = _empty_statistics(len(lags) * x.shape[1], y.shape[1])
+    for start in range(0, len(x), block_size):
+        stop = min(start + block_size, len(x))
+        _accumulate(stats, view[start:stop].reshape(stop - start, -1), y[start:stop])
+    return stats
+
+
+def _combine(stats_list):
+    """Sum of the statistics of several trials"""
+    total = {key: 0 for key in stats_list[0]}
+    for stats in stats_list:
+        for key in total:
+            total[key] = total[key] + stats[key]
+    return total
+
+
+def _subtract(total, stats):
+    return {key: total[key] - stats[key] for key in total}
+
+
+def _centered(stats):
+    """Means and centered sums of products of the statistics"""
+    n = stats['n']
+    x_mean, y_mean = stats['x_sum'] / n, stats['y_sum'] / n
+    xx = stats['xx'] - n * np.outer(x_mean, x_mean)
+    xy = stats['xy'] - n * np.outer(x_mean, y_mean)
+    yy = stats['yy'] - n * y_mean**2
+    return x_mean, y_mean, xx, xy, yy
+
+
+def _ridge_eigenbasis(stats, regularization, fs, n_trials):
+    """Ridge solutions of all regularization values in the eigenbasis of the
+    centered X'X
+
+    Details
+    -------
+        - mTRFpy solves (mean_trials(X'X) + lambda*fs*I) w = mean_trials(X'y)
+          with an unpenalized bias column. This equals the ridge regression of
+          the centered sums with a penalty lambda*fs*n_trials, and the bias
+          from the means.
+        - With X'X = V diag(d) V', the solution of each lambda is
+          V diag(1/(d + lambda)) V'X'y: one eigendecomposition for all values.
+    Returns
+    -------
+        V : np.ndarray
+            Eigenvectors of shape (n_weights, n_weights)
+        Z : np.ndarray
+            Solutions in the eigenbasis, (n_lambdas, n_weights, n_outputs)
+    """
+    _, _, xx, xy, _ = _centered(stats)
+    d, V = np.linalg.eigh(xx)
+    penalty = np.atleast_1d(regularization).astype(np.float64) * fs * n_trials
+    Z = (V.T @ xy)[np.newaxis] / (d[np.newaxis, :, np.newaxis] + penalty[:, np.newaxis, np.newaxis])
+    return V, Z
+
+
+def ridge_path(stats, regularization, fs, n_trials=1):
+    """Ridge weights of all regularization values
+
+    Parameters
+    ----------
+        stats : dict
+            Summed statistics of the training data, see trial_statistics
+        regularization : float | np.ndarray
+            Regularization values (lambda)
+        fs : float
+            Sampling rate
+        n_trials : int
+            Number of trials summed in stats (the penalty of mTRFpy is on the
+            average covariance of the trials)
+    Returns
+    -------
+        weights : np.ndarray
+            Weights of shape (n_lambdas, n_lags*n_features, n_outputs), scaled
+            by fs as in mTRFpy
+        bias : np.ndarray
+            Bias of shape (n_lambdas, n_outputs), scaled by fs
+    """
+    x_mean, y_mean, _, _, _ = _centered(stats)
+    V, Z = _ridge_eigenbasis(stats, regularization, fs, n_trials)
+    weights = V @ Z
+    bias = y_mean - np.einsum('p,lpo->lo', x_mean, weights)
+    return weights * fs, bias * fs
+
+
+def loo_correlation(stats_list, regularization, fs):
+    """Leave-one-trial-out prediction accuracy of all regularization values
+
+    Details
+    -------
+        - The training sums of each left-out trial are the total minus the
+          sums of that trial, and the weights of all regularization values come
+          from one eigendecomposition (see ridge_path).
+        - The Pearson correlation between the prediction and the left-out
+          trial is computed from the centered sums of that trial, for all
+          regularization values and outputs at once, without predicting:
+          cov(y, Xw) = w'X'y and var(Xw) = w'X'Xw.
+    Parameters
+    ----------
+        stats_list : list of dict
+            Statistics of every trial, see trial_statistics
+        regularization : float | np.ndarray
+            Regularization values (lambda)
+        fs : float
+            Sampling rate
+    Returns
+    -------
+        r : np.ndarray
+            Correlation of shape (n_lambdas, n_trials, n_outputs)
+    """
+    n_trials = len(stats_list)
+    if n_trials < 2:
+        raise ValueError('Need at least 2 trials for cross-validation')
+    total = _combine(stats_list)
+    n_lambdas = len(np.atleast_1d(regularization))
+    r = np.full((n_lambdas, n_trials, stats_list[0]['yy'].shape[0]), np.nan)
+    for k, test in enumerate(stats_list):
+        V, Z = _ridge_eigenbasis(_subtract(total, test), regularization, fs, n_trials - 1)
+        W = V @ Z
+        _, _, xx, xy, yy = _centered(test)
+        cov = np.sum(xy[np.newaxis] * W, axis=1)
+        var_pred = np.sum((xx @ W) * W, axis=1)
+        den = np.sqrt(yy * var_pred)
+        np.divide(cov, den, out=r[:, k], where=den > 0)
+    return np.clip(r, -1, 1)
+
+
+def train_trf(
+    stimulus,
+    response,
+    fs,
+    tmin,
+    tmax,
+    regularization,
+    direction=1,
+    block_size=4096
+):
+    """Fit a forward or backward TRF, selecting the regularization by
+    leave-one-trial-out cross-validation
+
+    Details
+    -------
+        - Same model as mtrf.model.TRF.train (ridge, zero padding, bias),
+          with the leave-one-out cross-validation of all regularization
+          values done on the trial sums (see loo_correlation) instead of
+          refitting every value and fold.
+        - The best regularization value has the highest correlation averaged
+          over the trials and outputs; the returned TRF is fitted to all
+          trials with it.
+    Parameters
+    ----------
+        stimulus : np.ndarray | list of np.ndarray
+            Stimulus trials of shape (n_samples, n_features) or (n_samples)
+        response : np.ndarray | list of np.ndarray
+            Response trials of shape (n_samples, n_channels)
+        fs : float
+            Sampling rate
+        tmin, tmax : float
+            Range of the time lags (s)
+        regularization : float | list
+            Regularization value(s) (lambda)
+        direction : int
+            1 for a forward (encoding) model, -1 for a backward (decoding) one
+        block_size : int
+            Number of samples of the lagged design materialized at a time
+    Returns
+    -------
+        trf : dict
+            weights (n_inputs, n_lags, n_outputs), bias (1, n_outputs),
+            times (lags in s), fs, direction and regularization, with the
+            same values as the attributes of mtrf.model.TRF
+        r : np.ndarray | None
+            Cross-validated correlation of shape (n_lambdas, n_outputs),
+            averaged over the trials; None for a single regularization value
+    """
+    x, y, tmin, tmax = _get_xy(stimulus, response, tmin, tmax, direction)
+    lags = lag_indices(tmin, tmax, fs)
+    stats_list = [trial_statistics(x_i, y_i, lags, block_size) for x_i, y_i in zip(x, y)]
+    return _fit_statistics(stats_list, lags, fs, direction, regularization)
+
+
+def _fit_statistics(stats_list, lags, fs, direction, regularization):
+    """TRF of the trial statistics, with the regularization selected by
+    leave-one-trial-out cross-validation if there are several values"""
+    r = None
+    if np.ndim(regularization) > 0:
+        regularization = np.asarray(regularization, dtype=np.float64)
+        r = loo_correlation(stats_list, regularization, fs).mean(axis=1)
+        regularization = regularization[np.argmax(np.nanmean(r, axis=1))]
+
+    weights, bias = ridge_path(_combine(stats_list), regularization, fs, len(stats_list))
+    n_inputs = stats_list[0]['x_sum'].shape[0] // len(lags)
+    return dict(
+        weights=weights[0].reshape(len(lags), n_inputs, -1).transpose(1, 0, 2),
+        bias=bias[0][np.newaxis],
+        times=lags / fs,
+        fs=fs,
+        direction=direction,
+        regularization=float(regularization)
+    ), r
+
+
+def pearsonr(y, y_pred):
+    """Pearson correlation of every column of y and y_pred"""
+    y = y - y.mean(axis=0)
+    y_pred = y_pred - y_pred.mean(axis=0)
+    num = np.sum(y * y_pred, axis=0)
+    den = np.sqrt(np.sum(y**2, axis=0) * np.sum(y_pred**2, axis=0))
+    r = np.full(num.shape, np.nan)
+    np.divide(num, den, out=r, where=den > 0)
+    return r
+
+
+def predict_trf(trf, stimulus=None, response=None, block_size=4096):
+    """Predict the response (forward) or stimulus (backward) with a TRF
+
+    Parameters
+    ----------
+        trf : dict
+            TRF, see train_trf
+        stimulus, response : np.ndarray | list of np.ndarray | None
+            Trials; the predictors of the model are required, the estimands
+            are optional and used to compute the accuracy
+        block_size : int
+            Number of samples of the lagged design materialized at a time
+    Returns
+    -------
+        prediction : list of np.ndarray
+            Predicted trials of shape (n_samples, n_outputs)
+        r : np.ndarray | None
+            Correlation of every output averaged over the trials (as
+            mtrf.model.TRF.predict with average=False), if the estimands are
+            given
+    """
+    times = trf['times']
+    x, y, _, _ = _get_xy(stimulus, response, times[0], times[-1], trf['direction'])
+    if x is None:
+        raise ValueError('Need the predictors of the model to predict')
+    lags = np.round(np.asarray(times) * trf['fs']).astype(int)
+    weights = trf['weights']
+    w = weights.transpose(1, 0, 2).reshape(-1, weights.shape[-1]) / trf['fs']
+    bias = trf['bias'] / trf['fs']
+
+    prediction = []
+    for x_i in x:
+        view = lagged_view(x_i, lags)
+        y_pred = np.empty((len(x_i), w.shape[1]))
+        for start in range(0, len(x_i), block_size):
+            stop = min(start + block_size, len(x_i))
+            y_pred[start:stop] = view[start:stop].reshape(stop - start, -1) @ w + bias
+        prediction.append(y_pred)
+    if y is None:
+        return prediction, None
+    r = np.mean([pearsonr(y_i, p_i) for y_i, p_i in zip(y, prediction)], axis=0)
+    return prediction, r
+
+
+class StreamingTRF:
+    """TRF fitted incrementally from chunks of long recordings
+
+    Details
+    -------
+        - partial_fit takes consecutive chunks of a recording and adds the
+          sums of their lagged design (see trial_statistics) to the
+          statistics; only the last max(|lags|) samples of the predictors
+          and the estimands still waiting for future samples (negative lags)
+          are kept between chunks, so the lagged rows across chunk boundaries
+          are the same as for the whole recording. end_trial zero-pads the
+          end of a recording, as train_trf does for every trial.
+        - The statistics are kept per segment of segment_samples samples
+          (every trial starts a new segment), for the cross-validation of the
+          regularization in finalize. With n_folds, segment k is added to
+          fold k % n_folds, so the memory stays n_folds X'X matrices however
+          long the recordings are.
+        - Without segment_samples and n_folds, every trial is one unit and
+          finalize gives the same TRF as train_trf on the whole trials.
+    Parameters
+    ----------
+        fs : float
+            Sampling rate
+        tmin, tmax : float
+            Range of the time lags (s)
+        direction : int
+            1 for a forward (encoding) model, -1 for a backward (decoding) one
+        segment_samples : int | None
+            Number of samples per cross-validation segment. If None, one
+            segment per trial.
+        n_folds : int | None
+            Number of folds the segments are spread over. If None, every
+            segment is a fold. The regularization is relative to the average
+            covariance of the folds, as if they were the trials of train_trf.
+        block_size : int
+            Number of samples of the lagged design materialized at a time
+    """
+    def __init__(
+        self,
+        fs,
+        tmin,
+        tmax,
+        direction=1,
+        segment_samples=None,
+        n_folds=None,
+        block_size=4096
+    ):
+        if direction not in [1, -1]:
+            raise ValueError('direction must be 1 or -1')
+        if direction == -1:
+            tmin, tmax = -tmax, -tmin
+        self.fs = fs
+        self.direction = direction
+        self.lags = lag_indices(tmin, tmax, fs)
+        self.segment_samples = segment_samples
+        self.n_folds = n_folds
+        self.block_size = block_size
+        self.stats_list = []
+        self._n_segments = 0
+        self._x_buf = None
+
+    def _start_trial(self, n_x, n_y):
+        # Predictors from time -lags[-1] of the first row (zeros before the
+        # trial), and estimands of the rows not accumulated yet
+        self._x_buf = np.zeros((max(self.lags[-1], 0), n_x))
+        self._y_buf = np.zeros((0, n_y))
+        self._skip = max(-self.lags[-1], 0)
+        self._segment = None
+        self._segment_rows = 0
+
+    def _new_segment(self):
+        n_x = len(self.lags) * self._x_buf.shape[1]
+        n_y = self._y_buf.shape[1]
+        if self.n_folds is not None and self._n_segments >= self.n_folds:
+            self._segment = self.stats_list[self._n_segments % self.n_folds]
+        else:
+            self._segment = _empty_statistics(n_x, n_y)
+            self.stats_list.append(self._segment)
+        self._n_segments += 1
+        self._segment_rows = 0
+
+    def _emit(self, n_rows):
+        """Accumulate the first n_rows pending rows and drop their samples"""
+        windows = sliding_window_view(self._x_buf, len(self.lags), axis=0)
+        view = windows[:n_rows, :, ::-1].transpose(0, 2, 1)
+        start = 0
+        while start < n_rows:
+            if self._segment is None or (self.segment_samples is not None
+                                         and self._segment_rows >= self.segment_samples):
+                self._new_segment()
+            stop = min(start + self.block_size, n_rows)
+            if self.segment_samples is not None:
+                stop = min(stop, start + self.segment_samples - self._segment_rows)
+            _accumulate(self._segment, view[start:stop].reshape(stop - start, -1),
+                        self._y_buf[start:stop])
+            self._segment_rows += stop - start
+            start = stop
+        self._x_buf = self._x_buf[n_rows:].copy()
+        self._y_buf = self._y_buf[n_rows:].copy()
+
+    def partial_fit(self, stimulus, response):
+        """Add the next chunk of the current trial
+
+        Parameters
+        ----------
+            stimulus : np.ndarray
+                Stimulus chunk of shape (n_samples, n_features) or (n_samples)
+            response : np.ndarray
+                Response chunk of shape (n_samples, n_channels)
+        Returns
+        -------
+            self : StreamingTRF
+        """
+        (x,), (y,), _, _ = _get_xy([stimulus], [response], 0, 0, self.direction)
+        if self._x_buf is None:
+            self._start_trial(x.shape[1], y.shape[1])
+        if self._skip:
+            n_skip = min(self._skip, len(x))
+            x, self._skip = x[n_skip:], self._skip - n_skip
+        self._x_buf = np.concatenate([self._x_buf, x])
+        self._y_buf = np.concatenate([self._y_buf, y])
+        # Rows whose lagged samples have all been received
+        n_ready = min(len(self._y_buf), max(len(self._x_buf) - len(self.lags) + 1, 0))
+        if n_ready:
+            self._emit(n_ready)
+        return self
+
+    def end_trial(self):
+        """End the current trial: the remaining rows are zero-padded"""
+        if self._x_buf is None:
+            return self
+        n_pad = len(self._y_buf) + len(self.lags) - 1 - len(self._x_buf)
+        if n_pad > 0:
+            self._x_buf = np.concatenate([self._x_buf, np.zeros((n_pad, self._x_buf.shape[1]))])
+        if len(self._y_buf):
+            self._emit(len(self._y_buf))
+        self._x_buf = None
+        return self
+
+    def finalize(self, regularization):
+        """Ridge solution of the accumulated statistics
+
+        Parameters
+        ----------
+            regularization : float | list
+                Regularization value(s) (lambda); with several values, the
+                best one by leave-one-fold-out cross-validation
+        Returns
+        -------
+            trf : dict
+                TRF, see train_trf
+            r : np.ndarray | None
+                Cross-validated correlation of shape (n_lambdas, n_outputs),
+                averaged over the folds
+        """
+        self.end_trial()
+        if not self.stats_list:
+            raise ValueError('No data: call partial_fit first')
+        if np.ndim(regularization) > 0 and len(self.stats_list) < 2:
+            raise ValueError('Selecting the regularization needs at least 2 folds: set '
+                             'segment_samples (and n_folds) to split the recordings, or '
+                             'give one regularization value')
+        return _fit_statistics(self.stats_list, self.lags, self.fs, self.direction,
+                               regularization)
+
+
+def fit_stream(
+    chunks,
+    fs,
+    tmin,
+    tmax,
+    regularization,
+    direction=1,
+    segment_samples=None,
+    n_folds=5,
+    block_size=4096
+):
+    """Fit a TRF to one continuous recording read chunk by chunk
+
+    Parameters
+    ----------
+        chunks : iterable
+            Consecutive (stimulus, response) chunks, e.g. a generator reading
+            a long recording from disk
+        segment_samples : int | None
+            Number of samples per cross-validation segment. If None, the
+            recording is one segment with one regularization value, and is
+            split into segments of 10 s with several values (one segment
+            could not cross-validate them)
+        fs, tmin, tmax, direction, n_folds, block_size
+            See StreamingTRF
+        regularization : float | list
+            Regularization value(s) (lambda), see StreamingTRF.finalize
+    Returns
+    -------
+        trf : dict
+            TRF, see train_trf
+        r : np.ndarray | None
+            Cross-validated correlation of shape (n_lambdas, n_outputs)
+    """
+    if segment_samples is None and np.ndim(regularization) > 0:
+        segment_samples = int(round(10 * fs))
+    model = StreamingTRF(fs, tmin, tmax, direction, segment_samples, n_folds, block_size)
+    for stimulus, response in chunks:
+        model.partial_fit(stimulus, response)
+    return model.finalize(regularization)